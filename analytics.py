@@ -6,6 +6,8 @@ import time
 from collections import Counter, defaultdict
 import altair as alt
 
+from detection_result import DetectionResult
+
 class DetectionAnalytics:
     def __init__(self, max_history=100):
         """
@@ -28,24 +30,25 @@ class DetectionAnalytics:
     
     def update_analytics(self, detection_results, detection_time=None):
         """
-        Update analytics data with new detection results
+        Update analytics data with new detection results (a result dict or a DetectionResult)
         """
-        if not detection_results or "objects" not in detection_results:
-            return
+        if not isinstance(detection_results, DetectionResult):
+            if not detection_results or "objects" not in detection_results:
+                return
+            detection_results = DetectionResult.from_json(detection_results)
         
-        objects = detection_results["objects"]
         timestamp = time.time()
         
         # Update object counts
-        categories = [obj.get("category", "unknown") for obj in objects]
-        for category in categories:
-            st.session_state.object_counts[category] += 1
+        category_counts = detection_results.category_counts("unknown")
+        for category, count in category_counts.items():
+            st.session_state.object_counts[category] += count
         
         # Update object history
         entry = {
             "timestamp": timestamp,
-            "total_objects": len(objects),
-            "categories": Counter(categories)
+            "total_objects": len(detection_results),
+            "categories": Counter(category_counts)
         }
         st.session_state.object_history.append(entry)
         
@@ -54,10 +57,11 @@ class DetectionAnalytics:
             st.session_state.object_history = st.session_state.object_history[-self.max_history:]
         
         # Update confidence history
-        for obj in objects:
-            category = obj.get("category", "unknown")
-            score = obj.get("score", 0)
-            st.session_state.confidence_history[category].append((timestamp, score))
+        categories = detection_results.category_names("unknown")
+        scores = np.asarray(detection_results.score_list(0))
+        for category in category_counts:
+            category_scores = scores[categories == category].tolist()
+            st.session_state.confidence_history[category].extend((timestamp, score) for score in category_scores)
         
         # Limit confidence history size
         for category in st.session_state.confidence_history:
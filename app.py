@@ -10,12 +10,24 @@ import json
 from dotenv import load_dotenv
 
 # Import custom modules
-from dinox_api import detect_objects, encode_image_to_base64
-from visualization import visualize_detection_results, create_detection_summary
+from detection_result import DetectionResult
+from dinox_api import detect_objects
+from image_payload import EncodedImage, hash_image, sniff_mime, upload_stats
+from postprocess import NMS_IOU_THRESHOLD, category_names, filter_result, request_threshold
+from visualization import create_detection_summary
+from render_cache import get_render_cache, render_detection_png
+from rate_limit import limiter_stats
+from result_cache import get_result_cache
+from tiling import TILE_OVERLAP, TILE_SIZE, detect_objects_tiled
+from singleflight import inflight_requests
+from task_journal import get_task_journal, start_task_recovery
 
 # Load environment variables
 load_dotenv()
 
+# 恢复上次进程退出时仍在进行的任务（每个进程只在后台执行一次，结果写入结果缓存）
+start_task_recovery()
+
 # Set page configuration
 st.set_page_config(
     page_title="DINO-X 图像检测",
@@ -78,6 +90,47 @@ if 'uploaded_image' not in st.session_state:
     st.session_state.uploaded_image = None
 if 'processed_image' not in st.session_state:
     st.session_state.processed_image = None
+# 图像内容的标识（渲染缓存的键）：重跑时重新解码得到的数组内容相同、键也相同
+if 'uploaded_image_key' not in st.session_state:
+    st.session_state.uploaded_image_key = None
+if 'processed_image_key' not in st.session_state:
+    st.session_state.processed_image_key = None
+if 'uploaded_payload' not in st.session_state:
+    st.session_state.uploaded_payload = None
+if 'request_threshold' not in st.session_state:
+    st.session_state.request_threshold = None
+
+def set_uploaded_payload(file_bytes):
+    """
+    Keep the original file bytes so an unmodified image is uploaded without re-encoding
+    同一文件在多次rerun之间复用同一个 EncodedImage，其编码结果只计算一次
+    """
+    payload = st.session_state.uploaded_payload
+    if payload is not None and payload.data == file_bytes:
+        return
+    st.session_state.uploaded_payload = EncodedImage(file_bytes) if sniff_mime(file_bytes) else None
+
+def set_uploaded_image(image_np, file_bytes):
+    """Store the decoded upload together with a content key (the file hash, computed once per file)"""
+    payload = st.session_state.uploaded_payload
+    st.session_state.uploaded_image = image_np
+    st.session_state.uploaded_image_key = (payload.digest if payload is not None and payload.data == file_bytes
+                                           else hash_image(file_bytes))
+
+def set_processed_image(image, key=None):
+    """Store an adjusted image; `key` identifies its content (None: the render cache hashes the pixels)"""
+    st.session_state.processed_image = image
+    st.session_state.processed_image_key = key
+
+def get_image_to_analyze():
+    """
+    The adjusted image if the user modified it, otherwise the original uploaded file
+    """
+    if st.session_state.processed_image is not None:
+        return st.session_state.processed_image
+    if st.session_state.uploaded_payload is not None:
+        return st.session_state.uploaded_payload
+    return st.session_state.uploaded_image
 
 # Main application header
 st.markdown("<h1 class='main-header'>DINO-X 图像检测</h1>", unsafe_allow_html=True)
@@ -170,9 +223,20 @@ with st.sidebar:
     # 始终包含bbox目标
     targets = ["bbox"]
     
-    # 置信度阈值
+    # 置信度阈值（在本地对已返回的结果过滤，调整时不会重新请求API）
     confidence_threshold = st.slider("置信度阈值", 0.0, 1.0, 0.25, 0.05)
     
+    # 同类别框的NMS IoU阈值，1.0 表示不做本地NMS
+    nms_iou_threshold = st.slider("NMS IoU 阈值", 0.1, 1.0, min(max(NMS_IOU_THRESHOLD, 0.1), 1.0), 0.05,
+                                  help="在本地对同一类别的重叠框进行非极大值抑制，1.0 表示关闭")
+    
+    # 大图分块检测：切成重叠的小块并发检测后合并，适合航拍、扫描件等远大于模型输入的图像
+    tiled_detection = st.checkbox("大图分块检测", value=False, key="tiled_detection",
+                                  help="把图像切成重叠的分块分别检测，提高小目标的检出率")
+    if tiled_detection:
+        tile_size = st.slider("分块大小", 256, 2048, TILE_SIZE, 128)
+        tile_overlap = st.slider("分块重叠比例", 0.0, 0.5, TILE_OVERLAP, 0.05)
+    
     # 简化可视化选项，只保留边界框显示
     st.markdown("<h3>可视化选项</h3>", unsafe_allow_html=True)
     show_bbox = st.checkbox("显示边界框", value=True, key="show_bbox")
@@ -194,13 +258,15 @@ with col1:
         if uploaded_file is not None:
             try:
                 # Read the image
-                image = Image.open(uploaded_file)
+                file_bytes = uploaded_file.getvalue()
+                set_uploaded_payload(file_bytes)
+                image = Image.open(io.BytesIO(file_bytes))
                 
                 # Convert to numpy array for processing
                 image_np = np.array(image)
                 
                 # Store the image in session state
-                st.session_state.uploaded_image = image_np
+                set_uploaded_image(image_np, file_bytes)
                 
                 # Display the image
                 st.image(image_np, caption="上传的图像", use_column_width=True)
@@ -229,8 +295,8 @@ with col1:
                     kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
                     enhanced_image = cv2.filter2D(enhanced_image, -1, kernel * 0.5)
                     
-                    # Store the enhanced image
-                    st.session_state.processed_image = enhanced_image
+                    # Store the enhanced image（增强结果只取决于原图，键由原图的键派生）
+                    set_processed_image(enhanced_image, f"{st.session_state.uploaded_image_key}:auto-enhance")
                     
                     # Display the enhanced image
                     st.image(enhanced_image, caption="自动增强后的图像", use_column_width=True)
@@ -280,7 +346,8 @@ with col1:
                             adjusted_image = np.array(pil_image)
                             
                             # Store the adjusted image
-                            st.session_state.processed_image = adjusted_image
+                            set_processed_image(adjusted_image, f"{st.session_state.uploaded_image_key}:adjust:"
+                                                                f"{brightness},{contrast},{saturation},{sharpness}")
                             
                             # Display the adjusted image
                             st.image(adjusted_image, caption="调整后的图像", use_column_width=True)
@@ -307,7 +374,7 @@ with col1:
                         resized_image = cv2.resize(current_image, (new_w, new_h))
                         
                         # Store the resized image
-                        st.session_state.processed_image = resized_image
+                        set_processed_image(resized_image)
                         
                         # Display the resized image
                         st.image(resized_image, caption=f"调整后的图像 ({new_w}x{new_h})", use_column_width=True)
@@ -319,30 +386,45 @@ with col1:
                         start_time = time.time()
                         
                         # Get the image to analyze
-                        image_to_analyze = st.session_state.processed_image if st.session_state.processed_image is not None else st.session_state.uploaded_image
+                        image_to_analyze = get_image_to_analyze()
                         
                         # Perform detection
                         prompt_universal = 1 if prompt_type_value == "universal" else None
-                        result, session_id = detect_objects(
-                            image_to_analyze,
-                            prompt_type=prompt_type_value,
-                            prompt_text=prompt_text,
-                            prompt_universal=prompt_universal,
-                            targets=["bbox"],  # 只使用边界框检测
-                            bbox_threshold=confidence_threshold
-                        )
+                        if tiled_detection:
+                            result, session_id = detect_objects_tiled(
+                                image_to_analyze,
+                                prompt_type=prompt_type_value,
+                                prompt_text=prompt_text,
+                                prompt_universal=prompt_universal,
+                                targets=["bbox"],
+                                bbox_threshold=request_threshold(confidence_threshold),
+                                tile_size=tile_size,
+                                overlap=tile_overlap
+                            )
+                        else:
+                            result, session_id = detect_objects(
+                                image_to_analyze,
+                                prompt_type=prompt_type_value,
+                                prompt_text=prompt_text,
+                                prompt_universal=prompt_universal,
+                                targets=["bbox"],  # 只使用边界框检测
+                                bbox_threshold=request_threshold(confidence_threshold)  # 以下限阈值请求，显示时在本地过滤
+                            )
                         
                         # Calculate detection time
                         detection_time = time.time() - start_time
                         
                         # Store results in session state
-                        st.session_state.detection_results = result
+                        st.session_state.detection_results = DetectionResult.from_json(result)
+                        st.session_state.request_threshold = request_threshold(confidence_threshold)
                         st.session_state.session_id = session_id
                         st.session_state.last_detection_time = detection_time
                         
                         # Show success message
-                        if "objects" in result and result["objects"]:
-                            st.success(f"成功检测到 {len(result['objects'])} 个对象！")
+                        filtered = filter_result(st.session_state.detection_results, confidence_threshold,
+                                                 iou_threshold=nms_iou_threshold)
+                        if filtered:
+                            st.success(f"成功检测到 {len(filtered)} 个对象！")
                         else:
                             st.warning("未检测到任何对象。尝试调整提示词或降低置信度阈值。")
 
@@ -353,7 +435,7 @@ with col1:
                         start_time = time.time()
                         
                         # Get the image to analyze
-                        image_to_analyze = st.session_state.processed_image if st.session_state.processed_image is not None else st.session_state.uploaded_image
+                        image_to_analyze = get_image_to_analyze()
                         
                         # 只使用边界框检测
                         bbox_targets = ["bbox"]
@@ -364,14 +446,15 @@ with col1:
                             prompt_type="universal",
                             prompt_universal=1,
                             targets=bbox_targets,  # 只使用边界框检测
-                            bbox_threshold=0.05  # 使用更低的阈值
+                            bbox_threshold=request_threshold(0.05)  # 使用更低的阈值
                         )
                         
                         # Calculate detection time
                         detection_time = time.time() - start_time
                         
                         # Store results in session state
-                        st.session_state.detection_results = result
+                        st.session_state.detection_results = DetectionResult.from_json(result)
+                        st.session_state.request_threshold = request_threshold(0.05)
                         st.session_state.session_id = session_id
                         st.session_state.last_detection_time = detection_time
                         
@@ -404,13 +487,14 @@ with col1:
                             st.error(f"获取图像失败: HTTP 状态码 {response.status_code}")
                         else:
                             # Open the image
+                            set_uploaded_payload(response.content)
                             image = Image.open(BytesIO(response.content))
                             
                             # Convert to numpy array for processing
                             image_np = np.array(image)
                             
                             # Store the image in session state
-                            st.session_state.uploaded_image = image_np
+                            set_uploaded_image(image_np, response.content)
                             
                             # Display the image
                             st.image(image_np, caption="从 URL 获取的图像", use_column_width=True)
@@ -426,8 +510,22 @@ with col2:
     st.markdown("<h2 class='sub-header'>检测结果</h2>", unsafe_allow_html=True)
     
     # 显示检测结果
-    if 'detection_results' in st.session_state and st.session_state.detection_results:
-        result = st.session_state.detection_results
+    if 'detection_results' in st.session_state and st.session_state.detection_results is not None:
+        raw_result = st.session_state.detection_results
+        
+        # 类别筛选（只在本地过滤，不重新请求）
+        available_categories = category_names(raw_result)
+        selected_categories = None
+        if len(available_categories) > 1:
+            selected_categories = st.multiselect("显示类别", available_categories, default=available_categories,
+                                                 key="result_categories")
+        
+        # 置信度阈值、类别和NMS都在本地应用于原始结果
+        result = filter_result(raw_result, confidence_threshold, categories=selected_categories,
+                               iou_threshold=nms_iou_threshold)
+        requested = st.session_state.request_threshold
+        if requested is not None and confidence_threshold < requested:
+            st.info(f"当前置信度阈值低于请求时使用的阈值 {requested:.2f}，重新分析图像可以获得更多低置信度对象")
         
         # 显示检测时间
         if 'last_detection_time' in st.session_state:
@@ -438,13 +536,15 @@ with col2:
             st.info(f"会话 ID: {st.session_state.session_id}")
         
         # 显示检测结果摘要
-        if "objects" in result and result["objects"]:
-            st.success(f"检测到 {len(result['objects'])} 个对象")
+        if result:
+            st.success(f"检测到 {len(result)} 个对象（原始结果 {len(raw_result)} 个）")
             
             # 显示检测结果可视化
             if 'uploaded_image' in st.session_state and st.session_state.uploaded_image is not None:
                 # 获取原始图像
                 original_image = st.session_state.processed_image if st.session_state.processed_image is not None else st.session_state.uploaded_image
+                image_key = (st.session_state.processed_image_key if st.session_state.processed_image is not None
+                             else st.session_state.uploaded_image_key)
                 
                 # 简化显示选项，只保留边界框和描述
                 st.markdown("<h3>显示选项</h3>", unsafe_allow_html=True)
@@ -452,9 +552,11 @@ with col2:
                 result_show_caption = st.checkbox("显示描述", value=True, key="result_show_caption")
                 
                 # 可视化检测结果，只使用边界框和描述
-                visualized_image = visualize_detection_results(
+                # 渲染结果和PNG编码按图像、结果内容和显示选项缓存，重跑时不必重新绘制和编码
+                visualized_png = render_detection_png(
                     original_image, 
-                    result["objects"],
+                    result,
+                    image_key=image_key,
                     show_bbox=result_show_bbox,
                     show_mask=False,  # 不显示掩码
                     show_pose=False,  # 不显示姿态
@@ -463,20 +565,13 @@ with col2:
                 )
                 
                 # 显示可视化结果
-                st.image(visualized_image, caption="检测结果", use_column_width=True)
+                st.image(visualized_png, caption="检测结果", use_column_width=True)
                 
                 # 添加保存按钮
                 if st.button("💾 保存结果", key="save_image", use_container_width=True):
                     try:
-                        # Convert the visualized image to PIL Image
-                        pil_image = Image.fromarray(visualized_image)
-                        
-                        # Create a BytesIO object
-                        buf = io.BytesIO()
-                        pil_image.save(buf, format="PNG")
-                        
-                        # Get the byte value
-                        byte_im = buf.getvalue()
+                        # 直接使用已编码的PNG
+                        byte_im = visualized_png
                         
                         # Create a download button
                         timestamp = time.strftime("%Y%m%d-%H%M%S")
@@ -495,14 +590,16 @@ with col2:
                 
                 # 显示检测结果详情
                 with st.expander("检测结果详情", expanded=False):
-                    summary = create_detection_summary(result["objects"])
+                    summary = create_detection_summary(result)
                     st.markdown(summary)
 
                 # 显示原始JSON结果（作为单独的expander，不嵌套）
                 with st.expander("原始JSON结果", expanded=False):
-                    st.json(result)
+                    st.json(result.to_json())
             else:
                 st.warning("无法显示检测结果可视化，因为没有上传图像")
+        elif raw_result:
+            st.warning("当前阈值和类别筛选下没有对象，尝试降低置信度阈值")
         else:
             st.warning("未检测到任何对象")
     else:
@@ -519,6 +616,9 @@ with col2:
             st.write("通用提示值:", "1 (粗力度检测万物)")
         st.write("检测目标:", targets)
         st.write("置信度阈值:", confidence_threshold)
+        st.write("NMS IoU 阈值:", nms_iou_threshold)
+        if st.session_state.request_threshold is not None:
+            st.write("请求使用的阈值:", st.session_state.request_threshold)
         
         if st.session_state.last_detection_time is not None:
             st.write("检测时间:", f"{st.session_state.last_detection_time:.2f} 秒")
@@ -526,6 +626,24 @@ with col2:
         if st.session_state.session_id:
             st.write("会话 ID:", st.session_state.session_id)
         
+        # 结果缓存命中统计
+        result_cache = get_result_cache()
+        if result_cache is not None:
+            st.write("结果缓存:", result_cache.stats())
+        render_cache = get_render_cache()
+        if render_cache is not None:
+            st.write("渲染缓存:", render_cache.stats())
+        
+        # 上传字节数统计（启用 DINOX_UPLOAD_MAX_SIDE / DINOX_UPLOAD_MAX_PIXELS 时包含缩放节省的字节数）
+        st.write("上传统计:", upload_stats.summary())
+        
+        # 各端点的限流、在途任务数和熔断器状态（进程内所有会话共享）
+        st.write("限流状态:", limiter_stats())
+        st.write("合并的重复请求:", inflight_requests.stats())
+        task_journal = get_task_journal()
+        if task_journal is not None:
+            st.write("任务日志:", task_journal.stats())
+        
         # Add a button to test API connection
         if st.button("测试 API 连接", key="test_api"):
             try:
@@ -0,0 +1,349 @@
+"""
+Pipelined batch detection
+批量检测：编码、提交、轮询作为相互重叠的流水线阶段运行，并发数有上限，结果按完成顺序返回
+"""
+import asyncio
+import contextvars
+import functools
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import dinox_api
+from dinox_api import MODEL_NAME, TaskFailedError, build_detection_payload, build_prompt
+from dinox_async import AsyncDinoXClient
+from image_payload import DEFAULT_UPLOAD_POLICY, hash_image, prepare_upload, rescale_result
+from rate_limit import get_limiter
+from result_cache import detection_cache_key, get_result_cache
+from singleflight import inflight_requests
+from task_journal import journal_call
+from timings import StageTrace, stage, trace_stages
+
+# 默认并发配置（可通过环境变量覆盖）
+DEFAULT_BATCH_CONCURRENCY = int(os.getenv("DINOX_BATCH_CONCURRENCY", "8"))
+DEFAULT_ENCODE_WORKERS = int(os.getenv("DINOX_ENCODE_WORKERS", "4"))
+# 流式接口中已完成但调用方尚未取走的结果数上限（默认等于并发数）
+DEFAULT_MAX_PENDING = int(os.getenv("DINOX_STREAM_MAX_PENDING", "0"))
+
+_DONE = object()
+
+def _prepare(image, cache, prompt, targets, bbox_threshold, iou_threshold, upload_policy):
+    """
+    Look an image up in the result cache and encode it on a miss (runs in the encode thread pool)
+    返回 (cache_key, image_hash, image_data, scale, cached)；缓存关闭时 cache_key 仍用于合并相同的在途请求
+    """
+    image_hash = hash_image(image)
+    cache_key = detection_cache_key(image, prompt, targets, bbox_threshold, iou_threshold, MODEL_NAME,
+                                    image_hash=image_hash, upload=upload_policy.cache_params())
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cache_key, image_hash, None, None, cached
+    with stage("encode"):
+        image_data, scale, _ = prepare_upload(image, upload_policy)
+    return cache_key, image_hash, image_data, scale, None
+
+async def _iterate(images):
+    # 同时支持普通可迭代对象和异步可迭代对象作为输入
+    if hasattr(images, "__aiter__"):
+        async for image in images:
+            yield image
+    elif isinstance(images, (list, tuple)):
+        for image in images:
+            yield image
+    else:
+        # 其余的可迭代对象（例如从磁盘读取图像的生成器）在线程中逐项取值，读取慢时不阻塞事件循环中的提交和轮询
+        loop = asyncio.get_running_loop()
+        iterator = iter(images)
+        while True:
+            image = await loop.run_in_executor(None, next, iterator, _DONE)
+            if image is _DONE:
+                break
+            yield image
+
+async def _pipeline(images, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold, iou_threshold,
+                    session_id, concurrency, encode_workers, client, upload_policy, max_pending):
+    """
+    Shared pipeline of adetect_objects_batch and astream_detections;
+    async generator of (index, result, session_id, trace) in completion order
+    """
+    concurrency = concurrency or DEFAULT_BATCH_CONCURRENCY
+    encode_workers = encode_workers or DEFAULT_ENCODE_WORKERS
+    own_client = client is None
+    client = client or AsyncDinoXClient(pool_size=max(concurrency, 1) * 2)
+
+    loop = asyncio.get_running_loop()
+    cache = get_result_cache()
+    prompt = build_prompt(prompt_type, prompt_text, prompt_universal)
+    upload_policy = upload_policy or DEFAULT_UPLOAD_POLICY
+    journal_params = {"prompt": prompt, "targets": targets, "bbox_threshold": bbox_threshold,
+                      "iou_threshold": iou_threshold, "upload": upload_policy.cache_params()}
+    executor = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix="dinox-encode")
+    encode_slots = asyncio.Semaphore(encode_workers)
+    api_slots = asyncio.Semaphore(concurrency)
+    encoded = asyncio.Queue(maxsize=concurrency)
+    # 有界：调用方处理不过来时，完成的任务在放入结果队列前一直占用并发名额，上游的编码和输入读取随之暂停
+    results = asyncio.Queue(maxsize=max_pending or concurrency)
+    encoders = set()
+    workers = set()
+    failures = []
+
+    async def encode_one(index, image):
+        trace = StageTrace()
+        try:
+            try:
+                # 在带有本图像 trace 的上下文中运行编码，编码耗时计入该图像
+                with trace_stages(trace):
+                    context = contextvars.copy_context()
+                prepared = await loop.run_in_executor(executor, functools.partial(
+                    context.run, _prepare, image, cache, prompt, targets, bbox_threshold, iou_threshold,
+                    upload_policy
+                ))
+            except Exception as e:
+                prepared = (None, None, e, None, None)
+            await encoded.put((index, trace, prepared))
+        finally:
+            encode_slots.release()
+
+    async def produce():
+        # 阶段1: 按需读取输入并编码（有界预取，内存占用与输入总量无关）
+        try:
+            index = 0
+            async for image in _iterate(images):
+                await encode_slots.acquire()
+                task = asyncio.ensure_future(encode_one(index, image))
+                index += 1
+                encoders.add(task)
+                task.add_done_callback(encoders.discard)
+            if encoders:
+                await asyncio.gather(*list(encoders))
+        except Exception as e:
+            # 输入迭代器出错：先让已提交的任务完成，再向调用方抛出
+            failures.append(e)
+        await encoded.put(_DONE)
+
+    async def submit_and_wait(cache_key, image_hash, image_data, scale):
+        payload = build_detection_payload(
+            image_data, prompt_type, prompt_text, prompt_universal,
+            targets, bbox_threshold, iou_threshold, session_id
+        )
+        # 在途任务数同时受进程级的检测端点限额约束（与同步调用共享）
+        async with get_limiter("detection").async_task_slot():
+            task_uuid = await client.submit_payload(dinox_api.DETECTION_API_URL, payload, "detection")
+            # 记录到任务日志：进程在轮询期间重启时可以恢复这个任务，而不必重新提交
+            await loop.run_in_executor(executor, journal_call, "record_submitted", task_uuid, "detection",
+                                       cache_key, image_hash, journal_params, scale)
+            try:
+                result, new_session_id = await client.get_task_result(task_uuid)
+            except TaskFailedError as e:
+                await loop.run_in_executor(executor, journal_call, "finish", task_uuid, "failed", str(e))
+                raise
+        rescale_result(result, scale)
+        if cache is not None:
+            await loop.run_in_executor(executor, cache.put, cache_key, result, new_session_id)
+        await loop.run_in_executor(executor, journal_call, "finish", task_uuid)
+        return result, new_session_id
+
+    async def run_task(index, trace, cache_key, image_hash, image_data, scale):
+        # 阶段2+3: 提交任务并轮询结果；批次内外相同的在途请求只提交一次
+        try:
+            try:
+                if isinstance(image_data, Exception):
+                    raise image_data
+                with trace_stages(trace):
+                    result, new_session_id = await inflight_requests.do_async(
+                        cache_key, submit_and_wait, cache_key, image_hash, image_data, scale
+                    )
+            except Exception as e:
+                result, new_session_id = {"objects": [], "error": str(e)}, session_id
+            await results.put((index, result, new_session_id, trace))
+        finally:
+            api_slots.release()
+
+    async def dispatch():
+        try:
+            while True:
+                item = await encoded.get()
+                if item is _DONE:
+                    break
+                index, trace, (cache_key, image_hash, image_data, scale, cached) = item
+                if cached is not None:
+                    await results.put((index,) + tuple(cached) + (trace,))
+                    continue
+                await api_slots.acquire()
+                task = asyncio.ensure_future(run_task(index, trace, cache_key, image_hash, image_data, scale))
+                workers.add(task)
+                task.add_done_callback(workers.discard)
+            if workers:
+                await asyncio.gather(*list(workers))
+        except asyncio.CancelledError:
+            # 调用方已经停止迭代，不再需要结束标记（结果队列可能已满）
+            raise
+        except Exception as e:
+            failures.append(e)
+        await results.put(_DONE)
+
+    producer = asyncio.ensure_future(produce())
+    dispatcher = asyncio.ensure_future(dispatch())
+    try:
+        while True:
+            item = await results.get()
+            if item is _DONE:
+                break
+            yield item
+        if failures:
+            raise failures[0]
+    finally:
+        tasks = [producer, dispatcher] + list(encoders) + list(workers)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=False)
+        if own_client:
+            await client.close()
+
+async def adetect_objects_batch(images, prompt_type="text", prompt_text=None, prompt_universal=None,
+                                targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8,
+                                session_id=None, concurrency=None, encode_workers=None, client=None,
+                                upload_policy=None):
+    """
+    Detect objects in many images; async generator of (index, result, session_id) in completion order
+
+    - 编码阶段在线程池中运行，最多预取 `concurrency` 张已编码图像
+    - 提交+轮询阶段最多同时有 `concurrency` 个任务在途；进程内所有检测任务另外受 rate_limit 的
+      在途任务数上限（DINOX_MAX_TASKS，默认16）约束，设置 DINOX_RATE_LIMIT 时创建任务还按该速率（次/秒）限流
+    - 失败的图像返回 {"objects": [], "error": "..."}，不会中断整个批次
+    - 命中结果缓存的图像不占用API并发名额，直接返回
+    - 与其他在途请求（包括同一批次内的重复图像）相同的请求共享同一个任务
+    - upload_policy 与 detect_objects 相同：超限图像缩小后上传，结果坐标映射回原图
+    - images 可以是普通或异步可迭代对象，按需读取
+    """
+    results = _pipeline(images, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold,
+                        iou_threshold, session_id, concurrency, encode_workers, client, upload_policy, None)
+    try:
+        async for index, result, new_session_id, _ in results:
+            yield index, result, new_session_id
+    finally:
+        await results.aclose()
+
+async def astream_detections(inputs, prompt_type="text", prompt_text=None, prompt_universal=None,
+                             targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                             concurrency=None, encode_workers=None, max_pending=None, client=None,
+                             upload_policy=None):
+    """
+    Stream detections as they complete; async generator of (input_id, result, timings)
+
+    Args:
+        inputs: (input_id, image) 对的可迭代对象或异步可迭代对象，可以是无限的流
+        max_pending: 已完成但尚未被取走的结果数上限（默认等于 concurrency）
+
+    timings 为 {"stages": {阶段名: 秒}, "total": 秒}，total 从开始编码到结果完成。
+    内存占用有上界：调用方处理较慢时，流水线依次暂停取结果、提交、编码和读取输入。
+    """
+    ids = {}
+
+    async def images():
+        index = 0
+        async for input_id, image in _iterate(inputs):
+            ids[index] = input_id
+            index += 1
+            yield image
+
+    results = _pipeline(images(), prompt_type, prompt_text, prompt_universal, targets, bbox_threshold,
+                        iou_threshold, session_id, concurrency, encode_workers, client, upload_policy,
+                        max_pending or DEFAULT_MAX_PENDING)
+    try:
+        async for index, result, _, trace in results:
+            yield ids.pop(index), result, {"stages": trace.as_dict(), "total": trace.elapsed}
+    finally:
+        await results.aclose()
+
+def _iterate_in_thread(make_agen, max_pending):
+    """
+    Run an async generator in a background event loop and yield its items synchronously
+
+    调用方每取走一个结果归还一个名额，后台最多领先 max_pending 个结果；
+    提前停止迭代会取消所有未完成的任务。
+    """
+    items = queue.Queue()
+    state = {}
+
+    async def main():
+        state["task"] = asyncio.current_task()
+        credits = state["credits"] = asyncio.Semaphore(max_pending)
+        agen = make_agen()
+        try:
+            async for item in agen:
+                await credits.acquire()
+                items.put(item)
+        finally:
+            await agen.aclose()
+
+    def runner():
+        loop = asyncio.new_event_loop()
+        state["loop"] = loop
+        try:
+            loop.run_until_complete(main())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            items.put(e)
+        finally:
+            loop.close()
+            items.put(_DONE)
+
+    thread = threading.Thread(target=runner, name="dinox-batch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            loop, credits = state["loop"], state["credits"]
+            try:
+                loop.call_soon_threadsafe(credits.release)
+            except RuntimeError:
+                pass
+            yield item
+    finally:
+        loop = state.get("loop")
+        task = state.get("task")
+        if thread.is_alive() and loop is not None and task is not None:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+
+def detect_objects_batch(images, prompt_type="text", prompt_text=None, prompt_universal=None,
+                         targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8,
+                         session_id=None, concurrency=None, encode_workers=None, upload_policy=None):
+    """
+    Synchronous generator over adetect_objects_batch; yields (index, result, session_id) as tasks complete
+
+    事件循环运行在后台线程中，调用方（例如Streamlit脚本）无需使用asyncio。
+    提前停止迭代会取消所有未完成的任务。
+    """
+    return _iterate_in_thread(lambda: adetect_objects_batch(
+        images, prompt_type, prompt_text, prompt_universal, targets,
+        bbox_threshold, iou_threshold, session_id, concurrency, encode_workers,
+        upload_policy=upload_policy
+    ), concurrency or DEFAULT_BATCH_CONCURRENCY)
+
+def stream_detections(inputs, prompt_type="text", prompt_text=None, prompt_universal=None,
+                      targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                      concurrency=None, encode_workers=None, max_pending=None, upload_policy=None):
+    """
+    Synchronous generator over astream_detections; yields (input_id, result, timings) as tasks complete
+
+    下游的导出或渲染可以在其余任务仍在途时处理已完成的结果；
+    inputs 在后台线程中按需读取，可以是无限的生成器
+    """
+    max_pending = max_pending or DEFAULT_MAX_PENDING or concurrency or DEFAULT_BATCH_CONCURRENCY
+    return _iterate_in_thread(lambda: astream_detections(
+        inputs, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold, iou_threshold,
+        session_id, concurrency, encode_workers, max_pending, upload_policy=upload_policy
+    ), max_pending)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Command-line batch detection
+命令行批量检测：读取目录、glob 或清单文件中的图像，通过批量检测流水线并发处理，结果逐条写入 JSONL（或最终生成 Parquet）。
+输出文件本身就是检查点：中断后使用相同的命令重新运行，已完成的图像不会再次提交。
+
+用法:
+    python batch_cli.py images/ --output results.jsonl --prompt person.car
+    python batch_cli.py "scans/**/*.jpg" --output results.parquet --concurrency 16 --encode-workers 8
+    python batch_cli.py --manifest list.csv --output results.jsonl --targets bbox,mask
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from batch import DEFAULT_BATCH_CONCURRENCY, DEFAULT_ENCODE_WORKERS, detect_objects_batch
+from dinox_api import set_api_base
+from dinox_logging import configure_logging, get_logger
+from image_payload import EncodedImage, sniff_mime
+from task_journal import recover_pending_tasks
+
+logger = get_logger("batch_cli")
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+# Parquet 输出时结果先逐条写入这个 JSONL 检查点，每次运行结束后再转换为 Parquet
+CHECKPOINT_SUFFIX = ".checkpoint.jsonl"
+PARQUET_ROW_GROUP = 1000
+
+def _is_image(path, extensions):
+    return os.path.splitext(path)[1].lower() in extensions
+
+def read_manifest(path):
+    """
+    (id, path) pairs from a manifest: .txt (one path per line), .csv or .jsonl (columns "path" and optional "id")
+
+    相对路径相对于清单文件所在目录
+    """
+    base = os.path.dirname(os.path.abspath(path))
+    ext = os.path.splitext(path)[1].lower()
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        if ext == ".csv":
+            rows = list(csv.DictReader(f))
+        elif ext in (".jsonl", ".json"):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = [{"path": line.strip()} for line in f if line.strip() and not line.lstrip().startswith("#")]
+    for row in rows:
+        image_path = row.get("path")
+        if not image_path:
+            continue
+        entries.append((str(row.get("id") or image_path), os.path.join(base, image_path)))
+    return entries
+
+def collect_inputs(inputs, manifest=None, recursive=False, extensions=IMAGE_EXTENSIONS):
+    """
+    (id, path) pairs from directories, glob patterns, files and an optional manifest, without duplicates
+
+    目录中的图像以相对于该目录的路径作为 id，其余输入以给定的路径作为 id
+    """
+    entries = []
+    for item in inputs:
+        if os.path.isdir(item):
+            pattern = os.path.join(item, "**", "*") if recursive else os.path.join(item, "*")
+            for path in sorted(glob.glob(pattern, recursive=recursive)):
+                if os.path.isfile(path) and _is_image(path, extensions):
+                    entries.append((os.path.relpath(path, item), path))
+        elif os.path.isfile(item):
+            entries.append((item, item))
+        else:
+            matches = sorted(p for p in glob.glob(item, recursive=True) if os.path.isfile(p) and _is_image(p, extensions))
+            if not matches:
+                logger.warning("No images match %s", item)
+            entries.extend((path, path) for path in matches)
+    if manifest:
+        entries.extend(read_manifest(manifest))
+    seen, unique = set(), []
+    for image_id, path in entries:
+        if image_id not in seen:
+            seen.add(image_id)
+            unique.append((image_id, path))
+    return unique
+
+def load_image(path):
+    """JPEG/PNG files are uploaded as-is; other formats are decoded (and re-encoded by the pipeline)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if sniff_mime(data):
+        return EncodedImage(data)
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+def prefetch(paths, workers, depth):
+    """
+    Load images in a thread pool, at most `depth` ahead of the consumer, in input order
+
+    读取失败的图像以异常对象代替，由调用方记录为错误
+    """
+    def load(path):
+        try:
+            return load_image(path)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dinox-read") as executor:
+        pending = deque()
+        for path in paths:
+            pending.append(executor.submit(load, path))
+            if len(pending) >= depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def read_checkpoint(path, retry_errors=False):
+    """
+    Ids already written to a JSONL output; a truncated last line (interrupted write) is cut off
+
+    retry_errors 为 True 时，最后一条记录是错误的图像不算完成（重新处理后追加的记录覆盖之前的记录）
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    valid_size = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            if retry_errors and record.get("error"):
+                done.discard(record["id"])
+            else:
+                done.add(record["id"])
+            valid_size += len(line)
+    if valid_size != os.path.getsize(path):
+        logger.warning("Discarding an incomplete record at the end of %s", path)
+        with open(path, "r+b") as f:
+            f.truncate(valid_size)
+    return done
+
+def write_parquet(jsonl_path, parquet_path, row_group=PARQUET_ROW_GROUP):
+    """
+    Convert the JSONL checkpoint to Parquet in row groups (objects are stored as a JSON string column)
+
+    同一 id 有多条记录时（--retry-errors 重新处理过）只保留最后一条
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("Parquet output requires pyarrow (pip install pyarrow); results are kept in " + jsonl_path)
+
+    schema = pa.schema([
+        ("id", pa.string()), ("path", pa.string()), ("num_objects", pa.int32()),
+        ("objects", pa.string()), ("session_id", pa.string()), ("error", pa.string()),
+    ])
+
+    def to_table(records):
+        return pa.Table.from_pydict({
+            "id": [r["id"] for r in records],
+            "path": [r.get("path") for r in records],
+            "num_objects": [len(r.get("objects") or []) for r in records],
+            "objects": [json.dumps(r.get("objects") or [], ensure_ascii=False) for r in records],
+            "session_id": [r.get("session_id") for r in records],
+            "error": [r.get("error") for r in records],
+        }, schema=schema)
+
+    last_line = {}
+    with open(jsonl_path, encoding="utf-8") as f:
+        for number, line in enumerate(f):
+            last_line[json.loads(line)["id"]] = number
+
+    tmp_path = parquet_path + ".tmp"
+    with pq.ParquetWriter(tmp_path, schema) as writer, open(jsonl_path, encoding="utf-8") as f:
+        records = []
+        for number, line in enumerate(f):
+            record = json.loads(line)
+            if last_line[record["id"]] != number:
+                continue
+            records.append(record)
+            if len(records) >= row_group:
+                writer.write_table(to_table(records))
+                records = []
+        if records:
+            writer.write_table(to_table(records))
+    os.replace(tmp_path, parquet_path)
+
+def run(entries, output, params, concurrency, encode_workers, read_workers, resume=True, retry_errors=False,
+        progress_every=50):
+    """
+    Detect every entry not yet in the checkpoint and append the results; returns a summary dict
+    """
+    # 先同步恢复上次中断时仍在进行的任务：结果写入结果缓存，下面重新提交的相同图像直接命中缓存
+    try:
+        recovery = recover_pending_tasks()
+    except Exception:
+        logger.exception("Task recovery failed")
+    else:
+        if recovery["recovered"] or recovery["failed"]:
+            print(f"恢复了 {recovery['recovered']} 个未完成的任务（失败 {recovery['failed']} 个）")
+
+    parquet = output.lower().endswith(".parquet")
+    checkpoint = output + CHECKPOINT_SUFFIX if parquet else output
+    if not resume and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    done = read_checkpoint(checkpoint, retry_errors)
+    pending = [(image_id, path) for image_id, path in entries if image_id not in done]
+    summary = {"total": len(entries), "skipped": len(entries) - len(pending), "processed": 0, "errors": 0,
+               "objects": 0}
+    print(f"{len(entries)} 张图像，{summary['skipped']} 张已完成，待处理 {len(pending)} 张")
+
+    start = time.perf_counter()
+    # 流水线中第 i 张图像在 pending 中的位置；读取失败的图像不进入流水线，直接记为错误
+    submitted = []
+    unreadable = deque()
+
+    def images():
+        for position, image in enumerate(prefetch([path for _, path in pending], read_workers,
+                                                 max(concurrency, read_workers) * 2)):
+            if isinstance(image, Exception):
+                unreadable.append((position, image))
+                continue
+            submitted.append(position)
+            yield image
+
+    def write(out, position, objects, session_id=None, error=None):
+        image_id, path = pending[position]
+        record = {"id": image_id, "path": path, "objects": objects, "session_id": session_id}
+        if error:
+            record["error"] = error
+            summary["errors"] += 1
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+        summary["processed"] += 1
+        summary["objects"] += len(objects)
+        if progress_every and summary["processed"] % progress_every == 0:
+            elapsed = time.perf_counter() - start
+            print(f"  {summary['processed']}/{len(pending)}  {summary['processed'] / elapsed:.2f} 张/秒  "
+                  f"错误 {summary['errors']}")
+
+    def write_unreadable(out):
+        while unreadable:
+            position, error = unreadable.popleft()
+            write(out, position, [], error=f"Could not read image: {error}")
+
+    with open(checkpoint, "a", encoding="utf-8") as out:
+        for index, result, session_id in detect_objects_batch(
+                images(), params["prompt_type"], params["prompt_text"], params["prompt_universal"],
+                params["targets"], params["bbox_threshold"], params["iou_threshold"],
+                concurrency=concurrency, encode_workers=encode_workers):
+            write_unreadable(out)
+            write(out, submitted[index], result.get("objects") or [], session_id, result.get("error"))
+        write_unreadable(out)
+
+    summary["elapsed"] = time.perf_counter() - start
+    if parquet:
+        write_parquet(checkpoint, output)
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="DINO-X batch detection")
+    parser.add_argument("inputs", nargs="*", help="图像目录、文件或glob模式")
+    parser.add_argument("--manifest", default=None, help="清单文件（.txt 每行一个路径，或包含 path/id 列的 .csv/.jsonl）")
+    parser.add_argument("--recursive", action="store_true", help="递归读取子目录")
+    parser.add_argument("--output", required=True, help="结果文件（.jsonl 或 .parquet）")
+    parser.add_argument("--no-resume", action="store_true", help="忽略已有结果，重新处理所有图像")
+    parser.add_argument("--retry-errors", action="store_true", help="重新处理上次运行中出错的图像")
+    parser.add_argument("--prompt", default="person.car.dog", help="文本提示（用点号分隔）")
+    parser.add_argument("--universal", action="store_true", help="使用通用提示检测所有物体")
+    parser.add_argument("--targets", default="bbox", help="检测目标，例如 bbox,mask")
+    parser.add_argument("--bbox-threshold", type=float, default=0.25)
+    parser.add_argument("--iou-threshold", type=float, default=0.8)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="同时在途的API任务数")
+    parser.add_argument("--encode-workers", type=int, default=DEFAULT_ENCODE_WORKERS, help="编码线程数")
+    parser.add_argument("--read-workers", type=int, default=4, help="读取/解码图像文件的线程数")
+    parser.add_argument("--limit", type=int, default=None, help="最多处理的图像数")
+    parser.add_argument("--base-url", default=None, help="API地址（默认使用 DINOX_API_BASE）")
+    parser.add_argument("--log-level", default=None)
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    if args.base_url:
+        set_api_base(args.base_url)
+    if not args.inputs and not args.manifest:
+        parser.error("至少需要一个输入目录、文件、glob模式或 --manifest")
+
+    entries = collect_inputs(args.inputs, args.manifest, args.recursive)
+    if args.limit is not None:
+        entries = entries[:args.limit]
+    if not entries:
+        raise SystemExit("没有找到图像")
+
+    params = {
+        "prompt_type": "universal" if args.universal else "text",
+        "prompt_text": None if args.universal else args.prompt,
+        "prompt_universal": 1 if args.universal else None,
+        "targets": [t.strip() for t in args.targets.split(",") if t.strip()],
+        "bbox_threshold": args.bbox_threshold,
+        "iou_threshold": args.iou_threshold,
+    }
+    try:
+        summary = run(entries, args.output, params, args.concurrency, args.encode_workers, args.read_workers,
+                      resume=not args.no_resume, retry_errors=args.retry_errors)
+    except KeyboardInterrupt:
+        print("\n已中断；已完成的结果保留在输出文件中，重新运行相同的命令即可继续")
+        sys.exit(130)
+    print(f"完成: 处理 {summary['processed']} 张，跳过 {summary['skipped']} 张，错误 {summary['errors']} 张，"
+          f"检测到 {summary['objects']} 个对象，耗时 {summary['elapsed']:.1f} 秒")
+    print(f"结果已写入 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+End-to-end latency benchmark for the DINO-X client
+端到端基准测试：逐阶段的延迟分解（解码、编码、上传、排队等待、轮询、JSON解析、可视化）、
+p50/p95/p99，以及不同并发度下 detect_objects 和批量检测的吞吐量；结果写入JSON文件便于对比不同版本
+
+用法:
+    python benchmark.py --mock --requests 40 --concurrency 1,4,16
+    python benchmark.py --base-url http://127.0.0.1:8600 --targets bbox,mask --output bench.json
+"""
+import argparse
+import datetime
+import glob
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import dinox_api
+import result_cache
+from batch import detect_objects_batch
+from dinox_api import DinoXClient, detect_objects, set_api_base
+from image_payload import EncodedImage
+from mock_server import MockConfig, MockDinoXServer
+from polling import poll_stats
+from rate_limit import limiter_stats
+from timings import STAGES, stage, summarize, trace_stages
+from visualization import visualize_detection_results
+
+def synthetic_images(count, width, height, seed=0):
+    """Distinct JPEG images (smooth gradients plus noise, so they compress like photos)"""
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    images = []
+    for _ in range(count):
+        fx, fy, phase = rng.uniform(0.002, 0.02, 2).tolist() + [rng.uniform(0, 6.28)]
+        base = 127 + 80 * np.sin(xx * fx + phase)[..., None] * np.cos(yy * fy)[..., None] * rng.uniform(0.5, 1, 3)
+        pixels = np.clip(base + rng.normal(0, 12, (height, width, 3)), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format="JPEG", quality=90)
+        images.append(EncodedImage(buffer.getvalue()))
+    return images
+
+def load_images(pattern, limit):
+    paths = sorted(glob.glob(pattern))[:limit]
+    if not paths:
+        raise SystemExit(f"No images match {pattern}")
+    return [EncodedImage.from_file(path) for path in paths]
+
+def run_traced_request(image, client, targets, prompt_text):
+    """
+    One detect_objects call with a full stage trace (same path as the app: decode for display,
+    upload the original bytes, draw the results)
+    """
+    with trace_stages() as trace:
+        with stage("decode"):
+            pixels = image.to_array()
+        result, _ = detect_objects(image, prompt_text=prompt_text, targets=targets, client=client)
+        objects = result.get("objects") or []
+        with stage("visualization"):
+            visualize_detection_results(pixels, objects)
+        total = trace.elapsed
+    return {"total": total, "stages": trace.as_dict(), "objects": len(objects)}
+
+def stage_breakdown(samples):
+    report = {}
+    for name in STAGES:
+        report[name] = summarize([s["stages"].get(name, 0.0) for s in samples])
+    report["other"] = summarize([max(0.0, s["total"] - sum(s["stages"].values())) for s in samples])
+    report["total"] = summarize([s["total"] for s in samples])
+    return report
+
+def bench_sequential(images, targets, prompt_text):
+    # 显式传入客户端：轮询在调用线程中进行，排队等待和轮询时间计入同一个 trace
+    client = DinoXClient()
+    try:
+        samples = [run_traced_request(image, client, targets, prompt_text) for image in images]
+    finally:
+        client.close()
+    return {
+        "requests": len(samples),
+        "empty_results": sum(1 for s in samples if not s["objects"]),
+        "stages": stage_breakdown(samples),
+    }
+
+def bench_concurrent(images, concurrency, targets, prompt_text):
+    """detect_objects from `concurrency` threads through the default client and shared poller"""
+    def timed(image):
+        start = time.perf_counter()
+        result, _ = detect_objects(image, prompt_text=prompt_text, targets=targets)
+        return time.perf_counter() - start, len(result.get("objects") or [])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, images))
+    makespan = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(outcomes),
+        "empty_results": sum(1 for _, objects in outcomes if not objects),
+        "makespan": makespan,
+        "throughput": len(outcomes) / makespan if makespan else None,
+        "latency": summarize([latency for latency, _ in outcomes]),
+    }
+
+def bench_batch(images, concurrency, targets, prompt_text):
+    """detect_objects_batch with a given in-flight limit; completion times are relative to the batch start"""
+    start = time.perf_counter()
+    completions, errors = [], 0
+    for _, result, _ in detect_objects_batch(images, prompt_text=prompt_text, targets=targets,
+                                             concurrency=concurrency):
+        completions.append(time.perf_counter() - start)
+        errors += 1 if result.get("error") else 0
+    makespan = time.perf_counter() - start
+    return {
+        "concurrency": concurrency,
+        "requests": len(completions),
+        "errors": errors,
+        "makespan": makespan,
+        "throughput": len(completions) / makespan if makespan else None,
+        "completion": summarize(completions),
+    }
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _ms(value):
+    return "-" if value is None else f"{value * 1000:.1f}"
+
+def print_report(report):
+    sequential = report.get("sequential")
+    if sequential:
+        print(f"\n逐阶段延迟 (ms, {sequential['requests']} 个顺序请求)")
+        print(f"{'stage':<14}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+        for name, s in sequential["stages"].items():
+            print(f"{name:<14}{_ms(s['p50']):>10}{_ms(s['p95']):>10}{_ms(s['p99']):>10}{_ms(s['mean']):>10}")
+    for key, title in (("concurrent", "detect_objects 并发"), ("batch", "批量检测")):
+        rows = report.get(key) or []
+        if not rows:
+            continue
+        latency_key = "latency" if key == "concurrent" else "completion"
+        print(f"\n{title}")
+        print(f"{'concurrency':<14}{'req/s':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for row in rows:
+            s = row[latency_key]
+            print(f"{row['concurrency']:<14}{row['throughput']:>10.2f}{_ms(s['p50']):>10}"
+                  f"{_ms(s['p95']):>10}{_ms(s['p99']):>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="DINO-X client latency benchmark")
+    parser.add_argument("--base-url", default=None, help="API地址（默认使用 DINOX_API_BASE）")
+    parser.add_argument("--mock", action="store_true", help="在进程内启动 mock_server 并对其测试")
+    parser.add_argument("--mock-queue-delay", default="uniform:0.1,0.3")
+    parser.add_argument("--mock-processing", default="lognormal:-0.7,0.4")
+    parser.add_argument("--mock-capacity", type=int, default=0)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--images", default=None, help="测试图像的glob模式（默认生成合成图像）")
+    parser.add_argument("--image-size", default="1280x720", help="合成图像尺寸 WxH")
+    parser.add_argument("--requests", type=int, default=20, help="每轮测试的请求数")
+    parser.add_argument("--concurrency", default="1,4,8,16", help="并发度列表")
+    parser.add_argument("--workloads", default="sequential,concurrent,batch")
+    parser.add_argument("--targets", default="bbox", help="检测目标，例如 bbox,mask")
+    parser.add_argument("--prompt", default="person.car.dog")
+    parser.add_argument("--use-cache", action="store_true", help="保留结果缓存（默认关闭以测量真实请求）")
+    parser.add_argument("--no-client-limits", action="store_true", help="关闭客户端限流和在途任务上限")
+    parser.add_argument("--label", default=None, help="写入结果文件的标签（例如版本名）")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    if args.no_client_limits:
+        # 限流器在第一次使用时按环境变量创建
+        os.environ["DINOX_RATE_LIMIT"] = "0"
+        os.environ["DINOX_MAX_TASKS"] = "0"
+    if not args.use_cache:
+        result_cache.CACHE_ENABLED = False
+
+    server = None
+    if args.mock:
+        server = MockDinoXServer(MockConfig(
+            queue_delay=args.mock_queue_delay, processing=args.mock_processing, capacity=args.mock_capacity,
+            error_rate=args.mock_error_rate, throttle_rate=args.mock_throttle_rate, seed=0,
+        )).start()
+        set_api_base(server.base_url)
+        os.environ.setdefault("DINOX_API_TOKEN", "mock")
+    elif args.base_url:
+        set_api_base(args.base_url)
+
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    workloads = {w.strip() for w in args.workloads.split(",")}
+    if args.images:
+        images = load_images(args.images, args.requests)
+    else:
+        width, height = (int(v) for v in args.image_size.lower().split("x"))
+        images = synthetic_images(args.requests, width, height)
+
+    print(f"Benchmarking {dinox_api.API_BASE} with {len(images)} images, targets={targets}")
+    report = {
+        "meta": {
+            "label": args.label,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "git_commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "api_base": dinox_api.API_BASE,
+            "mock": args.mock,
+            "args": vars(args),
+        },
+    }
+    try:
+        if "sequential" in workloads:
+            report["sequential"] = bench_sequential(images, targets, args.prompt)
+        if "concurrent" in workloads:
+            report["concurrent"] = [bench_concurrent(images, c, targets, args.prompt) for c in levels]
+        if "batch" in workloads:
+            report["batch"] = [bench_batch(images, c, targets, args.prompt) for c in levels]
+        report["poll_stats"] = poll_stats.summary()
+        report["limiter"] = limiter_stats()
+        if server is not None:
+            report["mock_stats"] = server.stats()
+    finally:
+        if server is not None:
+            server.stop()
+
+    print_report(report)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\n结果已写入 {args.output}")
+
+if __name__ == "__main__":
+    main()
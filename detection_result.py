@@ -0,0 +1,251 @@
+"""
+Columnar detection results
+检测结果的列式表示：边界框 (N, 4) float32、置信度和类别编号数组、去重的类别表；
+掩码和关键点保留原始数据，第一次使用时才解码。可以与API返回的JSON互相转换。
+"""
+import sys
+
+import numpy as np
+
+# 按列存储的字段，其余字段原样保存在 extras 中
+_COLUMN_FIELDS = ("category", "score", "bbox", "mask", "pose_keypoints", "hand_keypoints", "caption")
+
+def parse_keypoints(keypoints):
+    """
+    Keypoints in any of the API formats as a (K, 4) float32 array of [x, y, visible, score]
+
+    支持扁平列表 [x1, y1, v1, s1, ...]、嵌套列表 [[x, y, v, s], ...] 和字典列表 [{"x", "y", "visible", "score"}, ...]
+    """
+    if keypoints is None or len(keypoints) == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    if isinstance(keypoints, np.ndarray):
+        return keypoints.astype(np.float32, copy=False).reshape(-1, 4)
+    first = keypoints[0]
+    if isinstance(first, dict):
+        rows = [[kp.get("x", 0), kp.get("y", 0), kp.get("visible", 0), kp.get("score", 0)] for kp in keypoints]
+        return np.asarray(rows, dtype=np.float32).reshape(-1, 4)
+    if isinstance(first, (list, tuple)):
+        return np.asarray([list(kp)[:4] for kp in keypoints], dtype=np.float32).reshape(-1, 4)
+    flat = np.asarray(keypoints, dtype=np.float32)
+    return flat[:len(flat) // 4 * 4].reshape(-1, 4)
+
+def _shortest_floats(values):
+    # float32 -> 最短的十进制表示，避免转回JSON时出现 123.45600128173828 这样的值
+    return [float(str(v)) for v in values]
+
+class DetectionResult:
+    """
+    Detection result stored as arrays instead of a list of object dicts
+
+    Attributes:
+        boxes: (N, 4) float32 的 [x1, y1, x2, y2]；没有边界框的对象为 0，has_box 为 False
+        scores: (N,) float32，没有置信度的对象为 NaN
+        category_ids: (N,) int32，指向 categories；没有类别的对象为 -1
+        categories: 类别名表（字符串已 intern）
+        masks / pose_keypoints / hand_keypoints / captions: 每个对象的原始数据（或 None）
+        extras: 其他字段（没有时为 None）
+        meta: 结果字典中 "objects" 以外的键
+    """
+    __slots__ = ("boxes", "has_box", "scores", "category_ids", "categories", "masks", "pose_keypoints",
+                 "hand_keypoints", "captions", "extras", "meta", "_mask_cache", "_keypoint_cache")
+
+    def __init__(self, boxes=None, scores=None, category_ids=None, categories=(), has_box=None, masks=None,
+                 pose_keypoints=None, hand_keypoints=None, captions=None, extras=None, meta=None):
+        self.boxes = np.zeros((0, 4), dtype=np.float32) if boxes is None else \
+            np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        count = len(self.boxes)
+        self.has_box = np.ones(count, dtype=bool) if has_box is None else np.asarray(has_box, dtype=bool)
+        self.scores = np.full(count, np.nan, dtype=np.float32) if scores is None else \
+            np.asarray(scores, dtype=np.float32)
+        self.category_ids = np.full(count, -1, dtype=np.int32) if category_ids is None else \
+            np.asarray(category_ids, dtype=np.int32)
+        self.categories = tuple(categories)
+        self.masks = masks if masks is not None else [None] * count
+        self.pose_keypoints = pose_keypoints if pose_keypoints is not None else [None] * count
+        self.hand_keypoints = hand_keypoints if hand_keypoints is not None else [None] * count
+        self.captions = captions if captions is not None else [None] * count
+        self.extras = extras
+        self.meta = meta or {}
+        self._mask_cache = {}
+        self._keypoint_cache = {}
+
+    # ---- conversions ----
+
+    @classmethod
+    def from_objects(cls, objects, meta=None):
+        """Build from the API's list of object dicts"""
+        objects = objects or []
+        count = len(objects)
+        boxes = np.zeros((count, 4), dtype=np.float32)
+        has_box = np.zeros(count, dtype=bool)
+        scores = np.full(count, np.nan, dtype=np.float32)
+        category_ids = np.full(count, -1, dtype=np.int32)
+        table, categories = {}, []
+        masks, pose, hand, captions, extras = [], [], [], [], []
+        has_extras = False
+        for i, obj in enumerate(objects):
+            bbox = obj.get("bbox")
+            if bbox is not None and len(bbox) == 4:
+                boxes[i] = bbox
+                has_box[i] = True
+            score = obj.get("score")
+            if score is not None:
+                scores[i] = score
+            category = obj.get("category")
+            if category is not None:
+                category = str(category)
+                cid = table.get(category)
+                if cid is None:
+                    cid = table[category] = len(categories)
+                    categories.append(sys.intern(category))
+                category_ids[i] = cid
+            masks.append(obj.get("mask") or None)
+            pose.append(obj.get("pose_keypoints") or None)
+            hand.append(obj.get("hand_keypoints") or None)
+            captions.append(obj.get("caption"))
+            extra = {k: v for k, v in obj.items() if k not in _COLUMN_FIELDS}
+            has_extras = has_extras or bool(extra)
+            extras.append(extra or None)
+        return cls(boxes, scores, category_ids, categories, has_box, masks, pose, hand, captions,
+                   extras if has_extras else None, meta)
+
+    @classmethod
+    def from_json(cls, result):
+        """Build from a raw API result dict ({"objects": [...], ...})"""
+        result = result or {}
+        meta = {k: v for k, v in result.items() if k != "objects"}
+        return cls.from_objects(result.get("objects") or [], meta)
+
+    def to_objects(self):
+        """The list of object dicts in the API's format"""
+        boxes = [_shortest_floats(row) for row in self.boxes]
+        scores = _shortest_floats(self.scores)
+        objects = []
+        for i in range(len(self)):
+            obj = {}
+            cid = self.category_ids[i]
+            if cid >= 0:
+                obj["category"] = self.categories[cid]
+            if not np.isnan(self.scores[i]):
+                obj["score"] = scores[i]
+            if self.has_box[i]:
+                obj["bbox"] = boxes[i]
+            for key, column in (("mask", self.masks), ("pose_keypoints", self.pose_keypoints),
+                                ("hand_keypoints", self.hand_keypoints), ("caption", self.captions)):
+                if column[i] is not None:
+                    obj[key] = column[i]
+            if self.extras is not None and self.extras[i]:
+                obj.update(self.extras[i])
+            objects.append(obj)
+        return objects
+
+    def to_json(self):
+        """The raw API result dict"""
+        result = dict(self.meta)
+        result["objects"] = self.to_objects()
+        return result
+
+    # ---- selection ----
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __bool__(self):
+        return len(self.boxes) > 0
+
+    def take(self, indices):
+        """Subset by an index array or boolean mask (category table and raw data are shared)"""
+        indices = np.atleast_1d(np.asarray(indices))
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = indices.astype(np.int64, copy=False)
+        picked = indices.tolist()
+        subset = DetectionResult(
+            self.boxes[indices], self.scores[indices], self.category_ids[indices], self.categories,
+            self.has_box[indices], [self.masks[i] for i in picked], [self.pose_keypoints[i] for i in picked],
+            [self.hand_keypoints[i] for i in picked], [self.captions[i] for i in picked],
+            [self.extras[i] for i in picked] if self.extras is not None else None, self.meta,
+        )
+        # 已解码的掩码和关键点随子集一起保留
+        position = {old: new for new, old in enumerate(picked)}
+        subset._mask_cache = {(position[i], shape): mask for (i, shape), mask in self._mask_cache.items()
+                              if i in position}
+        subset._keypoint_cache = {(kind, position[i]): kp for (kind, i), kp in self._keypoint_cache.items()
+                                  if i in position}
+        return subset
+
+    __getitem__ = take
+
+    # ---- vectorized accessors ----
+
+    def category_names(self, default="unknown"):
+        """(N,) object array of category names, `default` where an object has no category"""
+        table = np.asarray(list(self.categories) + [default], dtype=object)
+        return table[np.where(self.category_ids >= 0, self.category_ids, len(self.categories))]
+
+    def category_counts(self, default="unknown"):
+        """{category name: count}"""
+        ids = np.where(self.category_ids >= 0, self.category_ids, len(self.categories))
+        counts = np.bincount(ids, minlength=len(self.categories) + 1)
+        names = list(self.categories) + [default]
+        return {names[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def scores_or(self, default):
+        """Scores with `default` in place of missing ones"""
+        return np.where(np.isnan(self.scores), np.float32(default), self.scores)
+
+    def score_list(self, default):
+        """Scores as Python floats with their float32 rounding removed (for JSON / history)"""
+        return _shortest_floats(self.scores_or(default))
+
+    def areas(self):
+        wh = np.clip(self.boxes[:, 2:] - self.boxes[:, :2], 0, None)
+        return wh[:, 0] * wh[:, 1] * self.has_box
+
+    @property
+    def has_mask(self):
+        return np.fromiter((m is not None for m in self.masks), dtype=bool, count=len(self))
+
+    # ---- lazy decoding ----
+
+    def mask(self, i, shape):
+        """Binary mask of object `i` resized to `shape` (decoded on first use), or None"""
+        key = (i, tuple(shape))
+        if key not in self._mask_cache:
+            if self.masks[i] is None:
+                return None
+            from visualization import decode_rle_mask
+            self._mask_cache[key] = decode_rle_mask(self.masks[i], tuple(shape))
+        return self._mask_cache[key]
+
+    def mask_roi(self, i, shape):
+        """((x1, y1, x2, y2), mask) of object `i` decoded only around its box for an image of `shape`, or None"""
+        if self.masks[i] is None:
+            return None
+        key = (i, tuple(shape))
+        if key in self._mask_cache:
+            # 整幅掩码已经解码过
+            mask = self._mask_cache[key]
+            return None if mask is None else ((0, 0, mask.shape[1], mask.shape[0]), mask)
+        from visualization import decode_rle_roi
+        return decode_rle_roi(self.masks[i], tuple(shape), self.boxes[i].tolist() if self.has_box[i] else None)
+
+    def keypoints(self, kind, i):
+        """(K, 4) keypoints of object `i` ("pose" or "hand"), parsed on first use, or None"""
+        key = (kind, i)
+        if key not in self._keypoint_cache:
+            raw = (self.pose_keypoints if kind == "pose" else self.hand_keypoints)[i]
+            if raw is None:
+                return None
+            self._keypoint_cache[key] = parse_keypoints(raw)
+        return self._keypoint_cache[key]
+
+def as_detection_result(value):
+    """
+    Accept a DetectionResult, a raw result dict or a list of object dicts
+    """
+    if value is None or isinstance(value, DetectionResult):
+        return value
+    if isinstance(value, dict):
+        return DetectionResult.from_json(value)
+    return DetectionResult.from_objects(list(value))
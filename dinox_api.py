@@ -1,408 +1,621 @@
 import requests
-import base64
-import json
-import time
+from requests.adapters import HTTPAdapter
 import os
+import threading
+import logging
 from dotenv import load_dotenv
-from PIL import Image
-import io
-import numpy as np
+
+from dinox_logging import LazyJSON, LogSampler, Truncated, get_logger, register_secret
+from polling import PollingPolicy, parse_retry_after, poll_stats
+from rate_limit import THROTTLE_BACKOFF, CircuitOpenError, RateLimitError, get_limiter
+from image_payload import (
+    DEFAULT_UPLOAD_POLICY, encode_image, hash_image, prepare_upload, rescale_result
+)
+from result_cache import detection_cache_key, get_result_cache, region_vl_cache_key
+from singleflight import inflight_requests
+from task_journal import journal_call
+from timings import stage
 
 # Load environment variables
 load_dotenv()
 
+logger = get_logger("api")
+
 # Get API token from environment variables or use a hardcoded value
 # 请将下面的 "你的API令牌" 替换为你从 DINO-X 获取的实际 API 令牌
 API_TOKEN = os.getenv("DINOX_API_TOKEN") or "你的API令牌"
 
-# 打印API令牌状态（不显示完整令牌）
+# 记录API令牌状态（日志输出中令牌会被脱敏）
 if API_TOKEN and API_TOKEN != "你的API令牌":
-    print(f"API令牌已设置: {API_TOKEN[:5]}...{API_TOKEN[-5:]} (长度: {len(API_TOKEN)})")
+    register_secret(API_TOKEN)
+    logger.info("API令牌已设置 (长度: %d)", len(API_TOKEN))
 else:
-    print("警告: API令牌未设置或使用了默认值")
+    logger.warning("API令牌未设置或使用了默认值")
 
-# API endpoints
-DETECTION_API_URL = "https://api.deepdataspace.com/v2/task/dinox/detection"
-REGION_VL_API_URL = "https://api.deepdataspace.com/v2/task/dinox/region_vl"
-TASK_STATUS_API_URL = "https://api.deepdataspace.com/v2/task_status/{task_uuid}"
+# API endpoints（DINOX_API_BASE 可指向本地模拟服务，见 mock_server.py）
+DEFAULT_API_BASE = "https://api.deepdataspace.com"
+API_BASE = os.getenv("DINOX_API_BASE") or DEFAULT_API_BASE
+DETECTION_API_URL = REGION_VL_API_URL = TASK_STATUS_API_URL = None
 
-# 打印API端点
-print(f"检测API端点: {DETECTION_API_URL}")
-print(f"区域视觉语言API端点: {REGION_VL_API_URL}")
-print(f"任务状态API端点: {TASK_STATUS_API_URL}")
+def set_api_base(base_url=None):
+    """
+    Point all endpoints at another server (e.g. "http://127.0.0.1:8600"); None restores the default
+    其他模块在调用时读取 dinox_api 中的端点，修改后立即生效
+    """
+    global API_BASE, DETECTION_API_URL, REGION_VL_API_URL, TASK_STATUS_API_URL
+    API_BASE = (base_url or DEFAULT_API_BASE).rstrip("/")
+    DETECTION_API_URL = f"{API_BASE}/v2/task/dinox/detection"
+    REGION_VL_API_URL = f"{API_BASE}/v2/task/dinox/region_vl"
+    TASK_STATUS_API_URL = f"{API_BASE}/v2/task_status/{{task_uuid}}"
 
-def encode_image_to_base64(image):
+set_api_base(API_BASE)
+
+# 模型名称（同时作为结果缓存键的一部分）
+MODEL_NAME = "DINO-X-1.0"
+
+logger.debug("API端点: detection=%s region_vl=%s task_status=%s",
+             DETECTION_API_URL, REGION_VL_API_URL, TASK_STATUS_API_URL)
+
+# HTTP连接池与超时配置（可通过环境变量覆盖）
+DEFAULT_POOL_SIZE = int(os.getenv("DINOX_POOL_SIZE", "10"))
+DEFAULT_CONNECT_TIMEOUT = float(os.getenv("DINOX_CONNECT_TIMEOUT", "5"))
+DEFAULT_READ_TIMEOUT = float(os.getenv("DINOX_READ_TIMEOUT", "60"))
+
+# 默认轮询策略（参数见 polling.py，可通过 DINOX_POLL_* 环境变量调整）
+DEFAULT_POLLING_POLICY = PollingPolicy()
+
+# 是否通过共享的后台轮询服务（task_poller.TaskPoller）等待任务结果
+USE_SHARED_POLLER = os.getenv("DINOX_SHARED_POLLER", "1") == "1"
+
+# 创建任务收到 429 时（按 Retry-After 等待后）最多重试的次数
+SUBMIT_RETRIES = int(os.getenv("DINOX_SUBMIT_RETRIES", "2"))
+
+# 状态查询响应的调试日志按 DINOX_LOG_POLL_SAMPLE 采样
+_poll_log_sampler = LogSampler()
+
+class TaskFailedError(Exception):
+    """The API reported the task as failed (as opposed to a timeout or transport error)"""
+
+class DinoXClient:
     """
-    Convert an image (numpy array or PIL Image) to base64 string
+    Reusable DINO-X API client that owns a pooled keep-alive requests.Session
+    提交任务和轮询状态复用同一组TCP/TLS连接，避免每次请求都重新握手
     """
-    if isinstance(image, np.ndarray):
-        # Convert numpy array to PIL Image
-        image = Image.fromarray(image)
+    def __init__(self, api_token=None, pool_size=None, connect_timeout=None,
+                 read_timeout=None, keep_alive=True):
+        self._api_token = api_token
+        register_secret(api_token)
+        self.pool_size = pool_size or DEFAULT_POOL_SIZE
+        self.timeout = (
+            connect_timeout if connect_timeout is not None else DEFAULT_CONNECT_TIMEOUT,
+            read_timeout if read_timeout is not None else DEFAULT_READ_TIMEOUT,
+        )
+        
+        # 每个host一个连接池，池大小决定可并发复用的连接数
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+    
+    @property
+    def api_token(self):
+        """The token sent with every request (explicit token, then environment, then module default)"""
+        return self._api_token or os.getenv("DINOX_API_TOKEN") or API_TOKEN
+    
+    def has_valid_token(self):
+        """Check whether a real API token is configured"""
+        token = self.api_token
+        return bool(token) and token != "你的API令牌"
+    
+    def request(self, method, url, endpoint=None, **kwargs):
+        """
+        Send a request through the pooled session with the token header and default timeouts
+        
+        指定 endpoint（"detection" / "region_vl" / "task_status"）时经过该端点的限流器：
+        按速率等待、熔断期间抛出 CircuitOpenError，并把响应状态反馈给限流器和熔断器
+        """
+        headers = {"Token": self.api_token}
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs.setdefault("timeout", self.timeout)
+        limiter = get_limiter(endpoint) if endpoint else None
+        if limiter is not None:
+            with stage("rate_limit"):
+                limiter.before_request()
+        try:
+            response = self.session.request(method, url, headers=headers, **kwargs)
+        except requests.RequestException:
+            if limiter is not None:
+                limiter.record_error()
+            raise
+        if limiter is not None:
+            limiter.record_response(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+        return response
     
-    # Convert PIL Image to base64
-    buffered = io.BytesIO()
-    image.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/jpeg;base64,{img_str}"
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+    
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+    
+    def close(self):
+        """Close all pooled connections"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-def detect_objects_async(image, prompt_type="text", prompt_text=None, prompt_universal=None, 
-                        targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None):
+_default_client = None
+_default_client_lock = threading.Lock()
+
+def get_default_client():
     """
-    Create a detection task using the DINO-X API and return the task UUID
-    按照最新API文档创建检测任务
+    Return the process-wide DinoXClient, creating it on first use
+    同一进程内（包括Streamlit的多个会话线程）共享一个连接池
     """
-    if not API_TOKEN or API_TOKEN == "你的API令牌":
-        raise ValueError("API token not found or using default value. Please set the DINOX_API_TOKEN environment variable.")
-    
-    # 准备图像数据
-    image_data = image if isinstance(image, str) else encode_image_to_base64(image)
+    global _default_client
+    if _default_client is None:
+        with _default_client_lock:
+            if _default_client is None:
+                _default_client = DinoXClient()
+    return _default_client
+
+def set_default_client(client):
+    """
+    Replace the process-wide DinoXClient (the previous one is closed)
+    """
+    global _default_client
+    with _default_client_lock:
+        previous = _default_client
+        _default_client = client
+    if previous is not None and previous is not client:
+        previous.close()
+
+def encode_image_to_base64(image):
+    """
+    Convert an image to a base64 data URI
     
-    # 准备提示结构
+    原始文件字节（EncodedImage / bytes）直接透传；numpy 数组和 PIL 图像编码为JPEG，
+    编码结果按图像内容缓存，重试和重新分析时不会重复编码（见 image_payload.py）
+    """
+    return encode_image(image)
+
+def build_prompt(prompt_type, prompt_text=None, prompt_universal=None):
+    """
+    Build the `prompt` object of a task payload
+    """
     prompt = {"type": prompt_type}
     if prompt_type == "text" and prompt_text:
         prompt["text"] = prompt_text
     elif prompt_type == "universal" and prompt_universal:
         prompt["universal"] = prompt_universal
-    
-    # 准备请求载荷
+    return prompt
+
+def build_detection_payload(image_data, prompt_type="text", prompt_text=None, prompt_universal=None,
+                            targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None):
+    """
+    Build the request payload of a detection task from an already encoded image
+    """
     payload = {
         "image": image_data,
         "targets": targets,
         "bbox_threshold": bbox_threshold,
         "iou_threshold": iou_threshold,
-        "prompt": prompt,
-        "model": "DINO-X-1.0"
+        "prompt": build_prompt(prompt_type, prompt_text, prompt_universal),
+        "model": MODEL_NAME
     }
     
     if session_id:
         payload["session_id"] = session_id
     
-    # 准备请求头
-    headers = {
-        "Token": API_TOKEN,
-        "Content-Type": "application/json"
+    return payload
+
+def build_region_vl_payload(image_data, regions, targets=["caption"], prompt_type=None,
+                            prompt_text=None, prompt_universal=None, session_id=None):
+    """
+    Build the request payload of a region visual language task from an already encoded image
+    """
+    payload = {
+        "image": image_data,
+        "regions": regions,
+        "targets": targets,
+        "model": MODEL_NAME
     }
     
-    print(f"Sending request to {DETECTION_API_URL}")
-    print(f"Headers: {headers}")
-    print(f"Payload keys: {list(payload.keys())}")
+    # 添加提示结构（如果提供）
+    if prompt_type:
+        payload["prompt"] = build_prompt(prompt_type, prompt_text, prompt_universal)
     
-    # 尝试多种API调用方式
-    try:
-        print("尝试方式1: 使用requests.post的json参数")
-        response = requests.post(DETECTION_API_URL, json=payload, headers=headers)
-        
-        print(f"Response status code: {response.status_code}")
-        print(f"Response text: {response.text[:500]}...")  # 只打印前500个字符
-        
-        if response.status_code != 200:
-            print("尝试方式2: 使用requests.post的data参数和手动JSON序列化")
-            json_payload = json.dumps(payload)
-            response = requests.post(DETECTION_API_URL, data=json_payload, headers=headers)
-            
-            print(f"Response status code: {response.status_code}")
-            print(f"Response text: {response.text[:500]}...")  # 只打印前500个字符
-            
-            if response.status_code != 200:
-                print("尝试方式3: 按照官方文档示例使用json.dumps")
-                headers["Content-Type"] = "application/json"
-                response = requests.post(
-                    url=DETECTION_API_URL,
-                    data=json.dumps(payload),
-                    headers=headers
-                )
-                
-                print(f"Response status code: {response.status_code}")
-                print(f"Response text: {response.text[:500]}...")  # 只打印前500个字符
-    except Exception as e:
-        print(f"API request error: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        raise
+    if session_id:
+        payload["session_id"] = session_id
+    
+    return payload
+
+def extract_task_uuid(response_data):
+    """
+    Extract the task UUID from a task creation response
+    """
+    if response_data.get("code") != 0:
+        raise Exception(f"API request failed: {response_data.get('msg')}")
+    
+    # 检查响应中是否包含task_uuid
+    if 'data' not in response_data:
+        raise Exception(f"API response missing 'data' field: {response_data}")
+    
+    # 检查是否包含task_uuid或uuid（兼容不同的API版本）
+    if 'task_uuid' in response_data['data']:
+        return response_data["data"]["task_uuid"]
+    elif 'uuid' in response_data['data']:
+        return response_data["data"]["uuid"]
+    else:
+        raise Exception(f"API response missing task identifier in 'data': {response_data['data']}")
+
+def extract_task_result(data):
+    """
+    Extract (result, session_id) from the `data` of a successful task status response
+    """
+    # 检查响应中是否包含result字段
+    if 'result' not in data:
+        logger.warning("API response missing 'result' field in 'data': %s", Truncated(LazyJSON(data)))
+        # 尝试兼容不同的API版本
+        if 'objects' in data:
+            logger.info("Found 'objects' directly in data, using it as result")
+            return {"objects": data.get("objects")}, data.get("session_id")
+        return {}, data.get("session_id")
     
+    return data.get("result"), data.get("session_id")
+
+def submit_task(url, payload, endpoint, client=None):
+    """
+    POST a prepared task payload once and return the task UUID
+    
+    请求经过端点限流器；只有 429（请求未被受理）时才在等待后重试，最多 SUBMIT_RETRIES 次
+    """
+    client = client or get_default_client()
+    logger.debug("Sending request to %s (payload keys: %s)", url, list(payload))
+    
+    for attempt in range(SUBMIT_RETRIES + 1):
+        with stage("upload"):
+            response = client.post(url, json=payload, endpoint=endpoint)
+        if response.status_code != 429:
+            break
+        logger.warning("%s request throttled (429), attempt %d of %d", endpoint, attempt + 1, SUBMIT_RETRIES + 1)
+    
+    if response.status_code == 429:
+        raise RateLimitError(f"API request was throttled {SUBMIT_RETRIES + 1} times: {response.text}")
     if response.status_code != 200:
         raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
     
     try:
-        response_data = response.json()
-        print(f"Response data: {json.dumps(response_data)}")
-        
-        if response_data.get("code") != 0:
-            raise Exception(f"API request failed: {response_data.get('msg')}")
-        
-        # 检查响应中是否包含task_uuid
-        if 'data' not in response_data:
-            raise Exception(f"API response missing 'data' field: {response_data}")
-        
-        # 检查是否包含task_uuid或uuid（兼容不同的API版本）
-        if 'task_uuid' in response_data['data']:
-            return response_data["data"]["task_uuid"]
-        elif 'uuid' in response_data['data']:
-            return response_data["data"]["uuid"]
-        else:
-            raise Exception(f"API response missing task identifier in 'data': {response_data['data']}")
-    except json.JSONDecodeError:
-        print(f"无法解析JSON响应: {response.text}")
+        with stage("json_parse"):
+            response_data = response.json()
+    except ValueError:
+        logger.error("无法解析JSON响应: %s", Truncated(response.text))
         raise Exception("API返回了无效的JSON响应")
+    
+    logger.debug("Response data: %s", LazyJSON(response_data))
+    return extract_task_uuid(response_data)
+
+def detect_objects_async(image, prompt_type="text", prompt_text=None, prompt_universal=None, 
+                        targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                        client=None):
+    """
+    Create a detection task using the DINO-X API and return the task UUID
+    按照最新API文档创建检测任务
+    """
+    client = client or get_default_client()
+    if not client.has_valid_token():
+        raise ValueError("API token not found or using default value. Please set the DINOX_API_TOKEN environment variable.")
+    
+    # 准备图像数据
+    image_data = image if isinstance(image, str) else encode_image_to_base64(image)
+    
+    # 准备请求载荷
+    payload = build_detection_payload(
+        image_data, prompt_type, prompt_text, prompt_universal,
+        targets, bbox_threshold, iou_threshold, session_id
+    )
+    
+    return submit_task(DETECTION_API_URL, payload, "detection", client)
 
-def get_task_result(task_uuid, max_retries=30, retry_interval=1):
+def poll_task_status(task_uuid, client=None):
+    """
+    Query the status of a task once
+    
+    返回 (status, data, retry_after)：
+    - status 为 API 返回的任务状态（"success"/"failed"/"waiting"/"running"...），请求或解析失败时为 None
+    - data 为响应中的 data 字段（失败时为 None）
+    - retry_after 为服务端的 Retry-After 提示（秒），没有时为 None
+    """
+    client = client or get_default_client()
+    url = TASK_STATUS_API_URL.format(task_uuid=task_uuid)
+    
+    try:
+        with stage("poll"):
+            response = client.get(url, endpoint="task_status")
+    except CircuitOpenError as e:
+        # 熔断期间不发请求，等到允许探测时再查询
+        return None, None, e.retry_after
+    except requests.RequestException as e:
+        logger.warning("Error checking status of task %s: %s", task_uuid, e)
+        return None, None, None
+    
+    if response.status_code != 200:
+        logger.warning("Task status request for %s failed with status code %s",
+                       task_uuid, response.status_code)
+        # 服务端限流或暂不可用时遵循 Retry-After 提示
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if response.status_code == 429 and retry_after is None:
+            retry_after = THROTTLE_BACKOFF
+        return None, None, retry_after
+    
+    try:
+        with stage("json_parse"):
+            response_data = response.json()
+    except ValueError:
+        logger.warning("无法解析JSON响应: %s", Truncated(response.text))
+        return None, None, None
+    
+    if logger.isEnabledFor(logging.DEBUG) and _poll_log_sampler():
+        logger.debug("Task status response for %s: %s", task_uuid, Truncated(LazyJSON(response_data)))
+    
+    if response_data.get("code") != 0:
+        logger.warning("Task status request for %s failed: %s", task_uuid, response_data.get("msg"))
+        return None, None, None
+    
+    # 检查响应中是否包含data字段
+    if 'data' not in response_data:
+        logger.warning("API response missing 'data' field: %s", Truncated(LazyJSON(response_data)))
+        return None, None, None
+    
+    data = response_data["data"]
+    return data.get("status"), data, None
+
+def get_task_result(task_uuid, max_retries=None, retry_interval=None, client=None, policy=None):
     """
     Get the result of a task using the DINO-X API
     按照最新API文档获取任务结果
+
+    轮询间隔由 PollingPolicy 决定（短首次轮询 + 指数退避 + 总截止时间）。
+    显式传入 max_retries / retry_interval 时退化为旧的固定间隔轮询。
+    每个任务的轮询次数记录在 polling.poll_stats 中。
     """
-    if not API_TOKEN or API_TOKEN == "你的API令牌":
+    client = client or get_default_client()
+    if not client.has_valid_token():
         raise ValueError("API token not found or using default value. Please set the DINOX_API_TOKEN environment variable.")
     
-    headers = {
-        "Token": API_TOKEN,
-        "Content-Type": "application/json"
-    }
+    if max_retries is not None or retry_interval is not None:
+        policy = PollingPolicy.fixed(retry_interval or 1, max_retries or 30)
+    schedule = (policy or DEFAULT_POLLING_POLICY).start()
     
-    print(f"Checking status for task: {task_uuid}")
-    
-    for retry in range(max_retries):
-        url = TASK_STATUS_API_URL.format(task_uuid=task_uuid)
-        print(f"Request URL: {url}")
-        print(f"Retry {retry+1}/{max_retries}")
+    retry_after = None
+    while True:
+        # 两次轮询之间的等待即任务在服务端排队和处理的时间
+        with stage("queue_wait"):
+            if not schedule.wait(retry_after):
+                break
+        schedule.record_poll()
         
-        try:
-            print(f"Sending GET request to {url}")
-            response = requests.get(url, headers=headers)
-            
-            print(f"Response status code: {response.status_code}")
-            if response.text:
-                print(f"Response text: {response.text[:500]}...")  # 只打印前500个字符
-            else:
-                print("Response text is empty")
-            
-            if response.status_code != 200:
-                print(f"API request failed with status code {response.status_code}")
-                # Continue to retry instead of raising exception immediately
-                time.sleep(retry_interval)
-                continue
-            
-            try:
-                response_data = response.json()
-                print(f"Response data: {json.dumps(response_data)}")
-                
-                if response_data.get("code") != 0:
-                    print(f"API request failed: {response_data.get('msg')}")
-                    # Continue to retry instead of raising exception immediately
-                    time.sleep(retry_interval)
-                    continue
-                
-                # 检查响应中是否包含data字段
-                if 'data' not in response_data:
-                    print(f"API response missing 'data' field: {response_data}")
-                    time.sleep(retry_interval)
-                    continue
-                
-                data = response_data["data"]
-                status = data.get("status")
-                
-                print(f"Task status: {status}")
-                
-                if status == "success":
-                    # 检查响应中是否包含result字段
-                    if 'result' not in data:
-                        print(f"API response missing 'result' field in 'data': {data}")
-                        # 尝试兼容不同的API版本
-                        if 'objects' in data:
-                            print("Found 'objects' directly in data, using it as result")
-                            return {"objects": data.get("objects")}, data.get("session_id")
-                        return {}, data.get("session_id")
-                    
-                    return data.get("result"), data.get("session_id")
-                elif status == "failed":
-                    error_msg = data.get("error", "Unknown error")
-                    print(f"Task failed: {error_msg}")
-                    raise Exception(f"Task failed: {error_msg}")
-                elif status in ["waiting", "running"]:
-                    print(f"Task is {status}, waiting...")
-                else:
-                    print(f"Unknown task status: {status}")
-            except json.JSONDecodeError:
-                print(f"无法解析JSON响应: {response.text}")
-                time.sleep(retry_interval)
-                continue
-            
-            print(f"Waiting {retry_interval} seconds before next retry...")
-            time.sleep(retry_interval)
-        except Exception as e:
-            print(f"Error checking task status: {str(e)}")
-            import traceback
-            print(traceback.format_exc())
-            time.sleep(retry_interval)
-    
-    raise Exception(f"Task timed out after {max_retries * retry_interval} seconds")
+        status, data, retry_after = poll_task_status(task_uuid, client)
+        
+        if status == "success":
+            poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, status)
+            logger.info("Task %s finished after %d polls in %.2fs", task_uuid, schedule.polls, schedule.elapsed)
+            return extract_task_result(data)
+        elif status == "failed":
+            poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, status)
+            error_msg = data.get("error", "Unknown error")
+            raise TaskFailedError(f"Task failed: {error_msg}")
+        elif status in ["waiting", "running"]:
+            if logger.isEnabledFor(logging.DEBUG) and _poll_log_sampler(schedule.polls):
+                logger.debug("Poll %d for task %s: %s (%.2fs elapsed)",
+                             schedule.polls, task_uuid, status, schedule.elapsed)
+        elif status is not None:
+            logger.warning("Unknown status of task %s: %s", task_uuid, status)
+    
+    poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, "timeout")
+    raise Exception(f"Task timed out after {schedule.elapsed:.1f} seconds ({schedule.polls} polls)")
+
+def task_kind(endpoint, targets=None):
+    """Key for per-task-type latency statistics: (endpoint, sorted targets)"""
+    return endpoint, tuple(sorted(targets or ()))
+
+def wait_for_task_result(task_uuid, client=None, kind=None):
+    """
+    Wait for a task to finish and return (result, session_id)
+    
+    默认交给进程内共享的 TaskPoller，所有在途任务共用一个轮询调度；
+    关闭 DINOX_SHARED_POLLER 或传入自定义 client 时退回到 get_task_result 的独立轮询。
+    kind（task_kind 的返回值）让轮询服务按任务类型估计耗时，决定首次轮询的时间。
+    """
+    if USE_SHARED_POLLER and client is None:
+        from task_poller import get_shared_poller
+        return get_shared_poller().wait(task_uuid, kind=kind)
+    return get_task_result(task_uuid, client=client)
+
+def _describe_object(obj):
+    """Short description of a detected object for debug logs"""
+    fields = {}
+    for key, value in obj.items():
+        if key == "mask":
+            fields[key] = f"mask({', '.join(value) if isinstance(value, dict) else type(value).__name__})"
+        elif key in ("pose_keypoints", "hand_keypoints"):
+            fields[key] = f"{len(value) if isinstance(value, list) else type(value).__name__} values"
+        else:
+            fields[key] = value
+    return fields
+
+def _wait_journaled(task_uuid, client=None, kind=None):
+    """
+    wait_for_task_result that records definite task failures in the task journal
+    超时和网络错误不改变日志状态，任务保持 pending，进程重启后仍可恢复
+    """
+    try:
+        return wait_for_task_result(task_uuid, client=client, kind=kind)
+    except TaskFailedError as e:
+        journal_call("finish", task_uuid, "failed", str(e))
+        raise
+
+def _run_detection(image, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold,
+                   iou_threshold, session_id, client, upload_policy, cache, cache_key, image_hash=None):
+    """
+    Upload, submit, wait and rescale one detection request; the result is stored in the cache
+    
+    提交后的任务记录在任务日志中（task_journal.py），结果写入缓存后才标记为完成
+    """
+    # 按上传策略缩放并编码图像
+    with stage("encode"):
+        image_data, scale, upload_info = prepare_upload(image, upload_policy)
+    if scale != (1.0, 1.0):
+        logger.debug("上传前缩放: %s -> %s, 节省 %d 字节",
+                     upload_info['original_size'], upload_info['upload_size'], upload_info['bytes_saved'])
+    
+    # 创建检测任务并获取结果（占用一个检测端点的在途任务名额）
+    with get_limiter("detection").task_slot():
+        task_uuid = detect_objects_async(
+            image_data, prompt_type, prompt_text, prompt_universal, 
+            targets, bbox_threshold, iou_threshold, session_id, client=client
+        )
+        journal_call("record_submitted", task_uuid, "detection", cache_key, image_hash, {
+            "prompt": build_prompt(prompt_type, prompt_text, prompt_universal), "targets": targets,
+            "bbox_threshold": bbox_threshold, "iou_threshold": iou_threshold,
+            "upload": upload_policy.cache_params(),
+        }, scale)
+        result, new_session_id = _wait_journaled(task_uuid, client, task_kind("detection", targets))
+    
+    # 把坐标映射回原图
+    rescale_result(result, scale)
+    
+    logger.info("检测完成: task=%s, %d 个对象, 会话 ID: %s",
+                task_uuid, len(result.get("objects") or []), new_session_id)
+    
+    # 逐个对象的摘要只在DEBUG级别生成（掩码和关键点只记录结构，不输出内容）
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, obj in enumerate(result.get("objects") or []):
+            logger.debug("对象 %d: %s", i + 1, _describe_object(obj))
+    
+    if cache is not None:
+        cache.put(cache_key, result, new_session_id)
+    journal_call("finish", task_uuid)
+    
+    return result, new_session_id
 
 def detect_objects(image, prompt_type="text", prompt_text=None, prompt_universal=None, 
-                  targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None):
+                  targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                  client=None, upload_policy=None):
     """
     Detect objects in an image using the DINO-X API
+    
+    upload_policy (UploadPolicy) 限制上传尺寸：超限的图像先缩小再上传，
+    返回的 bbox 和关键点会映射回原图坐标（默认读取 DINOX_UPLOAD_MAX_SIDE / DINOX_UPLOAD_MAX_PIXELS）
     """
+    upload_policy = upload_policy or DEFAULT_UPLOAD_POLICY
     try:
-        print(f"\n===== DINO-X API 调用开始 =====")
-        print(f"提示类型: {prompt_type}")
-        if prompt_type == "text":
-            print(f"提示文本: {prompt_text}")
-        else:
-            print(f"通用提示值: {prompt_universal}")
-        print(f"检测目标: {targets}")
-        print(f"置信度阈值: {bbox_threshold}")
-        print(f"IoU 阈值: {iou_threshold}")
-        print(f"会话 ID: {session_id}")
-        print(f"API URL: {DETECTION_API_URL}")
-        
-        # 检查 API 令牌
-        if not API_TOKEN or API_TOKEN == "你的API令牌":
-            print("警告: API 令牌未设置或使用了默认值")
-        else:
-            print(f"API 令牌: {API_TOKEN[:5]}...{API_TOKEN[-5:]} (已设置)")
+        logger.debug("DINO-X 检测: prompt_type=%s prompt=%r targets=%s bbox_threshold=%s iou_threshold=%s session_id=%s",
+                     prompt_type, prompt_text if prompt_type == "text" else prompt_universal,
+                     targets, bbox_threshold, iou_threshold, session_id)
         
-        # 创建检测任务
-        task_uuid = detect_objects_async(
-            image, prompt_type, prompt_text, prompt_universal, 
-            targets, bbox_threshold, iou_threshold, session_id
+        # 相同图像 + 相同参数的请求直接返回缓存结果，不再产生API调用
+        image_hash = hash_image(image)
+        cache_key = detection_cache_key(
+            image, build_prompt(prompt_type, prompt_text, prompt_universal),
+            targets, bbox_threshold, iou_threshold, MODEL_NAME,
+            image_hash=image_hash, upload=upload_policy.cache_params()
         )
+        cache = get_result_cache()
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("命中结果缓存: %s", cache_key)
+                return cached
         
-        print(f"任务 UUID: {task_uuid}")
-        
-        # 获取任务结果
-        result, new_session_id = get_task_result(task_uuid)
-        
-        print(f"检测完成, 会话 ID: {new_session_id}")
-        
-        # 打印完整的API响应，包括所有字段
-        print("API响应完整数据:")
-        if "objects" in result:
-            for i, obj in enumerate(result["objects"]):
-                print(f"\n对象 {i+1}:")
-                for key, value in obj.items():
-                    if key == "mask":
-                        print(f"  {key}: {type(value)} - {value.keys() if isinstance(value, dict) else '非字典类型'}")
-                    elif key in ["pose_keypoints", "hand_keypoints"]:
-                        print(f"  {key}: {type(value)} - 长度: {len(value) if isinstance(value, list) else '非列表类型'}")
-                    else:
-                        print(f"  {key}: {value}")
-        
-        print(f"===== DINO-X API 调用结束 =====\n")
-        
-        return result, new_session_id
+        # 相同的请求已经在途时（其他会话或批量任务）直接等待它的结果，不再重复创建任务
+        return inflight_requests.do(
+            cache_key, _run_detection, image, prompt_type, prompt_text, prompt_universal,
+            targets, bbox_threshold, iou_threshold, session_id, client, upload_policy, cache, cache_key,
+            image_hash
+        )
     
-    except Exception as e:
-        print(f"检测过程中出错: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("检测过程中出错")
         # Return empty result but don't raise exception to avoid breaking the UI
         return {"objects": []}, session_id
 
 def create_region_vl_task(image, regions, targets=["caption"], prompt_type=None, 
-                         prompt_text=None, prompt_universal=None, session_id=None):
+                         prompt_text=None, prompt_universal=None, session_id=None, client=None):
     """
     Create a region visual language task using the DINO-X API
     按照最新API文档创建区域视觉语言任务
     """
-    if not API_TOKEN:
+    client = client or get_default_client()
+    if not client.api_token:
         raise ValueError("API token not found. Please set the DINOX_API_TOKEN environment variable.")
     
     # 准备图像数据
     image_data = image if isinstance(image, str) else encode_image_to_base64(image)
     
     # 准备请求载荷
-    payload = {
-        "image": image_data,
-        "regions": regions,
-        "targets": targets,
-        "model": "DINO-X-1.0"
-    }
-    
-    # 添加提示结构（如果提供）
-    if prompt_type:
-        prompt = {"type": prompt_type}
-        if prompt_type == "text" and prompt_text:
-            prompt["text"] = prompt_text
-        elif prompt_type == "universal" and prompt_universal:
-            prompt["universal"] = prompt_universal
-        payload["prompt"] = prompt
-    
-    if session_id:
-        payload["session_id"] = session_id
-    
-    # 准备请求头
-    headers = {
-        "Token": API_TOKEN,
-        "Content-Type": "application/json"
-    }
-    
-    print(f"Sending request to {REGION_VL_API_URL}")
-    print(f"Headers: {headers}")
-    print(f"Payload: {json.dumps({k: v if k != 'image' else '...' for k, v in payload.items()})}")
-    
-    # 发送API请求 - 尝试两种方式
-    try:
-        # 方式1: 使用json参数（requests会自动处理JSON序列化）
-        response = requests.post(REGION_VL_API_URL, json=payload, headers=headers)
-        
-        print(f"Response status code: {response.status_code}")
-        print(f"Response text: {response.text}")
-        
-        if response.status_code != 200:
-            print("尝试替代方法...")
-            # 方式2: 手动序列化JSON并使用data参数
-            json_payload = json.dumps(payload)
-            response = requests.post(REGION_VL_API_URL, data=json_payload, headers=headers)
-            
-            print(f"Alternative method response status code: {response.status_code}")
-            print(f"Alternative method response text: {response.text}")
-    except Exception as e:
-        print(f"API request error: {str(e)}")
-        raise
+    payload = build_region_vl_payload(
+        image_data, regions, targets, prompt_type, prompt_text, prompt_universal, session_id
+    )
     
-    if response.status_code != 200:
-        raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
-    
-    response_data = response.json()
-    print(f"Response data: {json.dumps(response_data)}")
+    return submit_task(REGION_VL_API_URL, payload, "region_vl", client)
+
+def _run_region_descriptions(image, regions, targets, prompt_type, prompt_text, prompt_universal,
+                             session_id, client, cache, cache_key, image_hash=None):
+    """
+    Submit and wait for one region VL request; the result is stored in the cache
+    """
+    # Create region VL task and wait for its result (holds one region_vl task slot)
+    with get_limiter("region_vl").task_slot():
+        task_uuid = create_region_vl_task(
+            image, regions, targets, prompt_type, prompt_text, prompt_universal, session_id,
+            client=client
+        )
+        journal_call("record_submitted", task_uuid, "region_vl", cache_key, image_hash, {
+            "regions": regions, "targets": targets,
+            "prompt": build_prompt(prompt_type, prompt_text, prompt_universal) if prompt_type else None,
+        })
+        result, new_session_id = _wait_journaled(task_uuid, client, task_kind("region_vl", targets))
     
-    if response_data.get("code") != 0:
-        raise Exception(f"API request failed: {response_data.get('msg')}")
+    logger.info("Region descriptions completed: task=%s, session_id: %s", task_uuid, new_session_id)
     
-    # 检查响应中是否包含task_uuid
-    if 'data' not in response_data:
-        raise Exception(f"API response missing 'data' field: {response_data}")
+    if cache is not None:
+        cache.put(cache_key, result, new_session_id)
+    journal_call("finish", task_uuid)
     
-    # 检查是否包含task_uuid或uuid（兼容不同的API版本）
-    if 'task_uuid' in response_data['data']:
-        return response_data["data"]["task_uuid"]
-    elif 'uuid' in response_data['data']:
-        return response_data["data"]["uuid"]
-    else:
-        raise Exception(f"API response missing task identifier in 'data': {response_data['data']}")
+    return result, new_session_id
 
 def get_region_descriptions(image, regions, targets=["caption"], prompt_type=None, 
-                           prompt_text=None, prompt_universal=None, session_id=None):
+                           prompt_text=None, prompt_universal=None, session_id=None, client=None):
     """
     Get descriptions for regions in an image using the DINO-X API
     """
     try:
-        print(f"Starting region descriptions with targets={targets}, regions count={len(regions)}")
+        logger.debug("Starting region descriptions with targets=%s, regions count=%d", targets, len(regions))
         
-        # Create region VL task
-        task_uuid = create_region_vl_task(
-            image, regions, targets, prompt_type, prompt_text, prompt_universal, session_id
-        )
-        
-        print(f"Region VL task created with UUID: {task_uuid}")
+        prompt = build_prompt(prompt_type, prompt_text, prompt_universal) if prompt_type else None
+        image_hash = hash_image(image)
+        cache_key = region_vl_cache_key(image, regions, targets, prompt, MODEL_NAME, image_hash=image_hash)
+        cache = get_result_cache()
+        if cache is not None:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.debug("Region descriptions served from cache: %s", cache_key)
+                return cached
         
-        # Get task status
-        result, new_session_id = get_task_result(task_uuid)
-        
-        print(f"Region descriptions completed, session_id: {new_session_id}")
-        
-        return result, new_session_id
+        # Identical requests already in flight are joined instead of creating another task
+        return inflight_requests.do(
+            cache_key, _run_region_descriptions, image, regions, targets, prompt_type,
+            prompt_text, prompt_universal, session_id, client, cache, cache_key, image_hash
+        )
     
-    except Exception as e:
-        print(f"Error in get_region_descriptions: {str(e)}")
+    except Exception:
+        logger.exception("Error in get_region_descriptions")
         # Return empty result but don't raise exception to avoid breaking the UI
         return {"objects": []}, session_id 
\ No newline at end of file
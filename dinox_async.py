@@ -0,0 +1,236 @@
+"""
+asyncio-native DINO-X API client
+基于 aiohttp 的异步客户端：提交和轮询均为可 await 的协程，单个进程即可同时保持数百个任务在途
+"""
+import asyncio
+import json
+import os
+
+import aiohttp
+
+import dinox_api
+from dinox_api import (
+    API_TOKEN,
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_POLLING_POLICY,
+    DEFAULT_READ_TIMEOUT,
+    SUBMIT_RETRIES,
+    TaskFailedError,
+    build_detection_payload,
+    build_region_vl_payload,
+    encode_image_to_base64,
+    extract_task_result,
+    extract_task_uuid,
+)
+from dinox_logging import get_logger, register_secret
+from polling import parse_retry_after, poll_stats
+from rate_limit import THROTTLE_BACKOFF, CircuitOpenError, RateLimitError, get_limiter
+from timings import stage
+
+logger = get_logger("async")
+
+# 异步连接池大小（同时在途的HTTP请求数上限）
+DEFAULT_ASYNC_POOL_SIZE = int(os.getenv("DINOX_ASYNC_POOL_SIZE", "100"))
+
+class AsyncDinoXClient:
+    """
+    Async counterpart of DinoXClient / detect_objects / get_task_result / get_region_descriptions
+
+    The aiohttp session is created lazily inside the running event loop, so the
+    client can be constructed anywhere; use it as `async with AsyncDinoXClient() as client`.
+    """
+    def __init__(self, api_token=None, pool_size=None, connect_timeout=None,
+                 read_timeout=None, policy=None):
+        self._api_token = api_token
+        register_secret(api_token)
+        self.pool_size = pool_size or DEFAULT_ASYNC_POOL_SIZE
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT if connect_timeout is None else connect_timeout
+        self.read_timeout = DEFAULT_READ_TIMEOUT if read_timeout is None else read_timeout
+        self.policy = policy or DEFAULT_POLLING_POLICY
+        self._session = None
+
+    @property
+    def api_token(self):
+        return self._api_token or os.getenv("DINOX_API_TOKEN") or API_TOKEN
+
+    def has_valid_token(self):
+        token = self.api_token
+        return bool(token) and token != "你的API令牌"
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, limit_per_host=self.pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={"Content-Type": "application/json"}
+            )
+        return self._session
+
+    async def request(self, method, url, payload=None, endpoint=None):
+        """
+        Send a request and return (status_code, headers, parsed JSON or None, text)
+        指定 endpoint 时与同步客户端共用该端点的限流器和熔断器
+        """
+        session = self._get_session()
+        data = json.dumps(payload) if payload is not None else None
+        limiter = get_limiter(endpoint) if endpoint else None
+        if limiter is not None:
+            with stage("rate_limit"):
+                await limiter.before_request_async()
+        try:
+            async with session.request(method, url, data=data, headers={"Token": self.api_token}) as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if limiter is not None:
+                limiter.record_error()
+            raise
+        if limiter is not None:
+            limiter.record_response(response.status, parse_retry_after(response.headers.get("Retry-After")))
+        try:
+            with stage("json_parse"):
+                response_data = json.loads(text) if text else None
+        except ValueError:
+            response_data = None
+        return response.status, response.headers, response_data, text
+
+    async def _encode(self, image):
+        if isinstance(image, str):
+            return image
+        # JPEG编码是CPU密集操作，放到线程池中避免阻塞事件循环
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, encode_image_to_base64, image)
+
+    async def submit_payload(self, url, payload, endpoint=None):
+        """
+        POST a prepared task payload and return the task UUID (retried only on 429, like dinox_api.submit_task)
+        """
+        for _ in range(SUBMIT_RETRIES + 1):
+            with stage("upload"):
+                status_code, _, response_data, text = await self.request("POST", url, payload, endpoint)
+            if status_code != 429:
+                break
+        if status_code == 429:
+            raise RateLimitError(f"API request was throttled {SUBMIT_RETRIES + 1} times: {text}")
+        if status_code != 200:
+            raise Exception(f"API request failed with status code {status_code}: {text}")
+        if response_data is None:
+            raise Exception("API返回了无效的JSON响应")
+        return extract_task_uuid(response_data)
+
+    async def submit_detection(self, image, prompt_type="text", prompt_text=None, prompt_universal=None,
+                               targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None):
+        """
+        Create a detection task and return its UUID (async detect_objects_async)
+        """
+        if not self.has_valid_token():
+            raise ValueError("API token not found or using default value. Please set the DINOX_API_TOKEN environment variable.")
+        image_data = await self._encode(image)
+        payload = build_detection_payload(
+            image_data, prompt_type, prompt_text, prompt_universal,
+            targets, bbox_threshold, iou_threshold, session_id
+        )
+        return await self.submit_payload(dinox_api.DETECTION_API_URL, payload, "detection")
+
+    async def submit_region_vl(self, image, regions, targets=["caption"], prompt_type=None,
+                               prompt_text=None, prompt_universal=None, session_id=None):
+        """
+        Create a region visual language task and return its UUID (async create_region_vl_task)
+        """
+        if not self.has_valid_token():
+            raise ValueError("API token not found. Please set the DINOX_API_TOKEN environment variable.")
+        image_data = await self._encode(image)
+        payload = build_region_vl_payload(
+            image_data, regions, targets, prompt_type, prompt_text, prompt_universal, session_id
+        )
+        return await self.submit_payload(dinox_api.REGION_VL_API_URL, payload, "region_vl")
+
+    async def get_task_result(self, task_uuid, policy=None):
+        """
+        Poll a task until it finishes and return (result, session_id)
+        与同步版本使用相同的轮询策略，但等待期间只挂起协程，不占用线程
+        """
+        schedule = (policy or self.policy).start()
+        url = dinox_api.TASK_STATUS_API_URL.format(task_uuid=task_uuid)
+
+        retry_after = None
+        while not schedule.expired():
+            with stage("queue_wait"):
+                await asyncio.sleep(schedule.next_delay(retry_after))
+            if schedule.expired():
+                break
+            retry_after = None
+            schedule.record_poll()
+
+            try:
+                with stage("poll"):
+                    status_code, headers, response_data, _ = await self.request("GET", url, endpoint="task_status")
+            except CircuitOpenError as e:
+                # 熔断期间不发请求，等到允许探测时再查询
+                retry_after = e.retry_after
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                continue
+
+            if status_code != 200:
+                retry_after = parse_retry_after(headers.get("Retry-After"))
+                if status_code == 429 and retry_after is None:
+                    retry_after = THROTTLE_BACKOFF
+                continue
+            if not response_data or response_data.get("code") != 0 or "data" not in response_data:
+                continue
+
+            data = response_data["data"]
+            status = data.get("status")
+            if status == "success":
+                poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, status)
+                return extract_task_result(data)
+            elif status == "failed":
+                poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, status)
+                raise TaskFailedError(f"Task failed: {data.get('error', 'Unknown error')}")
+
+        poll_stats.record(task_uuid, schedule.polls, schedule.elapsed, "timeout")
+        raise Exception(f"Task timed out after {schedule.elapsed:.1f} seconds ({schedule.polls} polls)")
+
+    async def detect_objects(self, image, prompt_type="text", prompt_text=None, prompt_universal=None,
+                             targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None):
+        """
+        Detect objects in an image; like dinox_api.detect_objects, errors yield an empty result
+        """
+        try:
+            async with get_limiter("detection").async_task_slot():
+                task_uuid = await self.submit_detection(
+                    image, prompt_type, prompt_text, prompt_universal,
+                    targets, bbox_threshold, iou_threshold, session_id
+                )
+                return await self.get_task_result(task_uuid)
+        except Exception:
+            logger.exception("检测过程中出错")
+            return {"objects": []}, session_id
+
+    async def get_region_descriptions(self, image, regions, targets=["caption"], prompt_type=None,
+                                      prompt_text=None, prompt_universal=None, session_id=None):
+        """
+        Get descriptions for regions; like dinox_api.get_region_descriptions, errors yield an empty result
+        """
+        try:
+            async with get_limiter("region_vl").async_task_slot():
+                task_uuid = await self.submit_region_vl(
+                    image, regions, targets, prompt_type, prompt_text, prompt_universal, session_id
+                )
+                return await self.get_task_result(task_uuid)
+        except Exception:
+            logger.exception("Error in get_region_descriptions")
+            return {"objects": []}, session_id
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
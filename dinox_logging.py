@@ -0,0 +1,118 @@
+"""
+Logging for the DINO-X client modules
+分级、惰性格式化的日志：默认级别（WARNING）下热路径上的调试信息不做任何格式化；
+逐次轮询的日志按比例采样；输出前统一脱敏（API令牌、base64图像数据）
+"""
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import threading
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# 日志级别（DEBUG / INFO / WARNING / ERROR），默认只输出警告和错误
+LOG_LEVEL = os.getenv("DINOX_LOG_LEVEL", "WARNING").upper()
+# 逐次轮询的日志只输出第1条以及此后每N条（0 表示只输出第1条）
+POLL_LOG_SAMPLE = int(os.getenv("DINOX_LOG_POLL_SAMPLE", "10"))
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+ROOT_LOGGER_NAME = "dinox"
+
+_DATA_URI_RE = re.compile(r"(data:[\w/.+-]+;base64,)([A-Za-z0-9+/=]{16,})")
+_TOKEN_FIELD_RE = re.compile(r"""(["']?(?:Token|token|api_token|Authorization)["']?\s*[:=]\s*["']?)([^"'\s,}]+)""")
+
+_secrets = set()
+_configure_lock = threading.Lock()
+_configured = False
+
+def register_secret(value):
+    """Make sure `value` never appears in log output"""
+    if value and len(value) >= 4:
+        _secrets.add(value)
+
+def redact(text):
+    """Mask API tokens and shorten base64 payloads in a formatted log message"""
+    text = _DATA_URI_RE.sub(lambda m: f"{m.group(1)}<{len(m.group(2))} chars>", text)
+    text = _TOKEN_FIELD_RE.sub(r"\1***", text)
+    token = os.getenv("DINOX_API_TOKEN")
+    for secret in _secrets | ({token} if token else set()):
+        if secret in text:
+            text = text.replace(secret, "***")
+    return text
+
+class RedactingFormatter(logging.Formatter):
+    """Formatter that redacts the final text, including tracebacks; runs only for emitted records"""
+    def format(self, record):
+        return redact(super().format(record))
+
+class LazyJSON:
+    """Serialize an object to JSON only if the log message is actually emitted"""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        try:
+            return json.dumps(self.obj, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            return repr(self.obj)
+
+class Truncated:
+    """Truncate a long string (e.g. a response body) only if the log message is actually emitted"""
+    __slots__ = ("text", "limit")
+
+    def __init__(self, text, limit=500):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        text = str(self.text)
+        if len(text) <= self.limit:
+            return text
+        return f"{text[:self.limit]}... ({len(text)} chars)"
+
+class LogSampler:
+    """
+    Let through the first message and then one in every `every` (thread-safe counter)
+    传入 n（例如轮询次数）时按 n 采样，否则使用内部计数
+    """
+    def __init__(self, every=None):
+        self.every = POLL_LOG_SAMPLE if every is None else every
+        self._counter = itertools.count(1)
+
+    def __call__(self, n=None):
+        if n is None:
+            n = next(self._counter)
+        return n == 1 or (self.every > 0 and n % self.every == 0)
+
+def configure_logging(level=None, stream=None):
+    """
+    Attach a redacting stream handler to the "dinox" logger and set its level
+    重复调用只更新级别；应用可以在此之后自行添加其他 handler
+    """
+    global _configured
+    with _configure_lock:
+        logger = logging.getLogger(ROOT_LOGGER_NAME)
+        level = (level or LOG_LEVEL)
+        logger.setLevel(level.upper() if isinstance(level, str) else level)
+        if not _configured:
+            handler = logging.StreamHandler(stream or sys.stderr)
+            handler.setFormatter(RedactingFormatter(LOG_FORMAT))
+            logger.addHandler(handler)
+            # 避免Streamlit等框架的根logger重复输出
+            logger.propagate = False
+            _configured = True
+    return logger
+
+def get_logger(name):
+    """Return the "dinox.<name>" logger, configuring the package logger on first use"""
+    if not _configured:
+        configure_logging()
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
@@ -0,0 +1,364 @@
+"""
+Image upload payloads
+上传图像的编码：原始JPEG/PNG文件字节直接透传（不解码、不重新压缩），编码结果按图像内容缓存
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+from PIL import Image
+
+from mask_codec import resize as resize_mask
+
+# Load environment variables
+load_dotenv()
+
+# numpy/PIL 图像重新编码为JPEG时的质量（PIL默认75）
+JPEG_QUALITY = int(os.getenv("DINOX_JPEG_QUALITY", "75"))
+# 按内容缓存的已编码payload数量
+PAYLOAD_CACHE_ITEMS = int(os.getenv("DINOX_PAYLOAD_CACHE_ITEMS", "8"))
+
+_MIME_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+]
+
+def sniff_mime(data):
+    """Detect JPEG/PNG from the file signature, or None"""
+    for signature, mime in _MIME_SIGNATURES:
+        if data[:len(signature)] == signature:
+            return mime
+    return None
+
+def hash_image(image):
+    """
+    Content hash of an image (numpy array, PIL Image, EncodedImage, raw bytes or base64/URL string)
+    """
+    if isinstance(image, EncodedImage):
+        return image.digest
+    h = hashlib.blake2b(digest_size=20)
+    if isinstance(image, np.ndarray):
+        h.update(f"ndarray:{image.shape}:{image.dtype.str}:".encode("ascii"))
+        h.update(np.ascontiguousarray(image).data)
+    elif isinstance(image, Image.Image):
+        h.update(f"pil:{image.mode}:{image.size}:".encode("ascii"))
+        h.update(image.tobytes())
+    elif isinstance(image, (bytes, bytearray, memoryview)):
+        h.update(b"bytes:")
+        h.update(image)
+    elif isinstance(image, str):
+        h.update(b"str:")
+        h.update(image.encode("utf-8"))
+    else:
+        raise TypeError(f"Unsupported image type for hashing: {type(image)}")
+    return h.hexdigest()
+
+def _to_data_uri(data, mime):
+    # 直接对内存视图做base64，避免额外的bytes拷贝
+    return f"data:{mime};base64,{base64.b64encode(data).decode('ascii')}"
+
+class EncodedImage:
+    """
+    An already encoded JPEG/PNG file that is uploaded as-is
+
+    data URI、内容哈希和解码后的数组都在首次使用时计算并缓存在对象上，
+    重试或重新分析同一张图像时不会重复编码。
+    """
+    def __init__(self, data, mime=None):
+        self.data = bytes(data)
+        self.mime = mime or sniff_mime(self.data)
+        if self.mime is None:
+            raise ValueError("EncodedImage only supports JPEG and PNG data")
+        self._data_uri = None
+        self._digest = None
+        self._size = None
+
+    @classmethod
+    def from_file(cls, file):
+        """Build from a path or a binary file-like object (e.g. a Streamlit UploadedFile)"""
+        if isinstance(file, str):
+            with open(file, "rb") as f:
+                return cls(f.read())
+        if hasattr(file, "getvalue"):
+            return cls(file.getvalue())
+        return cls(file.read())
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hash_image(self.data)
+        return self._digest
+
+    @property
+    def size(self):
+        """(width, height), read from the file header without decoding pixels"""
+        if self._size is None:
+            with Image.open(io.BytesIO(self.data)) as img:
+                self._size = img.size
+        return self._size
+
+    def data_uri(self):
+        if self._data_uri is None:
+            self._data_uri = _to_data_uri(self.data, self.mime)
+        return self._data_uri
+
+    def to_array(self):
+        """Decode to an RGB numpy array"""
+        with Image.open(io.BytesIO(self.data)) as img:
+            return np.array(img.convert("RGB"))
+
+    def __len__(self):
+        return len(self.data)
+
+class _PayloadCache:
+    """Small thread-safe LRU of data URIs keyed by image content hash"""
+    def __init__(self, max_items):
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+_payload_cache = _PayloadCache(PAYLOAD_CACHE_ITEMS)
+
+def encode_pil_image(image, quality=None):
+    """
+    Encode a PIL image as a JPEG data URI
+    """
+    if image.mode not in ("RGB", "L"):
+        # JPEG不支持透明通道和调色板模式
+        image = image.convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=quality or JPEG_QUALITY)
+    return _to_data_uri(buffered.getbuffer(), "image/jpeg")
+
+def encode_image(image, quality=None):
+    """
+    Convert an image to a base64 data URI for the API payload
+
+    - str：已经是 data URI / URL，原样返回
+    - EncodedImage / bytes：原始文件字节直接透传，不重新压缩
+    - numpy 数组 / PIL 图像：编码为JPEG，结果按内容哈希缓存
+    """
+    if isinstance(image, str):
+        return image
+    if isinstance(image, EncodedImage):
+        return image.data_uri()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return EncodedImage(image).data_uri()
+
+    key = (hash_image(image), quality or JPEG_QUALITY)
+    cached = _payload_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    data_uri = encode_pil_image(image, quality)
+    _payload_cache.put(key, data_uri)
+    return data_uri
+
+# ---- 上传前缩放 ----
+
+# 默认上传尺寸上限（未设置时不缩放）
+UPLOAD_MAX_SIDE = int(os.getenv("DINOX_UPLOAD_MAX_SIDE", "0")) or None
+UPLOAD_MAX_PIXELS = int(os.getenv("DINOX_UPLOAD_MAX_PIXELS", "0")) or None
+
+class UploadPolicy:
+    """
+    Downscale images larger than `max_side` (longest side) or `max_pixels` (width * height) before upload
+    """
+    def __init__(self, max_side=None, max_pixels=None):
+        self.max_side = max_side
+        self.max_pixels = max_pixels
+
+    @property
+    def active(self):
+        return bool(self.max_side or self.max_pixels)
+
+    def target_size(self, width, height):
+        """Size to upload at, or None if the image is already within limits"""
+        scale = 1.0
+        if self.max_side and max(width, height) > self.max_side:
+            scale = min(scale, self.max_side / float(max(width, height)))
+        if self.max_pixels and width * height > self.max_pixels:
+            scale = min(scale, (self.max_pixels / float(width * height)) ** 0.5)
+        if scale >= 1.0:
+            return None
+        return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+    def cache_params(self):
+        """Policy description included in result cache keys"""
+        return {"max_side": self.max_side, "max_pixels": self.max_pixels} if self.active else None
+
+    def __repr__(self):
+        return f"UploadPolicy(max_side={self.max_side}, max_pixels={self.max_pixels})"
+
+DEFAULT_UPLOAD_POLICY = UploadPolicy(UPLOAD_MAX_SIDE, UPLOAD_MAX_PIXELS)
+
+def _base64_length(n):
+    return (n + 2) // 3 * 4
+
+class UploadStats:
+    """Thread-safe totals of upload bytes before/after downscaling"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.downscaled = 0
+        self.uploaded_bytes = 0
+        self.bytes_saved = 0
+        self.last = None
+
+    def record(self, entry):
+        with self._lock:
+            self.requests += 1
+            self.uploaded_bytes += entry["uploaded_bytes"]
+            if entry["scale"] != (1.0, 1.0):
+                self.downscaled += 1
+                self.bytes_saved += entry["bytes_saved"] or 0
+            self.last = entry
+
+    def summary(self):
+        with self._lock:
+            return {"requests": self.requests, "downscaled": self.downscaled,
+                    "uploaded_bytes": self.uploaded_bytes, "bytes_saved": self.bytes_saved,
+                    "last": self.last}
+
+upload_stats = UploadStats()
+
+def decode_to_array(image):
+    """
+    Pixels of an image input as a numpy array (numpy array, PIL Image, EncodedImage, raw file bytes or a file path)
+
+    分块检测、拼图检测等需要按像素裁剪或拼接的场景使用；numpy输入原样返回
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, EncodedImage):
+        return image.to_array()
+    if isinstance(image, Image.Image):
+        return np.array(image.convert("RGB"))
+    if isinstance(image, (bytes, bytearray)):
+        with Image.open(io.BytesIO(image)) as img:
+            return np.array(img.convert("RGB"))
+    if isinstance(image, str) and os.path.exists(image):
+        with Image.open(image) as img:
+            return np.array(img.convert("RGB"))
+    raise ValueError(f"Cannot decode image pixels from {type(image).__name__}")
+
+def _image_size(image):
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    if isinstance(image, (Image.Image, EncodedImage)):
+        return image.size
+    return None
+
+def prepare_upload(image, policy=None):
+    """
+    Apply an upload policy to an image
+
+    返回 (image_data, (scale_x, scale_y), stats)：
+    - image_data 为实际上传图像的 data URI（未超限时即原图的编码结果）
+    - scale 为 原图坐标 / 上传图坐标，用于把返回结果映射回原图
+    - stats 包含上传字节数和节省的字节数（numpy输入的原始字节数按像素比例估算）
+    """
+    policy = policy or DEFAULT_UPLOAD_POLICY
+    size = _image_size(image) if policy.active else None
+    target = policy.target_size(*size) if size else None
+
+    if target is None:
+        image_data, scale = encode_image(image), (1.0, 1.0)
+        entry = {"original_size": size, "upload_size": size, "scale": scale,
+                 "uploaded_bytes": len(image_data), "bytes_saved": 0, "estimated": False}
+        upload_stats.record(entry)
+        return image_data, scale, entry
+
+    width, height = size
+    if isinstance(image, EncodedImage):
+        pil = Image.open(io.BytesIO(image.data))
+        # JPEG可以在DCT域直接按2的幂缩小解码，避免解码完整分辨率
+        pil.draft("RGB", target)
+    elif isinstance(image, np.ndarray):
+        pil = Image.fromarray(image)
+    else:
+        pil = image
+    if pil.mode not in ("RGB", "L"):
+        pil = pil.convert("RGB")
+    resized = pil.resize(target, Image.BILINEAR, reducing_gap=2.0)
+    scale = (width / float(target[0]), height / float(target[1]))
+
+    image_data = encode_pil_image(resized)
+    uploaded = len(image_data)
+    if isinstance(image, EncodedImage):
+        original, estimated = _base64_length(len(image.data)), False
+    else:
+        original, estimated = int(uploaded * scale[0] * scale[1]), True
+    entry = {"original_size": size, "upload_size": target, "scale": scale,
+             "uploaded_bytes": uploaded, "bytes_saved": max(0, original - uploaded),
+             "estimated": estimated}
+    upload_stats.record(entry)
+    return image_data, scale, entry
+
+def _rescale_keypoints(keypoints, sx, sy):
+    if not isinstance(keypoints, list) or not keypoints:
+        return keypoints
+    if isinstance(keypoints[0], dict):
+        for kp in keypoints:
+            if "x" in kp:
+                kp["x"] = kp["x"] * sx
+            if "y" in kp:
+                kp["y"] = kp["y"] * sy
+        return keypoints
+    if isinstance(keypoints[0], list):
+        for kp in keypoints:
+            if len(kp) >= 2:
+                kp[0] = kp[0] * sx
+                kp[1] = kp[1] * sy
+        return keypoints
+    # 扁平列表: [x1, y1, v1, s1, x2, y2, v2, s2, ...]
+    for i in range(0, len(keypoints) - 1, 4):
+        keypoints[i] = keypoints[i] * sx
+        keypoints[i + 1] = keypoints[i + 1] * sy
+    return keypoints
+
+def rescale_result(result, scale):
+    """
+    Map boxes, keypoints and masks of a result from upload coordinates back to the original image (in place)
+
+    掩码（COCO RLE）按最近邻放大到原图尺寸（上传尺寸 x scale），结果中的框和掩码使用同一坐标系
+    """
+    sx, sy = scale
+    if (sx, sy) == (1.0, 1.0) or not result:
+        return result
+    for obj in result.get("objects") or []:
+        bbox = obj.get("bbox")
+        if bbox and len(bbox) == 4:
+            obj["bbox"] = [bbox[0] * sx, bbox[1] * sy, bbox[2] * sx, bbox[3] * sy]
+        mask = obj.get("mask")
+        if isinstance(mask, dict) and mask.get("size") and mask.get("counts") is not None:
+            height, width = (int(v) for v in mask["size"])
+            target = max(1, int(round(height * sy))), max(1, int(round(width * sx)))
+            obj["mask"] = dict(mask, **resize_mask(mask, *target))
+        for key in ("pose_keypoints", "hand_keypoints"):
+            if obj.get(key):
+                obj[key] = _rescale_keypoints(obj[key], sx, sy)
+    return result
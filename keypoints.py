@@ -0,0 +1,107 @@
+"""
+Batched keypoint parsing and skeleton drawing
+姿态/手部关键点的批量处理：所有对象的关键点解析为一个 (N, K, 4) 数组，可见性用NumPy一次算出，
+所有骨架画在同一张图像上（按颜色分组批量调用 cv2.polylines），不再逐个对象复制图像
+"""
+import cv2
+import numpy as np
+
+from detection_result import as_detection_result, parse_keypoints
+
+# 姿态（COCO 17点）和手部（21点）关键点的连接关系
+POSE_CONNECTIONS = [
+    (0, 1), (0, 2), (1, 3), (2, 4),  # Face
+    (5, 7), (7, 9), (6, 8), (8, 10),  # Arms
+    (5, 6), (5, 11), (6, 12), (11, 12),  # Torso
+    (11, 13), (13, 15), (12, 14), (14, 16)  # Legs
+]
+HAND_CONNECTIONS = [
+    (0, 1), (1, 2), (2, 3), (3, 4),  # Thumb
+    (0, 5), (5, 6), (6, 7), (7, 8),  # Index finger
+    (0, 9), (9, 10), (10, 11), (11, 12),  # Middle finger
+    (0, 13), (13, 14), (14, 15), (15, 16),  # Ring finger
+    (0, 17), (17, 18), (18, 19), (19, 20)  # Pinky finger
+]
+CONNECTIONS = {"pose": POSE_CONNECTIONS, "hand": HAND_CONNECTIONS}
+
+# 置信度不高于该值的关键点视为不可见
+KEYPOINT_SCORE_THRESHOLD = 0.1
+
+def stack_keypoints(raw_keypoints):
+    """
+    Parse the keypoints of many objects into one array
+
+    Args:
+        raw_keypoints: 每个对象的原始关键点（任意API格式，或 None）
+
+    Returns:
+        (indices, keypoints): 有关键点的对象的位置，以及 (M, K, 4) float32 数组 [x, y, visible, score]；
+        各对象点数不同时用 0 补齐（补齐的点不可见）
+    """
+    indices = [i for i, kp in enumerate(raw_keypoints) if kp is not None and len(kp) > 0]
+    if not indices:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 0, 4), dtype=np.float32)
+    items = [raw_keypoints[i] for i in indices]
+    first = items[0]
+    # 常见情况：所有对象都是等长的扁平或嵌套数值列表，一次转换
+    if not isinstance(first, np.ndarray) and not (isinstance(first, list) and first and isinstance(first[0], dict)):
+        try:
+            array = np.asarray(items, dtype=np.float32)
+        except (ValueError, TypeError):
+            array = None
+        if array is not None and array.ndim >= 2 and array.shape[-1] >= 4 and array.ndim <= 3:
+            if array.ndim == 2:
+                array = array[:, :array.shape[1] // 4 * 4]
+            else:
+                array = array[..., :4]
+            return np.asarray(indices, dtype=np.int64), np.ascontiguousarray(array.reshape(len(items), -1, 4))
+    parsed = [parse_keypoints(kp) for kp in items]
+    stacked = np.zeros((len(parsed), max(len(p) for p in parsed), 4), dtype=np.float32)
+    for row, points in zip(stacked, parsed):
+        row[:len(points)] = points
+    return np.asarray(indices, dtype=np.int64), stacked
+
+def result_keypoints(result, kind="pose"):
+    """(indices, (M, K, 4) keypoints) of the pose ("pose") or hand ("hand") keypoints of a detection result"""
+    detections = as_detection_result(result)
+    if detections is None or not detections:
+        return stack_keypoints([])
+    return stack_keypoints(detections.pose_keypoints if kind == "pose" else detections.hand_keypoints)
+
+def visible_mask(keypoints, score_threshold=KEYPOINT_SCORE_THRESHOLD):
+    """(M, K) bool: keypoints marked visible with a score above the threshold"""
+    keypoints = np.asarray(keypoints, dtype=np.float32)
+    return (keypoints[..., 2] > 0) & (keypoints[..., 3] > score_threshold)
+
+def draw_skeletons(image, keypoints, connections, colors, radius=5, thickness=2,
+                   score_threshold=KEYPOINT_SCORE_THRESHOLD):
+    """
+    Draw the visible keypoints and skeleton lines of many objects onto `image` in place; returns the image
+
+    Args:
+        keypoints: (M, K, 4) 数组（stack_keypoints 的返回值）
+        connections: 连接的关键点下标对列表；超出点数的连接被忽略
+        colors: 每个对象的颜色（M 个图像通道顺序的元组），同色对象的连线在一次 cv2.polylines 中绘制
+    """
+    keypoints = np.asarray(keypoints, dtype=np.float32)
+    if keypoints.size == 0:
+        return image
+    visible = visible_mask(keypoints, score_threshold)
+    points = keypoints[..., :2].astype(np.int32)
+    colors = [tuple(int(c) for c in color) for color in colors]
+    groups = {}
+    for row, color in enumerate(colors):
+        groups.setdefault(color, []).append(row)
+
+    edges = np.asarray([c for c in connections or [] if max(c) < keypoints.shape[1]], dtype=np.int64).reshape(-1, 2)
+    for color, rows in groups.items():
+        rows = np.asarray(rows)
+        # 先画点再画线，与逐个对象绘制时的顺序相同
+        for x, y in points[rows][visible[rows]].tolist():
+            cv2.circle(image, (x, y), radius, color, -1)
+        if len(edges):
+            both = visible[rows][:, edges[:, 0]] & visible[rows][:, edges[:, 1]]
+            segments = np.stack([points[rows][:, edges[:, 0]], points[rows][:, edges[:, 1]]], axis=2)[both]
+            if len(segments):
+                cv2.polylines(image, list(segments.reshape(-1, 2, 1, 2)), False, color, thickness)
+    return image
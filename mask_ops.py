@@ -0,0 +1,200 @@
+"""
+Mask operations on COCO RLE without decoding
+直接在游程上计算掩码的面积、IoU、并集/交集、裁剪和外接框，不展开为整幅图像。
+游程按列优先排列，前景像素集合表示为有序的半开区间 [start, end)（以像素的线性下标计），
+两个掩码的运算只需要合并两组区间端点，开销与游程数量成正比，与图像分辨率无关。
+"""
+import numpy as np
+
+from detection_result import as_detection_result
+from mask_codec import counts_to_string, rle_counts
+
+def _size(rle):
+    return tuple(int(v) for v in rle["size"])
+
+def intervals(rle):
+    """Sorted, non-touching foreground intervals (starts, ends) of an RLE dict, as int64 arrays"""
+    counts = np.clip(rle_counts(rle), 0, None)
+    height, width = _size(rle)
+    # 超出像素总数的游程截断（与 mask_codec.counts_to_mask 一致）
+    cumulative = np.cumsum(counts)
+    starts = np.minimum(cumulative - counts, height * width)[1::2]
+    ends = np.minimum(cumulative, height * width)[1::2]
+    keep = ends > starts
+    return _coalesce(starts[keep], ends[keep])
+
+def _coalesce(starts, ends):
+    # 首尾相接的区间合并为一个（中间出现长度为0的背景游程时）
+    if starts.size < 2:
+        return starts, ends
+    gap = starts[1:] != ends[:-1]
+    return starts[np.concatenate(([True], gap))], ends[np.concatenate((gap, [True]))]
+
+def _boundaries(starts, ends):
+    return np.stack([starts, ends], axis=1).ravel()
+
+def _inside(boundaries, points):
+    # 点之前（含）的端点个数为奇数时点在区间内
+    return (np.searchsorted(boundaries, points, side="right") & 1).astype(bool)
+
+def _combine(a, b, op):
+    """Apply a boolean `op` to two interval sets; returns the intervals of the result"""
+    bounds_a, bounds_b = _boundaries(*a), _boundaries(*b)
+    points = np.union1d(bounds_a, bounds_b)
+    if points.size < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    inside = op(_inside(bounds_a, points[:-1]), _inside(bounds_b, points[:-1]))
+    edges = np.diff(np.concatenate(([False], inside, [False])).astype(np.int8))
+    return points[np.flatnonzero(edges == 1)], points[np.flatnonzero(edges == -1)]
+
+def _from_intervals(starts, ends, size):
+    # 区间 -> 以背景游程开头的游程数组 -> 压缩RLE
+    height, width = size
+    counts = np.empty(2 * starts.size + 1, dtype=np.int64)
+    counts[0:-1:2] = starts - np.concatenate(([0], ends[:-1]))
+    counts[1::2] = ends - starts
+    counts[-1] = height * width - (ends[-1] if ends.size else 0)
+    if counts[-1] == 0 and counts.size > 1:
+        counts = counts[:-1]
+    return {"size": [height, width], "counts": counts_to_string(counts)}
+
+def _check_sizes(rles):
+    sizes = {_size(rle) for rle in rles}
+    if len(sizes) > 1:
+        raise ValueError(f"Masks have different sizes: {sorted(sizes)}")
+    return sizes.pop() if sizes else None
+
+def area(rle):
+    """Number of foreground pixels"""
+    starts, ends = intervals(rle)
+    return int((ends - starts).sum())
+
+def intersection_area(rle_a, rle_b):
+    _check_sizes([rle_a, rle_b])
+    starts, ends = _combine(intervals(rle_a), intervals(rle_b), np.logical_and)
+    return int((ends - starts).sum())
+
+def iou(rle_a, rle_b):
+    """Intersection over union of two masks of the same size (0 when both are empty)"""
+    inter = intersection_area(rle_a, rle_b)
+    union = area(rle_a) + area(rle_b) - inter
+    return inter / float(union) if union else 0.0
+
+def merge(rles, intersect=False):
+    """Union (or intersection) of masks of the same size, as a compressed RLE dict"""
+    rles = list(rles)
+    size = _check_sizes(rles)
+    if size is None:
+        raise ValueError("No masks to merge")
+    op = np.logical_and if intersect else np.logical_or
+    result = intervals(rles[0])
+    for rle in rles[1:]:
+        result = _combine(result, intervals(rle), op)
+    return _from_intervals(result[0], result[1], size)
+
+def to_bbox(rle):
+    """
+    Tight [x1, y1, x2, y2] box of the foreground (x2 / y2 exclusive, like the API boxes), or None when empty
+
+    跨越列边界的区间覆盖了前一列的底部和后一列的顶部
+    """
+    height, _ = _size(rle)
+    starts, ends = intervals(rle)
+    if starts.size == 0:
+        return None
+    first, last = starts // height, (ends - 1) // height
+    spans = first != last
+    top = np.where(spans, 0, starts % height)
+    bottom = np.where(spans, height, (ends - 1) % height + 1)
+    return [int(first.min()), int(top.min()), int(last.max()) + 1, int(bottom.max())]
+
+def crop(rle, x1, y1, x2, y2):
+    """The window [y1:y2, x1:x2] of a mask as a new RLE dict of size (y2 - y1, x2 - x1)"""
+    height, width = _size(rle)
+    x1, x2 = max(0, int(x1)), min(width, int(x2))
+    y1, y2 = max(0, int(y1)), min(height, int(y2))
+    crop_width, crop_height = max(0, x2 - x1), max(0, y2 - y1)
+    if crop_width == 0 or crop_height == 0:
+        return {"size": [crop_height, crop_width], "counts": counts_to_string([crop_height * crop_width])}
+    # 窗口本身也是一组区间：每列一段 [col * h + y1, col * h + y2)
+    columns = np.arange(x1, x2, dtype=np.int64) * height
+    starts, ends = _combine(intervals(rle), _coalesce(columns + y1, columns + y2), np.logical_and)
+    # 交集区间都在某一列的窗口内，平移到裁剪后的线性下标
+    column = starts // height
+    new_starts = (column - x1) * crop_height + (starts - column * height - y1)
+    return _from_intervals(*_coalesce(new_starts, new_starts + (ends - starts)), (crop_height, crop_width))
+
+def areas(rles):
+    """(N,) int64 foreground areas; 0 where an entry is None"""
+    return np.asarray([area(rle) if rle is not None else 0 for rle in rles], dtype=np.int64)
+
+def pairwise_iou(rles_a, rles_b=None):
+    """
+    (len(a), len(b)) mask IoU matrix (b defaults to a); entries involving a missing mask are 0
+
+    先用外接框排除不相交的对，只对外接框重叠的对合并区间
+    """
+    rles_a = list(rles_a)
+    rles_b = rles_a if rles_b is None else list(rles_b)
+    present = [rle for rle in rles_a + rles_b if rle is not None]
+    _check_sizes(present)
+    parsed_a = [intervals(rle) if rle is not None else None for rle in rles_a]
+    parsed_b = parsed_a if rles_b is rles_a else [intervals(rle) if rle is not None else None for rle in rles_b]
+    boxes_a = _interval_boxes(rles_a)
+    boxes_b = boxes_a if rles_b is rles_a else _interval_boxes(rles_b)
+    area_a = np.asarray([(p[1] - p[0]).sum() if p is not None else 0 for p in parsed_a], dtype=np.float64)
+    area_b = area_a if rles_b is rles_a else np.asarray(
+        [(p[1] - p[0]).sum() if p is not None else 0 for p in parsed_b], dtype=np.float64)
+
+    overlaps = ((boxes_a[:, None, 0] < boxes_b[None, :, 2]) & (boxes_b[None, :, 0] < boxes_a[:, None, 2]) &
+                (boxes_a[:, None, 1] < boxes_b[None, :, 3]) & (boxes_b[None, :, 1] < boxes_a[:, None, 3]))
+    inter = np.zeros((len(rles_a), len(rles_b)), dtype=np.float64)
+    symmetric = rles_b is rles_a
+    for i, j in zip(*np.nonzero(np.triu(overlaps) if symmetric else overlaps)):
+        starts, ends = _combine(parsed_a[i], parsed_b[j], np.logical_and)
+        inter[i, j] = (ends - starts).sum()
+    if symmetric:
+        inter = np.maximum(inter, inter.T)
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1), 0.0)
+
+def _interval_boxes(rles):
+    # 没有掩码或空掩码的框设为空框，不与任何框重叠
+    boxes = np.zeros((len(rles), 4), dtype=np.int64)
+    for i, rle in enumerate(rles):
+        box = to_bbox(rle) if rle is not None else None
+        if box is not None:
+            boxes[i] = box
+    return boxes
+
+def mask_nms(rles, scores, iou_threshold):
+    """Greedy NMS on mask IoU; returns the kept indices, highest score first"""
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    order = np.argsort(-scores, kind="stable")
+    if len(order) == 0 or iou_threshold is None or iou_threshold >= 1:
+        return order
+    overlap = pairwise_iou(rles)
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        order = order[1:][overlap[i, order[1:]] <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+def category_coverage(result):
+    """
+    {category name: fraction of the image covered by the union of that category's masks}
+
+    result 可以是 DetectionResult、API结果字典或对象字典列表；没有掩码的对象不计入
+    """
+    detections = as_detection_result(result)
+    if detections is None or not detections:
+        return {}
+    names = detections.category_names("unknown")
+    coverage = {}
+    for name in sorted(set(names[detections.has_mask].tolist())):
+        rles = [detections.masks[i] for i in np.flatnonzero((names == name) & detections.has_mask).tolist()]
+        height, width = _check_sizes(rles)
+        coverage[name] = area(merge(rles)) / float(max(height * width, 1))
+    return coverage
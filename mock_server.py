@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the DINO-X API
+本地模拟 DINO-X 服务：实现 dinox_api.py 使用的三个接口，返回合成的检测框、掩码（COCO压缩RLE）和关键点，
+可配置排队延迟、处理时间分布、错误率和429注入，用于离线压测和延迟测试
+
+用法:
+    python mock_server.py --port 8600 --processing lognormal:0.0,0.5 --throttle-rate 0.05
+    DINOX_API_BASE=http://127.0.0.1:8600 DINOX_API_TOKEN=mock python run.py
+
+也可以在进程内启动（例如基准测试）:
+    with MockDinoXServer(MockConfig(queue_delay="uniform:0.1,0.3")) as server:
+        dinox_api.set_api_base(server.base_url)
+"""
+import argparse
+import base64
+import binascii
+import heapq
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mask_codec import counts_to_string
+
+DETECTION_PATH = "/v2/task/dinox/detection"
+REGION_VL_PATH = "/v2/task/dinox/region_vl"
+TASK_STATUS_PATH = "/v2/task_status/"
+STATS_PATH = "/mock/stats"
+
+DEFAULT_CATEGORIES = ["person", "car", "dog", "cat", "chair", "bottle", "cup", "bicycle"]
+POSE_KEYPOINTS = 17
+HAND_KEYPOINTS = 21
+
+class Distribution:
+    """
+    Random duration parsed from "kind:args"
+
+    - fixed:1.0            恒定值
+    - uniform:0.5,2.0      均匀分布
+    - exp:1.0              指数分布（均值）
+    - normal:1.0,0.2       正态分布（均值, 标准差），截断为非负
+    - lognormal:0.0,0.5    对数正态分布（mu, sigma）
+    """
+    KINDS = {"fixed": 1, "uniform": 2, "exp": 1, "normal": 2, "lognormal": 2}
+
+    def __init__(self, kind="fixed", *params):
+        if kind not in self.KINDS or len(params) != self.KINDS[kind]:
+            raise ValueError(f"Invalid distribution: {kind}{list(params)}")
+        self.kind = kind
+        self.params = [float(p) for p in params]
+
+    @classmethod
+    def parse(cls, spec):
+        if isinstance(spec, Distribution):
+            return spec
+        if isinstance(spec, (int, float)):
+            return cls("fixed", spec)
+        kind, _, args = str(spec).partition(":")
+        if not args:
+            return cls("fixed", kind)
+        return cls(kind, *args.split(","))
+
+    def sample(self, rng):
+        p = self.params
+        if self.kind == "fixed":
+            value = p[0]
+        elif self.kind == "uniform":
+            value = rng.uniform(p[0], p[1])
+        elif self.kind == "exp":
+            value = rng.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+        elif self.kind == "normal":
+            value = rng.gauss(p[0], p[1])
+        else:
+            value = rng.lognormvariate(p[0], p[1])
+        return max(0.0, value)
+
+    def __repr__(self):
+        return f"{self.kind}:{','.join(str(p) for p in self.params)}"
+
+class MockConfig:
+    """
+    Behaviour of the mock server
+
+    - queue_delay / processing: 排队时间和处理时间的分布（见 Distribution）
+    - capacity: 同时处理的任务数（0 表示不限），超出时任务在队列中等待，用于模拟服务端积压
+    - error_rate: 任意请求返回 500 的概率；throttle_rate: 返回 429 的概率
+    - max_rps: 每秒请求上限（超出返回 429 + Retry-After），0 表示不限
+    - failure_rate: 任务最终状态为 failed 的概率
+    - latency: 每个HTTP响应额外的网络延迟分布
+    - objects: 每张图像的合成对象数量范围 (min, max)
+    - token: 要求的 Token 请求头（None 表示接受任意非空令牌）
+    """
+    def __init__(self, queue_delay="fixed:0.2", processing="lognormal:-0.5,0.4", capacity=0,
+                 error_rate=0.0, throttle_rate=0.0, max_rps=0.0, failure_rate=0.0, latency="fixed:0",
+                 objects=(3, 8), token=None, retry_after=1.0, seed=None, task_ttl=600.0):
+        self.queue_delay = Distribution.parse(queue_delay)
+        self.processing = Distribution.parse(processing)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rps = max_rps
+        self.failure_rate = failure_rate
+        self.latency = Distribution.parse(latency)
+        self.objects = objects
+        self.token = token
+        self.retry_after = retry_after
+        self.seed = seed
+        self.task_ttl = task_ttl
+
+# ---- synthetic results ----
+
+def ellipse_rle(bbox, height, width):
+    """
+    COCO RLE (column-major run lengths) of the ellipse inscribed in `bbox`
+    按列解析计算，不生成整幅掩码
+    """
+    x0, y0, x1, y1 = bbox
+    cx, cy = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+    rx, ry = (x1 - x0) / 2.0, (y1 - y0) / 2.0
+    counts = []
+    zeros = 0
+    for x in range(width):
+        dx = (x + 0.5 - cx) / rx if rx > 0 else 2.0
+        if abs(dx) < 1.0:
+            dy = ry * math.sqrt(1.0 - dx * dx)
+            top = min(height, max(0, int(math.ceil(cy - dy - 0.5))))
+            bottom = min(height, max(0, int(math.floor(cy + dy - 0.5)) + 1))
+            if bottom > top:
+                counts += [zeros + top, bottom - top]
+                zeros = height - bottom
+                continue
+        zeros += height
+    counts.append(zeros)
+    return {"size": [height, width], "counts": counts_to_string(counts)}
+
+def _keypoints(rng, bbox, count):
+    x0, y0, x1, y1 = bbox
+    values = []
+    for _ in range(count):
+        visible = 2 if rng.random() > 0.15 else 0
+        values += [round(rng.uniform(x0, x1), 2), round(rng.uniform(y0, y1), 2), visible,
+                   round(rng.uniform(0.3, 1.0), 3) if visible else 0.0]
+    return values
+
+def _random_bbox(rng, width, height):
+    w = rng.uniform(0.08, 0.5) * width
+    h = rng.uniform(0.08, 0.5) * height
+    x0 = rng.uniform(0, width - w)
+    y0 = rng.uniform(0, height - h)
+    return [round(x0, 2), round(y0, 2), round(x0 + w, 2), round(y0 + h, 2)]
+
+def image_size(image):
+    """(width, height) of a base64 data URI image, read from the header; defaults to 1024x768"""
+    if isinstance(image, str) and image.startswith("data:") and "," in image:
+        try:
+            from PIL import Image
+            data = base64.b64decode(image.split(",", 1)[1])
+            with Image.open(io.BytesIO(data)) as img:
+                return img.size
+        except (ImportError, OSError, ValueError, binascii.Error):
+            pass
+    return 1024, 768
+
+def _categories(prompt):
+    prompt = prompt or {}
+    if prompt.get("type") == "text" and prompt.get("text"):
+        names = [name.strip() for name in re.split(r"[.,]", prompt["text"]) if name.strip()]
+        if names:
+            return names
+    return DEFAULT_CATEGORIES
+
+def synthetic_detection(rng, payload, object_range):
+    width, height = image_size(payload.get("image"))
+    targets = payload.get("targets") or ["bbox"]
+    threshold = float(payload.get("bbox_threshold", 0.25))
+    categories = _categories(payload.get("prompt"))
+    objects = []
+    for _ in range(rng.randint(*object_range)):
+        bbox = _random_bbox(rng, width, height)
+        obj = {
+            "category": rng.choice(categories),
+            "score": round(rng.uniform(max(threshold, 0.0), 1.0), 4),
+            "bbox": bbox,
+        }
+        if "mask" in targets:
+            obj["mask"] = ellipse_rle(bbox, height, width)
+        if "pose_keypoints" in targets:
+            obj["pose_keypoints"] = _keypoints(rng, bbox, POSE_KEYPOINTS)
+        if "hand_keypoints" in targets:
+            obj["hand_keypoints"] = _keypoints(rng, bbox, HAND_KEYPOINTS)
+        objects.append(obj)
+    return {"objects": objects}
+
+def synthetic_region_vl(rng, payload):
+    targets = payload.get("targets") or ["caption"]
+    objects = []
+    for i, region in enumerate(payload.get("regions") or []):
+        obj = {"bbox": region}
+        if "caption" in targets:
+            obj["caption"] = f"a synthetic caption for region {i}"
+        if "roc" in targets:
+            obj["roc"] = f"region {i}"
+        if "ocr" in targets:
+            obj["ocr"] = "".join(rng.choice("ABCDEFGH0123456789") for _ in range(6))
+        objects.append(obj)
+    return {"objects": objects}
+
+# ---- server ----
+
+class _MockState:
+    """Tasks, virtual worker pool, request rate window and counters (shared by handler threads)"""
+    def __init__(self, config):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.workers = [0.0] * config.capacity
+        self.window = []
+        self.counters = {"requests": 0, "tasks": 0, "polls": 0, "errors": 0, "throttled": 0,
+                         "failed": 0, "max_backlog": 0}
+
+    def _throttled(self, now):
+        if not self.config.max_rps:
+            return False
+        while self.window and self.window[0] <= now - 1.0:
+            heapq.heappop(self.window)
+        if len(self.window) >= self.config.max_rps:
+            return True
+        heapq.heappush(self.window, now)
+        return False
+
+    def admit(self):
+        """Return an injected (status_code, body) or None to process the request normally"""
+        config = self.config
+        with self.lock:
+            self.counters["requests"] += 1
+            if self._throttled(time.time()) or self.rng.random() < config.throttle_rate:
+                self.counters["throttled"] += 1
+                return 429, {"code": 429, "msg": "Too many requests"}
+            if self.rng.random() < config.error_rate:
+                self.counters["errors"] += 1
+                return 500, {"code": 500, "msg": "Injected server error"}
+        return None
+
+    def create_task(self, result):
+        config = self.config
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            queue_delay = config.queue_delay.sample(self.rng)
+            processing = config.processing.sample(self.rng)
+            start = now + queue_delay
+            if self.workers:
+                # 固定数量的虚拟工作者：任务排队直到有工作者空闲
+                start = max(start, heapq.heappop(self.workers))
+                heapq.heappush(self.workers, start + processing)
+            failed = self.rng.random() < config.failure_rate
+            task_uuid = str(uuid.uuid4())
+            self.tasks[task_uuid] = {
+                "created": now, "start": start, "done": start + processing,
+                "failed": failed, "result": result, "session_id": uuid.uuid4().hex,
+            }
+            self.counters["tasks"] += 1
+            backlog = sum(1 for task in self.tasks.values() if task["start"] > now)
+            self.counters["max_backlog"] = max(self.counters["max_backlog"], backlog)
+            return task_uuid
+
+    def task_status(self, task_uuid):
+        now = time.time()
+        with self.lock:
+            self.counters["polls"] += 1
+            task = self.tasks.get(task_uuid)
+            if task is None:
+                return None
+            data = {"uuid": task_uuid, "session_id": task["session_id"]}
+            if now < task["start"]:
+                data["status"] = "waiting"
+            elif now < task["done"]:
+                data["status"] = "running"
+            elif task["failed"]:
+                data["status"] = "failed"
+                data["error"] = "Injected task failure"
+                if not task.get("counted"):
+                    task["counted"] = True
+                    self.counters["failed"] += 1
+            else:
+                data["status"] = "success"
+                data["result"] = task["result"]
+            return data
+
+    def _expire(self, now):
+        cutoff = now - self.config.task_ttl
+        for task_uuid in [u for u, task in self.tasks.items() if task["done"] < cutoff]:
+            del self.tasks[task_uuid]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["tasks_tracked"] = len(self.tasks)
+        return stats
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "DinoXMock/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def _send(self, status, body, headers=None):
+        delay = self.state.config.latency.sample(self.state.rng)
+        if delay:
+            time.sleep(delay)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _check(self):
+        """Auth and fault injection; returns True if the request was already answered"""
+        token = self.headers.get("Token")
+        expected = self.state.config.token
+        if not token or (expected and token != expected):
+            self._send(401, {"code": 401, "msg": "Invalid token"})
+            return True
+        injected = self.state.admit()
+        if injected is not None:
+            status, body = injected
+            headers = {"Retry-After": str(self.state.config.retry_after)} if status == 429 else None
+            self._send(status, body, headers)
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if self.path not in (DETECTION_PATH, REGION_VL_PATH):
+            self._send(404, {"code": 404, "msg": f"Unknown endpoint {self.path}"})
+            return
+        if self._check():
+            return
+        try:
+            payload = json.loads(raw.decode("utf-8"))
+        except ValueError:
+            self._send(400, {"code": 400, "msg": "Invalid JSON body"})
+            return
+        if not payload.get("image") or not payload.get("model"):
+            self._send(200, {"code": 1, "msg": "Missing 'image' or 'model'"})
+            return
+        if self.path == REGION_VL_PATH and not payload.get("regions"):
+            self._send(200, {"code": 1, "msg": "Missing 'regions'"})
+            return
+        state = self.state
+        with state.lock:
+            rng = random.Random(state.rng.random())
+        if self.path == DETECTION_PATH:
+            result = synthetic_detection(rng, payload, state.config.objects)
+        else:
+            result = synthetic_region_vl(rng, payload)
+        task_uuid = state.create_task(result)
+        self._send(200, {"code": 0, "msg": "ok", "data": {"task_uuid": task_uuid}})
+
+    def do_GET(self):
+        if self.path == STATS_PATH:
+            self._send(200, self.state.stats())
+            return
+        if not self.path.startswith(TASK_STATUS_PATH):
+            self._send(404, {"code": 404, "msg": f"Unknown endpoint {self.path}"})
+            return
+        if self._check():
+            return
+        data = self.state.task_status(self.path[len(TASK_STATUS_PATH):])
+        if data is None:
+            self._send(200, {"code": 404, "msg": "Task not found"})
+            return
+        self._send(200, {"code": 0, "msg": "ok", "data": data})
+
+class MockDinoXServer:
+    """
+    Threaded mock server; use as a context manager or call start() / stop()
+    """
+    def __init__(self, config=None, host="127.0.0.1", port=0, verbose=False):
+        self.config = config or MockConfig()
+        self._httpd = ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.state = _MockState(self.config)
+        self._httpd.verbose = verbose
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stats(self):
+        return self._httpd.state.stats()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="dinox-mock", daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock DINO-X API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--queue-delay", default="fixed:0.2", help="排队时间分布，例如 uniform:0.1,0.5")
+    parser.add_argument("--processing", default="lognormal:-0.5,0.4", help="处理时间分布，例如 exp:1.0")
+    parser.add_argument("--capacity", type=int, default=0, help="同时处理的任务数（0 表示不限）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回500的概率")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="随机返回429的概率")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="每秒请求上限，超出返回429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="任务失败的概率")
+    parser.add_argument("--latency", default="fixed:0", help="每个响应额外的网络延迟分布")
+    parser.add_argument("--objects", default="3,8", help="每张图像的对象数量范围 min,max")
+    parser.add_argument("--token", default=None, help="要求的API令牌（默认接受任意令牌）")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="输出每个请求的访问日志")
+    args = parser.parse_args()
+
+    low, _, high = args.objects.partition(",")
+    config = MockConfig(
+        queue_delay=args.queue_delay, processing=args.processing, capacity=args.capacity,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate, max_rps=args.max_rps,
+        failure_rate=args.failure_rate, latency=args.latency,
+        objects=(int(low), int(high or low)), token=args.token, seed=args.seed,
+    )
+    server = MockDinoXServer(config, args.host, args.port, verbose=args.verbose)
+    print(f"Mock DINO-X API listening on {server.base_url}")
+    print(f"设置 DINOX_API_BASE={server.base_url} 让客户端使用模拟服务")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n服务已停止")
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
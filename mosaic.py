@@ -0,0 +1,185 @@
+"""
+Mosaic packing of small images
+把多张小图按货架（shelf）方式排布在一张画布上，一次检测任务处理多张图像；
+返回的对象按框的包含关系分回各自的原图，坐标平移回原图，跨越图像边界的框被丢弃
+"""
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from batch import detect_objects_batch
+from dinox_logging import get_logger
+from image_payload import decode_to_array
+from tiling import shift_objects
+
+# Load environment variables
+load_dotenv()
+
+logger = get_logger("mosaic")
+
+# 画布边长上限（像素）、图像之间的间隔、间隔的填充灰度
+MOSAIC_SIZE = int(os.getenv("DINOX_MOSAIC_SIZE", "1024"))
+MOSAIC_PADDING = int(os.getenv("DINOX_MOSAIC_PADDING", "16"))
+MOSAIC_FILL = int(os.getenv("DINOX_MOSAIC_FILL", "114"))
+# 框至少有这个比例的面积落在某张图像内才归属该图像，否则视为跨越边界而丢弃
+MOSAIC_CONTAINMENT = float(os.getenv("DINOX_MOSAIC_CONTAINMENT", "0.9"))
+
+class MosaicLayout:
+    """
+    Placement of some input images on one canvas
+
+    Attributes:
+        indices: 各图像在输入序列中的位置
+        boxes: (n, 4) int 数组，各图像在画布上的 [x1, y1, x2, y2]
+        width / height: 画布尺寸
+    """
+    __slots__ = ("indices", "boxes", "width", "height")
+
+    def __init__(self, indices, boxes, width, height):
+        self.indices = list(indices)
+        self.boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        self.width = width
+        self.height = height
+
+    @property
+    def fill_ratio(self):
+        """Fraction of the canvas covered by images (the rest is padding and unused space)"""
+        areas = (self.boxes[:, 2] - self.boxes[:, 0]) * (self.boxes[:, 3] - self.boxes[:, 1])
+        return float(areas.sum()) / max(self.width * self.height, 1)
+
+    def __len__(self):
+        return len(self.indices)
+
+def pack_shelves(sizes, canvas_size=None, padding=None):
+    """
+    Shelf-pack (width, height) sizes onto canvases no larger than canvas_size x canvas_size
+
+    按高度从大到小逐行（货架）放置；放不下的行开启新画布。超过画布尺寸的图像单独占一张画布（不缩放）。
+    返回 MosaicLayout 列表，画布高度裁剪到实际使用的高度。
+    """
+    canvas_size = canvas_size or MOSAIC_SIZE
+    padding = MOSAIC_PADDING if padding is None else padding
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0]))
+    layouts = []
+    current, x, y, shelf_height, used_width, used_height = [], padding, padding, 0, 0, 0
+
+    def flush():
+        if current:
+            indices, boxes = zip(*current)
+            layouts.append(MosaicLayout(indices, boxes, used_width + padding, used_height + padding))
+
+    for index in order:
+        width, height = sizes[index]
+        if width + 2 * padding > canvas_size or height + 2 * padding > canvas_size:
+            layouts.append(MosaicLayout([index], [[0, 0, width, height]], width, height))
+            continue
+        if x + width + padding > canvas_size:
+            # 当前行放不下：换行
+            x, y, shelf_height = padding, y + shelf_height + padding, 0
+        if y + height + padding > canvas_size:
+            # 当前画布放不下：新画布
+            flush()
+            current, x, y, shelf_height, used_width, used_height = [], padding, padding, 0, 0, 0
+        current.append((index, [x, y, x + width, y + height]))
+        used_width = max(used_width, x + width)
+        used_height = max(used_height, y + height)
+        shelf_height = max(shelf_height, height)
+        x += width + padding
+    flush()
+    return layouts
+
+def _rgb(pixels):
+    if pixels.ndim == 2:
+        return np.stack([pixels] * 3, axis=-1)
+    return pixels[..., :3]
+
+def compose(layout, arrays, fill=None):
+    """Draw the images of a layout onto a uint8 RGB canvas"""
+    fill = MOSAIC_FILL if fill is None else fill
+    if len(layout) == 1 and (layout.width, layout.height) == (layout.boxes[0, 2], layout.boxes[0, 3]):
+        # 单独占一张画布的图像直接上传
+        return arrays[layout.indices[0]]
+    canvas = np.full((layout.height, layout.width, 3), fill, dtype=np.uint8)
+    for index, (x1, y1, x2, y2) in zip(layout.indices, layout.boxes.tolist()):
+        canvas[y1:y2, x1:x2] = _rgb(arrays[index])
+    return canvas
+
+def split_objects(objects, layout, containment=None):
+    """
+    Assign canvas objects to the images of a layout; returns {input index: objects in image coordinates}
+
+    每个框归属与其交集最大的图像；落在该图像内的面积比例低于 containment 的框（跨越边界或落在间隔中）被丢弃
+    """
+    containment = MOSAIC_CONTAINMENT if containment is None else containment
+    split = {index: [] for index in layout.indices}
+    boxed = [obj for obj in objects or [] if obj.get("bbox") and len(obj["bbox"]) == 4]
+    if not boxed:
+        return split
+    boxes = np.asarray([obj["bbox"] for obj in boxed], dtype=np.float64)
+    regions = layout.boxes.astype(np.float64)
+    # (对象数, 图像数) 的交集面积
+    top_left = np.maximum(boxes[:, None, :2], regions[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], regions[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    areas = np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+    owner = inter.argmax(axis=1)
+    fraction = inter[np.arange(len(boxed)), owner] / np.maximum(areas, 1e-12)
+    keep = fraction >= containment
+    dropped = int((~keep).sum())
+    if dropped:
+        logger.debug("Dropped %d object(s) crossing image borders in the mosaic", dropped)
+
+    for obj, region in zip((boxed[i] for i in np.flatnonzero(keep)), owner[keep].tolist()):
+        x1, y1, x2, y2 = layout.boxes[region].tolist()
+        local = shift_objects([obj], -x1, -y1)[0]
+        bbox = local["bbox"]
+        # 残余的越界部分裁剪到图像范围内
+        local["bbox"] = [min(max(bbox[0], 0), x2 - x1), min(max(bbox[1], 0), y2 - y1),
+                         min(max(bbox[2], 0), x2 - x1), min(max(bbox[3], 0), y2 - y1)]
+        split[layout.indices[region]].append(local)
+    return split
+
+def detect_objects_mosaic(images, prompt_type="text", prompt_text=None, prompt_universal=None,
+                          targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                          canvas_size=None, padding=None, containment=None, concurrency=None, upload_policy=None):
+    """
+    Detect objects in many small images with one task per packed canvas
+
+    参数与 detect_objects 相同，另外:
+        canvas_size / padding: 画布边长上限和图像之间的间隔
+        containment: 框归属某张图像所需的面积比例
+        concurrency: 同时在途的画布任务数
+
+    返回 (results, stats)：results 按输入顺序排列，每项与 detect_objects 的结果格式相同
+    （所在画布检测失败时包含 "error"）；stats 包含图像数、API调用数、每次调用的图像数和画布填充率。
+    画布上的掩码无法按图像拆分，不会保留在结果中。
+    """
+    arrays = [decode_to_array(image) for image in images]
+    layouts = pack_shelves([(a.shape[1], a.shape[0]) for a in arrays], canvas_size, padding)
+    canvases = (compose(layout, arrays) for layout in layouts)
+    results = [None] * len(arrays)
+    last_session_id = session_id
+
+    for index, result, new_session_id in detect_objects_batch(
+            canvases, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold, iou_threshold,
+            session_id, concurrency=concurrency, upload_policy=upload_policy):
+        layout = layouts[index]
+        if result.get("error"):
+            for image_index in layout.indices:
+                results[image_index] = {"objects": [], "error": result["error"]}
+            continue
+        for image_index, objects in split_objects(result.get("objects"), layout, containment).items():
+            results[image_index] = {"objects": objects}
+        last_session_id = new_session_id or last_session_id
+
+    stats = {
+        "images": len(arrays),
+        "api_calls": len(layouts),
+        "images_per_call": len(arrays) / float(len(layouts)) if layouts else 0.0,
+        "fill_ratio": [layout.fill_ratio for layout in layouts],
+        "session_id": last_session_id,
+    }
+    logger.info("Mosaic detection: %d image(s) in %d call(s)", stats["images"], stats["api_calls"])
+    return results, stats
@@ -0,0 +1,184 @@
+"""
+Polling policies for DINO-X task status
+任务状态轮询策略：短首次轮询、带抖动的指数退避、延迟上限、总截止时间，并支持服务端 Retry-After 提示
+"""
+import os
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# 默认轮询参数（可通过环境变量覆盖）
+DEFAULT_INITIAL_DELAY = float(os.getenv("DINOX_POLL_INITIAL_DELAY", "0.25"))
+DEFAULT_MULTIPLIER = float(os.getenv("DINOX_POLL_MULTIPLIER", "1.6"))
+DEFAULT_MAX_DELAY = float(os.getenv("DINOX_POLL_MAX_DELAY", "3.0"))
+DEFAULT_JITTER = float(os.getenv("DINOX_POLL_JITTER", "0.2"))
+DEFAULT_DEADLINE = float(os.getenv("DINOX_POLL_DEADLINE", "60"))
+
+class PollingPolicy:
+    """
+    Exponential backoff with jitter, a per-delay cap and a total deadline
+
+    delay(n) = min(max_delay, initial_delay * multiplier ** n) * U(1 - jitter, 1 + jitter)
+    """
+    def __init__(self, initial_delay=None, multiplier=None, max_delay=None, jitter=None,
+                 deadline=None, min_delay=0.05):
+        self.initial_delay = DEFAULT_INITIAL_DELAY if initial_delay is None else initial_delay
+        self.multiplier = DEFAULT_MULTIPLIER if multiplier is None else multiplier
+        self.max_delay = DEFAULT_MAX_DELAY if max_delay is None else max_delay
+        self.jitter = DEFAULT_JITTER if jitter is None else jitter
+        self.deadline = DEFAULT_DEADLINE if deadline is None else deadline
+        self.min_delay = min_delay
+
+    @classmethod
+    def fixed(cls, interval, max_polls):
+        """
+        Policy equivalent to the old fixed `retry_interval` / `max_retries` loop
+        """
+        return cls(initial_delay=interval, multiplier=1.0, max_delay=interval, jitter=0.0,
+                   deadline=interval * max_polls, min_delay=0.0)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Delay in seconds before poll number `attempt` (0-based)
+        服务端给出 Retry-After 时，等待时间不小于该提示值
+        """
+        delay = min(self.max_delay, self.initial_delay * (self.multiplier ** attempt))
+        if self.jitter:
+            delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return max(self.min_delay, delay)
+
+    def start(self):
+        """Start a schedule for one task"""
+        return PollSchedule(self)
+
+    def __repr__(self):
+        return (f"PollingPolicy(initial_delay={self.initial_delay}, multiplier={self.multiplier}, "
+                f"max_delay={self.max_delay}, jitter={self.jitter}, deadline={self.deadline})")
+
+class PollSchedule:
+    """
+    Per-task polling state: counts polls and enforces the policy deadline
+    """
+    def __init__(self, policy):
+        self.policy = policy
+        self.started = time.monotonic()
+        self.polls = 0
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def remaining(self):
+        return self.policy.deadline - self.elapsed
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def next_delay(self, retry_after=None):
+        """
+        Delay before the next poll, clipped so that it never sleeps past the deadline
+        """
+        delay = self.policy.delay(self.polls, retry_after)
+        return max(0.0, min(delay, self.remaining()))
+
+    def wait(self, retry_after=None):
+        """
+        Sleep until the next poll; returns False if the deadline has already passed
+        """
+        if self.expired():
+            return False
+        time.sleep(self.next_delay(retry_after))
+        return not self.expired()
+
+    def record_poll(self):
+        self.polls += 1
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header (delta-seconds or HTTP-date) into seconds, or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at is None:
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(q / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+class PollStats:
+    """
+    Thread-safe record of how many polls (and how long) each task needed
+    用于根据真实的任务耗时分布调整轮询策略
+    """
+    def __init__(self, max_samples=1000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=max_samples)
+        self._by_task = OrderedDict()
+        self.max_samples = max_samples
+
+    def record(self, task_uuid, polls, elapsed, status):
+        entry = {"task_uuid": task_uuid, "polls": polls, "elapsed": elapsed, "status": status}
+        with self._lock:
+            self._samples.append(entry)
+            self._by_task[task_uuid] = entry
+            self._by_task.move_to_end(task_uuid)
+            while len(self._by_task) > self.max_samples:
+                self._by_task.popitem(last=False)
+        return entry
+
+    def get(self, task_uuid):
+        """Polling record for a recently finished task, or None"""
+        with self._lock:
+            return self._by_task.get(task_uuid)
+
+    def summary(self):
+        """
+        Aggregate polls / latency over the recent samples
+        """
+        with self._lock:
+            samples = list(self._samples)
+        polls = sorted(s["polls"] for s in samples)
+        elapsed = sorted(s["elapsed"] for s in samples)
+        statuses = {}
+        for s in samples:
+            statuses[s["status"]] = statuses.get(s["status"], 0) + 1
+        return {
+            "tasks": len(samples),
+            "statuses": statuses,
+            "polls_mean": sum(polls) / len(polls) if polls else None,
+            "polls_p50": _percentile(polls, 50),
+            "polls_p95": _percentile(polls, 95),
+            "polls_max": polls[-1] if polls else None,
+            "elapsed_p50": _percentile(elapsed, 50),
+            "elapsed_p95": _percentile(elapsed, 95),
+            "elapsed_p99": _percentile(elapsed, 99),
+        }
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._by_task.clear()
+
+# 进程级别的轮询统计
+poll_stats = PollStats()
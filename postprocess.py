@@ -0,0 +1,118 @@
+"""
+Client-side post-processing of detection results
+以较低的下限阈值请求一次，保留原始对象；之后的置信度阈值、类别筛选和按类别NMS都在本地用NumPy完成，不再调用API
+"""
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from detection_result import DetectionResult, as_detection_result
+
+# Load environment variables
+load_dotenv()
+
+# 向API请求时使用的 bbox_threshold 下限；界面上高于它的阈值都在本地过滤
+FLOOR_THRESHOLD = float(os.getenv("DINOX_FLOOR_THRESHOLD", "0.05"))
+# 本地NMS的默认IoU阈值（>= 1 表示不做NMS）
+NMS_IOU_THRESHOLD = float(os.getenv("DINOX_NMS_IOU", "1.0"))
+
+def request_threshold(threshold):
+    """bbox_threshold to send to the API so that `threshold` (and anything above it) can be applied locally"""
+    return min(FLOOR_THRESHOLD, threshold)
+
+def box_area(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+def box_iou(boxes_a, boxes_b):
+    """Pairwise IoU matrix (len(a), len(b)) of [x1, y1, x2, y2] boxes"""
+    a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+    union = box_area(a)[:, None] + box_area(b)[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+def nms(boxes, scores, iou_threshold, classes=None):
+    """
+    Greedy non-maximum suppression; returns the kept indices, highest score first
+
+    传入 classes 时按类别抑制：不同类别的框按类别编号平移到互不重叠的区域，一次NMS即可完成
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    order = np.argsort(-scores, kind="stable")
+    if iou_threshold is None or iou_threshold >= 1:
+        return order
+    if classes is not None:
+        offset = boxes.max() - min(boxes.min(), 0) + 1
+        boxes = boxes + (np.asarray(classes, dtype=np.float64) * offset)[:, None]
+
+    areas = box_area(boxes)
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        top_left = np.maximum(boxes[i, :2], boxes[rest, :2])
+        bottom_right = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        wh = np.clip(bottom_right - top_left, 0, None)
+        inter = wh[:, 0] * wh[:, 1]
+        union = areas[i] + areas[rest] - inter
+        iou = np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+def select_objects(detections, score_threshold=0.0, categories=None, iou_threshold=None, class_aware=True):
+    """
+    Indices of the objects that pass the score threshold, the category filter and NMS, in their original order
+
+    Args:
+        detections: DetectionResult、API结果字典或对象字典列表
+        score_threshold: 置信度阈值（没有置信度的对象不会被过滤）
+        categories: 保留的类别名（None 表示全部）
+        iou_threshold: NMS的IoU阈值（None 或 >= 1 表示不做NMS）
+        class_aware: True 时只在同一类别内抑制
+    """
+    detections = as_detection_result(detections)
+    if not detections:
+        return np.zeros(0, dtype=np.int64)
+    scores = detections.scores_or(1.0)
+    mask = scores >= np.float32(score_threshold)
+    if categories is not None:
+        wanted = [i for i, name in enumerate(detections.categories) if name in set(categories)]
+        mask &= np.isin(detections.category_ids, wanted)
+    candidates = np.flatnonzero(mask)
+    if iou_threshold is not None and iou_threshold < 1 and len(candidates) > 1:
+        # 没有边界框的对象不参与抑制
+        boxed = candidates[detections.has_box[candidates]]
+        kept = nms(detections.boxes[boxed], scores[boxed], iou_threshold,
+                   classes=detections.category_ids[boxed] + 1 if class_aware else None)
+        candidates = np.sort(np.concatenate([boxed[kept], candidates[~detections.has_box[candidates]]]))
+    return candidates
+
+def filter_result(result, score_threshold=0.0, categories=None, iou_threshold=None, class_aware=True):
+    """
+    The selected objects of `result`
+
+    传入 DetectionResult 时返回 DetectionResult 子集；传入结果字典时返回其副本，"objects" 只包含选中的对象（对象字典共享）
+    """
+    if isinstance(result, DetectionResult):
+        return result.take(select_objects(result, score_threshold, categories, iou_threshold, class_aware))
+    objects = (result or {}).get("objects") or []
+    indices = select_objects(objects, score_threshold, categories, iou_threshold, class_aware)
+    filtered = dict(result or {})
+    filtered["objects"] = [objects[i] for i in indices]
+    return filtered
+
+def category_names(result):
+    """Sorted category names present in a detection result"""
+    detections = as_detection_result(result)
+    if not detections:
+        return []
+    return sorted(detections.categories[i] for i in np.unique(detections.category_ids) if i >= 0)
@@ -0,0 +1,308 @@
+"""
+Client-side rate limiting for the DINO-X endpoints
+每个端点一个令牌桶（请求/秒）、在途任务数上限和熔断器；状态在进程内所有线程和事件循环之间共享
+"""
+import asyncio
+import contextlib
+import os
+import threading
+import time
+from collections import deque
+
+from dotenv import load_dotenv
+
+from dinox_logging import get_logger
+
+# Load environment variables
+load_dotenv()
+
+logger = get_logger("rate_limit")
+
+# 各端点的默认限额；可通过 DINOX_RATE_LIMIT / DINOX_RATE_BURST / DINOX_MAX_TASKS 统一覆盖，
+# 或加端点后缀单独覆盖（例如 DINOX_RATE_LIMIT_DETECTION）；0 表示不限制。
+# 创建任务的速率默认不限制（需要时设置 DINOX_RATE_LIMIT 开启），服务端的429仍会触发退避
+_ENDPOINT_DEFAULTS = {
+    "detection": {"rate": 0, "burst": 0, "max_tasks": 16},
+    "region_vl": {"rate": 0, "burst": 0, "max_tasks": 16},
+    "task_status": {"rate": 20.0, "burst": 20.0, "max_tasks": 0},
+}
+_SETTING_ENV = {"rate": "DINOX_RATE_LIMIT", "burst": "DINOX_RATE_BURST", "max_tasks": "DINOX_MAX_TASKS"}
+
+# 熔断器：连续失败次数阈值、熔断后等待多久再放行一次探测请求（秒）
+BREAKER_FAILURES = int(os.getenv("DINOX_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("DINOX_BREAKER_RESET", "30"))
+# 429 响应没有 Retry-After 时的退避时间（秒）
+THROTTLE_BACKOFF = float(os.getenv("DINOX_THROTTLE_BACKOFF", "1.0"))
+
+class CircuitOpenError(Exception):
+    """Raised instead of sending a request while an endpoint's circuit breaker is open"""
+    def __init__(self, endpoint, retry_after):
+        super().__init__(f"Circuit breaker for '{endpoint}' is open, retry in {retry_after:.1f}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class RateLimitError(Exception):
+    """Raised when the API keeps answering 429 after the allowed retries"""
+
+class TokenBucket:
+    """
+    Thread-safe token bucket with reservations
+
+    reserve() 立即扣除一个令牌并返回调用方需要等待的秒数（令牌可以透支），
+    因此同步线程（time.sleep）和事件循环（asyncio.sleep）可以共用同一个桶。
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = max(1.0, float(burst or self.rate or 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take one token; returns the delay (seconds) before the request may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            blocked = max(0.0, self._blocked_until - now)
+            if not self.rate:
+                return blocked
+            self._refill(now)
+            self._tokens -= 1
+            return max(blocked, -self._tokens / self.rate if self._tokens < 0 else 0.0)
+
+    def penalize(self, seconds):
+        """Hold back every caller for `seconds` (e.g. after a 429 with Retry-After)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.rate:
+                # 以透支令牌的方式暂停：恢复后仍按速率逐个放行，而不是所有等待者同时发出
+                self._refill(now)
+                self._tokens = min(self._tokens, -seconds * self.rate)
+            else:
+                self._blocked_until = max(self._blocked_until, now + seconds)
+
+class TaskSlots:
+    """
+    Limit on concurrently running tasks, shared by threads and event loops
+    """
+    def __init__(self, limit):
+        self.limit = int(limit or 0)
+        self.in_use = 0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    def _available(self):
+        return not self.limit or self.in_use < self.limit
+
+    def acquire(self, timeout=None):
+        with self._cond:
+            if not self._cond.wait_for(self._available, timeout):
+                raise TimeoutError("Timed out waiting for a free task slot")
+            self.in_use += 1
+
+    async def acquire_async(self):
+        while True:
+            with self._cond:
+                if self._available():
+                    self.in_use += 1
+                    return
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            # release() 唤醒后重新竞争名额
+            await waiter
+
+    def release(self):
+        with self._cond:
+            self.in_use = max(0, self.in_use - 1)
+            self._cond.notify()
+            waiters, self._async_waiters = self._async_waiters, deque()
+        for loop, waiter in waiters:
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # 等待者所在的事件循环已经关闭
+                pass
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker
+
+    - closed：正常放行，连续失败达到阈值后打开
+    - open：直接拒绝，`reset_timeout` 秒后进入 half_open
+    - half_open：只放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = BREAKER_FAILURES if failure_threshold is None else failure_threshold
+        self.reset_timeout = BREAKER_RESET_TIMEOUT if reset_timeout is None else reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probe_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Return 0 if a request may be sent now, otherwise the seconds until the next probe"""
+        if not self.failure_threshold:
+            return 0.0
+        with self._lock:
+            if self.state == "closed":
+                return 0.0
+            now = time.monotonic()
+            remaining = self._opened_at + self.reset_timeout - now
+            if remaining > 0:
+                return remaining
+            # 探测请求没有结果（例如调用方被取消）时，超过 reset_timeout 后允许新的探测
+            if self._probe_at is not None and now - self._probe_at < self.reset_timeout:
+                return self._probe_at + self.reset_timeout - now
+            self.state = "half_open"
+            self._probe_at = now
+            return 0.0
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("Circuit breaker closed")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failure_threshold
+                                             and self.failures >= self.failure_threshold):
+                if self.state == "closed":
+                    logger.warning("Circuit breaker opened after %d consecutive failures", self.failures)
+                self.state = "open"
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                self._probe_at = None
+
+class EndpointLimiter:
+    """
+    Rate limit, task limit and circuit breaker of one API endpoint
+    """
+    def __init__(self, name, rate=0, burst=None, max_tasks=0, breaker=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.slots = TaskSlots(max_tasks)
+        self.breaker = breaker or CircuitBreaker()
+        self.counters = {"requests": 0, "throttled": 0, "errors": 0, "rejected": 0, "waited": 0.0}
+        self._delay_logged = False
+        self._lock = threading.Lock()
+
+    def _admit(self):
+        remaining = self.breaker.check()
+        if remaining:
+            with self._lock:
+                self.counters["rejected"] += 1
+            raise CircuitOpenError(self.name, remaining)
+        delay = self.bucket.reserve()
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters["waited"] += delay
+            first_delay = delay > 0 and not self._delay_logged
+            if first_delay:
+                self._delay_logged = True
+        if first_delay:
+            # 只在第一次被客户端限流延迟时提示一次，说明吞吐受限于配置的速率
+            logger.info("Requests to '%s' are being delayed by the client-side rate limit (%.1f/s, burst %.0f)",
+                        self.name, self.bucket.rate, self.bucket.burst)
+        return delay
+
+    def before_request(self):
+        """Block until the request may be sent; raises CircuitOpenError while the breaker is open"""
+        delay = self._admit()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def before_request_async(self):
+        delay = self._admit()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record_response(self, status_code, retry_after=None):
+        if status_code == 429:
+            with self._lock:
+                self.counters["throttled"] += 1
+            self.bucket.penalize(retry_after or THROTTLE_BACKOFF)
+        elif status_code >= 500:
+            with self._lock:
+                self.counters["errors"] += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def record_error(self):
+        """Record a transport error (connection failure, timeout)"""
+        with self._lock:
+            self.counters["errors"] += 1
+        self.breaker.record_failure()
+
+    @contextlib.contextmanager
+    def task_slot(self, timeout=None):
+        """Hold one of the endpoint's concurrent task slots (submit until result)"""
+        self.slots.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    @contextlib.asynccontextmanager
+    async def async_task_slot(self):
+        await self.slots.acquire_async()
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update({"rate": self.bucket.rate, "tasks_in_flight": self.slots.in_use,
+                      "max_tasks": self.slots.limit, "breaker": self.breaker.state})
+        return stats
+
+def _endpoint_setting(endpoint, name):
+    env_name = _SETTING_ENV[name]
+    value = os.getenv(f"{env_name}_{endpoint.upper()}") or os.getenv(env_name)
+    if value:
+        return float(value)
+    return _ENDPOINT_DEFAULTS.get(endpoint, {}).get(name, 0)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(endpoint):
+    """
+    Return the process-wide EndpointLimiter of an endpoint ("detection", "region_vl", "task_status")
+    """
+    limiter = _limiters.get(endpoint)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(endpoint)
+            if limiter is None:
+                limiter = EndpointLimiter(
+                    endpoint,
+                    rate=_endpoint_setting(endpoint, "rate"),
+                    burst=_endpoint_setting(endpoint, "burst"),
+                    max_tasks=_endpoint_setting(endpoint, "max_tasks"),
+                )
+                _limiters[endpoint] = limiter
+    return limiter
+
+def limiter_stats():
+    """Stats of every limiter created so far, keyed by endpoint"""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,371 @@
+"""
+Cached, layered rendering of detection results
+可视化结果缓存：按图像内容和检测结果内容缓存分层渲染结果。
+掩码合成后的底图、边界框（含标签）、姿态关键点、手部关键点和描述各自是一层（矢量层以稀疏的像素下标 + 颜色 + 透明度保存），
+每个（图像, 结果）组合的每一层只绘制一次，切换显示选项时只需把启用的层叠加到底图的副本上
+（新结果的第一次渲染直接绘制，切换选项时才提取各层）；相同选项的最终图像和PNG编码也会被缓存。
+"""
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+
+from detection_result import as_detection_result
+from dinox_logging import get_logger
+from image_payload import hash_image
+from keypoints import CONNECTIONS, draw_skeletons, result_keypoints, visible_mask
+from visualization import _to_bgr, composite_masks, get_color, text_size, visualize_detection_results
+
+# Load environment variables
+load_dotenv()
+
+logger = get_logger("render_cache")
+
+# 是否启用渲染缓存、缓存的（图像, 结果）组合数、每个组合缓存的显示选项组合数
+RENDER_CACHE_ENABLED = os.getenv("DINOX_RENDER_CACHE_ENABLED", "1") == "1"
+RENDER_CACHE_ITEMS = int(os.getenv("DINOX_RENDER_CACHE_ITEMS", "4"))
+RENDER_CACHE_OUTPUTS = int(os.getenv("DINOX_RENDER_CACHE_OUTPUTS", "4"))
+
+# 矢量层的叠加顺序，以及各层对应的显示选项
+LAYER_ORDER = ("boxes", "pose", "hand", "captions")
+LAYER_OPTIONS = {"boxes": "show_bbox", "pose": "show_pose", "hand": "show_hand", "captions": "show_caption"}
+# 绘制区域外扩的像素数（线宽和抗锯齿边缘）
+DRAW_MARGIN = 3
+
+def result_fingerprint(detections):
+    """Content hash of a DetectionResult (filtered subsets are new objects on every rerun)"""
+    h = hashlib.blake2b(digest_size=16)
+    for array in (detections.boxes, detections.has_box, detections.scores, detections.category_ids):
+        h.update(np.ascontiguousarray(array).tobytes())
+    h.update("\x00".join(detections.categories).encode("utf-8"))
+    # 掩码的压缩字符串可能很长，只取其哈希（字符串对象会缓存自己的哈希值）
+    masks = [(tuple(m.get("size") or ()), hash(m["counts"]) if isinstance(m.get("counts"), (str, bytes))
+              else repr(m.get("counts"))) if isinstance(m, dict) else m for m in detections.masks]
+    h.update(repr((masks, detections.pose_keypoints, detections.hand_keypoints, detections.captions)).encode("utf-8"))
+    return h.hexdigest()
+
+def encode_png(image):
+    """PNG bytes of an RGB (or grayscale) uint8 image"""
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    ok, encoded = cv2.imencode(".png", image)
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return encoded.tobytes()
+
+def _bgr(color):
+    return tuple(_to_bgr(color))
+
+def _rect(xa, ya, xb, yb, pad=0):
+    # 两个角点 -> 外扩后的半开区域 (x0, y0, x1, y1)，由 _drawn_pixels 裁剪到图像范围内
+    margin = DRAW_MARGIN + pad
+    return (min(xa, xb) - margin, min(ya, yb) - margin, max(xa, xb) + margin + 1, max(ya, yb) + margin + 1)
+
+def _ragged_arange(starts, lengths):
+    # 连续区间 [start, start + length) 的下标依次拼接
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()), dtype=np.int64)
+
+def _drawn_pixels(black, white, rects):
+    """
+    (flat indices, black values, white values) of the pixels inside `rects` that differ from the blank canvases
+    (pixels in overlapping rects may repeat)
+
+    只检查绘制函数报告的区域（所有区域一次展开为像素下标），开销与绘制的面积成正比，而不是整幅图像
+    """
+    height, width = black.shape[:2]
+    rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+    x0, y0 = np.maximum(rects[:, 0], 0), np.maximum(rects[:, 1], 0)
+    x1, y1 = np.minimum(rects[:, 2], width), np.minimum(rects[:, 3], height)
+    valid = (x1 > x0) & (y1 > y0)
+    x0, y0, x1, y1 = x0[valid], y0[valid], x1[valid], y1[valid]
+    # 区域 -> 每一行的区间 -> 像素下标
+    rows = _ragged_arange(y0, y1 - y0)
+    rect_of_row = np.repeat(np.arange(len(x0)), y1 - y0)
+    candidates = _ragged_arange(rows * width + x0[rect_of_row], (x1 - x0)[rect_of_row])
+    # 区域可能重叠，重复的像素得到相同的值，叠加时重复写入不影响结果，因此不去重
+    b, w = np.take(black.reshape(-1, 3), candidates, axis=0), np.take(white.reshape(-1, 3), candidates, axis=0)
+    drawn = np.flatnonzero(((b[:, 0] | b[:, 1] | b[:, 2]) != 0) | ((w[:, 0] & w[:, 1] & w[:, 2]) != 255))
+    return np.take(candidates, drawn), np.take(b, drawn, axis=0), np.take(w, drawn, axis=0)
+
+class _Layer:
+    """
+    Pixels drawn by one layer (sparse overlay + alpha), recovered from drawing it on a black and on a white canvas
+
+    两张画布上颜色相同的像素是不透明的，直接拷贝；抗锯齿的边缘像素（OpenCV 的文字）按
+    result = black + below * (white - black) / 255 逐通道混合，与直接画在图像上的效果一致
+    """
+    __slots__ = ("indices", "values", "edge_indices", "edge_values", "edge_weights")
+
+    def __init__(self, indices, black, white):
+        # 白色画布上的像素不会比黑色画布暗，差值为 0 表示不透明
+        spread = white - black
+        opaque = (spread[:, 0] | spread[:, 1] | spread[:, 2]) == 0
+        self.indices = indices[opaque]
+        self.values = black[opaque]
+        self.edge_indices = indices[~opaque]
+        self.edge_values = black[~opaque].astype(np.float32)
+        self.edge_weights = spread[~opaque].astype(np.float32) / 255.0
+
+    def apply(self, image):
+        flat = image.reshape(-1, image.shape[-1])
+        if self.edge_indices.size:
+            below = flat[self.edge_indices].astype(np.float32)
+            flat[self.edge_indices] = np.clip(self.edge_values + below * self.edge_weights + 0.5, 0, 255)
+        flat[self.indices] = self.values
+        return image
+
+# 各层的绘制函数：画在画布上，返回覆盖所有绘制像素的区域列表
+
+def _draw_boxes(canvas, detections):
+    # 边界框和标签按对象依次绘制，与 draw_bbox 的样式和重叠顺序相同
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    categories = detections.category_names("object").tolist()
+    scores = detections.scores_or(1.0).tolist()
+    rects = []
+    for i in np.flatnonzero(detections.has_box).tolist():
+        x1, y1, x2, y2 = map(int, detections.boxes[i].tolist())
+        color = _bgr(get_color(i))
+        cv2.rectangle(canvas, (x1, y1), (x2, y2), color, 2)
+        text = f"{categories[i]} {scores[i]:.2f}"
+        (text_width, text_height), baseline = text_size(text, font, 0.5, 1)
+        cv2.rectangle(canvas, (x1, y1 - text_height - 5), (x1 + text_width, y1), color, -1)
+        cv2.putText(canvas, text, (x1, y1 - 5), font, 0.5, (255, 255, 255), 1)
+        # 框只报告四条边，标签报告文字区域
+        rects += [_rect(x1, y1, x2, y1), _rect(x1, y2, x2, y2), _rect(x1, y1, x1, y2), _rect(x2, y1, x2, y2),
+                  _rect(x1, y1 - text_height - 5, x1 + text_width, y1 + baseline)]
+    return rects
+
+def _draw_keypoint_layer(kind, connections):
+    def draw(canvas, detections):
+        indices, points = result_keypoints(detections, kind)
+        draw_skeletons(canvas, points, connections, [_bgr(get_color(i)) for i in indices.tolist()])
+        # 只画可见的点和两端都可见的连线，都在可见点的外接框内（外扩点的半径）
+        rects = []
+        for row, visible in zip(points[..., :2].astype(np.int32), visible_mask(points)):
+            if visible.any():
+                (xa, ya), (xb, yb) = row[visible].min(axis=0).tolist(), row[visible].max(axis=0).tolist()
+                rects.append(_rect(xa, ya, xb, yb, pad=5))
+        return rects
+    return draw
+
+def _draw_captions(canvas, detections):
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    rects = []
+    for i, caption in enumerate(detections.captions):
+        if not caption:
+            continue
+        if detections.has_box[i]:
+            x, y = int(detections.boxes[i, 0]), int(detections.boxes[i, 1])
+        else:
+            x, y = 10, 10 + i * 20
+        cv2.putText(canvas, caption, (x, y - 10), font, 0.5, _bgr(get_color(i)), 2)
+        (text_width, text_height), baseline = text_size(caption, font, 0.5, 2)
+        rects.append(_rect(x, y - 10 - text_height, x + text_width, y - 10 + baseline, pad=2))
+    return rects
+
+_LAYER_DRAWERS = {
+    "boxes": _draw_boxes,
+    "pose": _draw_keypoint_layer("pose", CONNECTIONS["pose"]),
+    "hand": _draw_keypoint_layer("hand", CONNECTIONS["hand"]),
+    "captions": _draw_captions,
+}
+
+class _Entry:
+    __slots__ = ("detections", "base", "layers", "outputs", "lock")
+
+    def __init__(self, detections):
+        self.detections = detections
+        self.base = None
+        self.layers = {}
+        self.outputs = OrderedDict()
+        self.lock = threading.Lock()
+
+class RenderCache:
+    """
+    LRU of layered renders keyed by (image content, result content)
+
+    Streamlit 每次重跑都会重新解码上传的文件，得到新的数组，因此图像按内容识别：调用方可以传入 image_key
+    （例如上传文件字节的哈希，见 EncodedImage.digest），否则计算像素哈希（同一个数组对象只计算一次）。
+    返回的图像是只读的缓存数组，调用方需要修改时应先复制。
+    """
+    def __init__(self, max_items=None, max_outputs=None):
+        self.max_items = RENDER_CACHE_ITEMS if max_items is None else max_items
+        self.max_outputs = RENDER_CACHE_OUTPUTS if max_outputs is None else max_outputs
+        self._entries = OrderedDict()
+        self._digests = OrderedDict()
+        self._canvases = None
+        self._lock = threading.Lock()
+        self._canvas_lock = threading.Lock()
+        self.counters = {"hits": 0, "direct_renders": 0, "composites": 0, "layer_builds": 0, "entries": 0,
+                         "evictions": 0}
+
+    def _image_digest(self, image):
+        # 像素哈希按数组对象记忆，弱引用确认 id 没有被新的数组复用
+        with self._lock:
+            memo = self._digests.get(id(image))
+            if memo is not None and memo[0]() is image:
+                return memo[1]
+        digest = hash_image(image)
+        with self._lock:
+            self._digests[id(image)] = (weakref.ref(image), digest)
+            while len(self._digests) > max(self.max_items, 1) * 2:
+                self._digests.popitem(last=False)
+        return digest
+
+    def _entry(self, image, detections, image_key=None):
+        key = (image_key or self._image_digest(image), image.shape, result_fingerprint(detections))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry(detections)
+                self._entries[key] = entry
+                self.counters["entries"] += 1
+                while len(self._entries) > max(self.max_items, 1):
+                    self._entries.popitem(last=False)
+                    self.counters["evictions"] += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def _base(self, entry, image):
+        # 掩码层：合成了所有掩码的底图；没有掩码时直接使用原图
+        if not entry.detections.has_mask.any():
+            return image
+        if entry.base is None:
+            base = composite_masks(image.copy(), entry.detections)
+            base.flags.writeable = False
+            entry.base = base
+        return entry.base
+
+    def _layer(self, entry, image, name):
+        if name not in entry.layers:
+            shape = image.shape[:2] + (3,)
+            with self._canvas_lock:
+                # 黑、白两张画布按尺寸复用，每次用完后只把绘制过的区域恢复原值
+                if self._canvases is None or self._canvases[0].shape != shape:
+                    self._canvases = (np.zeros(shape, dtype=np.uint8), np.full(shape, 255, dtype=np.uint8))
+                black, white = self._canvases
+                rects = []
+                try:
+                    for canvas in (black, white):
+                        rects = _LAYER_DRAWERS[name](canvas, entry.detections)
+                except Exception:
+                    logger.exception("Error drawing %s layer", name)
+                    # 画了一半的画布无法确定绘制区域，直接丢弃
+                    self._canvases, rects = None, []
+                indices, black_values, white_values = _drawn_pixels(black, white, rects)
+                layer = _Layer(indices, black_values, white_values)
+                for x0, y0, x1, y1 in rects:
+                    black[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = 0
+                    white[max(y0, 0):max(y1, 0), max(x0, 0):max(x1, 0)] = 255
+            entry.layers[name] = layer
+            self.counters["layer_builds"] += 1
+        return entry.layers[name]
+
+    def _output(self, image, detections, options, image_key=None):
+        entry = self._entry(image, detections, image_key)
+        key = tuple(sorted(options.items()))
+        with entry.lock:
+            output = entry.outputs.get(key)
+            if output is not None:
+                entry.outputs.move_to_end(key)
+                self.counters["hits"] += 1
+                return output
+            base = self._base(entry, image) if options["show_mask"] else image
+            if not entry.outputs:
+                # 新结果的第一次渲染（例如拖动阈值滑块）直接画在底图的副本上，比提取各层更快；
+                # 同一结果切换到其他选项时才提取各层
+                overlays = {name: value for name, value in options.items() if name != "show_mask"}
+                rendered = visualize_detection_results(base, entry.detections, show_mask=False, **overlays)
+                self.counters["direct_renders"] += 1
+            else:
+                # 底图的副本上只叠加启用的层，各层每个（图像, 结果）组合只绘制一次
+                rendered = base.copy()
+                for name in LAYER_ORDER:
+                    if options[LAYER_OPTIONS[name]]:
+                        self._layer(entry, image, name).apply(rendered)
+                self.counters["composites"] += 1
+            rendered.flags.writeable = False
+            output = {"image": rendered, "png": None}
+            entry.outputs[key] = output
+            while len(entry.outputs) > max(self.max_outputs, 1):
+                entry.outputs.popitem(last=False)
+            return output
+
+    def render(self, image, detections, show_bbox=True, show_mask=True, show_pose=True, show_hand=True,
+               show_caption=True, image_key=None):
+        """
+        Rendered (read-only) image; options as in visualize_detection_results
+
+        image_key: 图像内容的标识（相同内容必须得到相同的键），省略时使用像素哈希
+        """
+        options = {"show_bbox": show_bbox, "show_mask": show_mask, "show_pose": show_pose,
+                   "show_hand": show_hand, "show_caption": show_caption}
+        return self._output(image, detections, options, image_key)["image"]
+
+    def render_png(self, image, detections, image_key=None, **options):
+        """PNG bytes of the rendered image (RGB input), encoded once per option set"""
+        options = {"show_bbox": True, "show_mask": True, "show_pose": True, "show_hand": True,
+                   "show_caption": True, **options}
+        output = self._output(image, detections, options, image_key)
+        if output["png"] is None:
+            output["png"] = encode_png(output["image"])
+        return output["png"]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["items"] = len(self._entries)
+        stats["text_size"] = text_size.cache_info()._asdict()
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._digests.clear()
+        with self._canvas_lock:
+            self._canvases = None
+
+_render_cache = None
+_render_cache_lock = threading.Lock()
+
+def get_render_cache():
+    """
+    Return the process-wide RenderCache, or None when disabled (DINOX_RENDER_CACHE_ENABLED=0)
+    """
+    global _render_cache
+    if not RENDER_CACHE_ENABLED:
+        return None
+    if _render_cache is None:
+        with _render_cache_lock:
+            if _render_cache is None:
+                _render_cache = RenderCache()
+    return _render_cache
+
+def _cacheable(image):
+    return isinstance(image, np.ndarray) and image.ndim == 3 and image.shape[2] == 3 and image.dtype == np.uint8
+
+def render_detection_results(image, objects, image_key=None, **options):
+    """
+    visualize_detection_results through the render cache (falls back to it when caching is off or not applicable)
+
+    image_key 见 RenderCache.render；返回的数组是只读的
+    """
+    cache = get_render_cache()
+    detections = as_detection_result(objects)
+    if cache is None or not _cacheable(image) or detections is None or not detections:
+        return visualize_detection_results(image, detections, **options)
+    return cache.render(image, detections, image_key=image_key, **options)
+
+def render_detection_png(image, objects, image_key=None, **options):
+    """PNG bytes of render_detection_results (cached when the render cache is enabled)"""
+    cache = get_render_cache()
+    detections = as_detection_result(objects)
+    if cache is None or not _cacheable(image) or detections is None or not detections:
+        return encode_png(visualize_detection_results(image, detections, **options))
+    return cache.render_png(image, detections, image_key=image_key, **options)
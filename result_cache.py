@@ -0,0 +1,244 @@
+"""
+Content-addressed cache for DINO-X task results
+检测结果缓存：键为图像内容哈希 + 规范化的请求参数；内存LRU层 + 磁盘层（按容量和TTL淘汰）
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from dinox_logging import get_logger
+from image_payload import hash_image
+
+# Load environment variables
+load_dotenv()
+
+# 缓存配置（可通过环境变量覆盖）
+CACHE_ENABLED = os.getenv("DINOX_CACHE_ENABLED", "1") == "1"
+CACHE_MEMORY_ITEMS = int(os.getenv("DINOX_CACHE_MEMORY_ITEMS", "256"))
+CACHE_DIR = os.getenv("DINOX_CACHE_DIR", os.path.join(".cache", "dinox_results"))
+CACHE_DISK_MAX_MB = float(os.getenv("DINOX_CACHE_DISK_MAX_MB", "512"))
+CACHE_TTL_SECONDS = float(os.getenv("DINOX_CACHE_TTL", str(7 * 24 * 3600)))
+
+logger = get_logger("cache")
+
+def _canonical_float(value):
+    return None if value is None else round(float(value), 6)
+
+def make_cache_key(kind, image_hash, params):
+    """
+    Combine an image hash and request parameters into a cache key
+    参数以排序后的JSON规范化，保证相同请求得到相同的键
+    """
+    canonical = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{kind}\n{image_hash}\n{canonical}".encode("utf-8"))
+    return h.hexdigest()
+
+def detection_cache_key(image, prompt, targets, bbox_threshold, iou_threshold, model, image_hash=None,
+                        upload=None):
+    """Cache key of a detection request (`upload` describes an active upload downscale policy)"""
+    params = {
+        "prompt": prompt,
+        "targets": sorted(targets),
+        "bbox_threshold": _canonical_float(bbox_threshold),
+        "iou_threshold": _canonical_float(iou_threshold),
+        "model": model,
+    }
+    if upload:
+        params["upload"] = upload
+    return make_cache_key("detection", image_hash or hash_image(image), params)
+
+def region_vl_cache_key(image, regions, targets, prompt, model, image_hash=None):
+    """Cache key of a region visual language request"""
+    params = {
+        "regions": [[_canonical_float(v) for v in region] for region in regions],
+        "targets": sorted(targets),
+        "prompt": prompt,
+        "model": model,
+    }
+    return make_cache_key("region_vl", image_hash or hash_image(image), params)
+
+class ResultCache:
+    """
+    Two-tier result cache: bounded in-memory LRU in front of an on-disk JSON store
+
+    值为 (result, session_id)；读取时返回副本，调用方修改结果不会影响缓存内容。
+    """
+    def __init__(self, max_memory_items=None, disk_dir=None, max_disk_bytes=None, ttl=None):
+        self.max_memory_items = CACHE_MEMORY_ITEMS if max_memory_items is None else max_memory_items
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes if max_disk_bytes is not None else int(CACHE_DISK_MAX_MB * 1024 * 1024)
+        self.ttl = CACHE_TTL_SECONDS if ttl is None else ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "puts": 0,
+                         "expired": 0, "evictions": 0}
+
+    # ---- public API ----
+
+    def get(self, key):
+        """Return the cached (result, session_id) or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self.ttl and now - entry["created"] > self.ttl:
+                    del self._memory[key]
+                    self.counters["expired"] += 1
+                else:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return copy.deepcopy(entry["value"])
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self.counters["disk_hits"] += 1
+            self._memory_put(key, entry)
+            return copy.deepcopy(entry["value"])
+
+    def put(self, key, result, session_id=None):
+        entry = {"created": time.time(), "value": (copy.deepcopy(result), session_id)}
+        with self._lock:
+            self.counters["puts"] += 1
+            self._memory_put(key, entry)
+        self._disk_put(key, entry)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_items"] = len(self._memory)
+            stats["disk_bytes"] = self._disk_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else None
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self.disk_dir and os.path.isdir(self.disk_dir):
+                for path, _, _ in self._disk_files():
+                    self._remove(path)
+            self._disk_bytes = 0
+
+    # ---- memory tier ----
+
+    def _memory_put(self, key, entry):
+        if self.max_memory_items <= 0:
+            return
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    # ---- disk tier ----
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if self.ttl and now - data.get("created", 0) > self.ttl:
+            with self._lock:
+                self.counters["expired"] += 1
+                self._remove(path)
+            return None
+        try:
+            # 更新访问时间，容量淘汰按最近访问顺序进行
+            os.utime(path, None)
+        except OSError:
+            pass
+        return {"created": data["created"], "value": (data["result"], data.get("session_id"))}
+
+    def _disk_put(self, key, entry):
+        if not self.disk_dir:
+            return
+        path = self._path(key)
+        result, session_id = entry["value"]
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"created": entry["created"], "result": result, "session_id": session_id}, f)
+            size = os.path.getsize(tmp_path)
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Failed to write result cache entry: %s", e)
+            return
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += size - old_size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _disk_files(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, st.st_size, st.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        # 先删除过期条目，再按最近访问时间从旧到新删除，直到低于容量上限的90%
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - self.ttl if self.ttl else None
+        target = self.max_disk_bytes * 0.9
+        for path, size, mtime in files:
+            if total <= target and (cutoff is None or mtime >= cutoff):
+                continue
+            if self._remove(path):
+                total -= size
+                self.counters["evictions"] += 1
+        self._disk_bytes = total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+def get_result_cache():
+    """
+    Return the process-wide ResultCache, or None when caching is disabled (DINOX_CACHE_ENABLED=0)
+    """
+    global _result_cache
+    if not CACHE_ENABLED:
+        return None
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ResultCache(disk_dir=CACHE_DIR or None)
+    return _result_cache
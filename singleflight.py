@@ -0,0 +1,89 @@
+"""
+Single-flight request coalescing
+相同请求（相同的图像内容和参数，即结果缓存键）同时在途时只执行一次，其余调用方等待并共享结果
+"""
+import asyncio
+import copy
+import threading
+from concurrent.futures import Future
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one execution
+
+    使用 concurrent.futures.Future 记录在途调用，因此同步线程（Streamlit会话）和
+    不同事件循环中的协程（批量检测）可以挂到同一个调用上。
+    每个调用方拿到结果的独立副本；执行失败时所有等待者收到同一个异常。
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"executed": 0, "coalesced": 0}
+
+    def _join(self, key):
+        """Return (future, is_leader)"""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.counters["coalesced"] += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self.counters["executed"] += 1
+            return future, True
+
+    def _complete(self, key, future, value=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            if not isinstance(error, Exception):
+                # 发起者被取消或中断：等待者收到普通异常，而不是把取消传播给它们
+                error = RuntimeError(f"Coalesced request was interrupted: {error!r}")
+            future.set_exception(error)
+        else:
+            # 等待者拿到的是副本，发起者之后修改自己的结果不会影响它们
+            future.set_result(copy.deepcopy(value))
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs), or wait for the identical call already in flight"""
+        if key is None:
+            return fn(*args, **kwargs)
+        future, leader = self._join(key)
+        if not leader:
+            return copy.deepcopy(future.result())
+        try:
+            value = fn(*args, **kwargs)
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, value)
+        return value
+
+    async def do_async(self, key, coro_fn, *args, **kwargs):
+        """Async counterpart of do(); `coro_fn` is a coroutine function"""
+        if key is None:
+            return await coro_fn(*args, **kwargs)
+        future, leader = self._join(key)
+        if not leader:
+            # shield：一个等待者被取消不会取消共享的调用
+            return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(future)))
+        try:
+            value = await coro_fn(*args, **kwargs)
+        except BaseException as e:
+            self._complete(key, future, error=e)
+            raise
+        self._complete(key, future, value)
+        return value
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._calls)
+        return stats
+
+# 进程内共享（键已包含请求类型，检测和区域描述共用一个实例）
+inflight_requests = SingleFlight()
@@ -0,0 +1,227 @@
+"""
+Durable journal of submitted DINO-X tasks
+SQLite任务日志：记录已提交任务的UUID、输入哈希和请求参数；进程重启后恢复未完成的任务，结果写入结果缓存
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from dinox_logging import get_logger
+
+# Load environment variables
+load_dotenv()
+
+logger = get_logger("journal")
+
+JOURNAL_ENABLED = os.getenv("DINOX_JOURNAL_ENABLED", "1") == "1"
+JOURNAL_PATH = os.getenv("DINOX_JOURNAL_PATH", os.path.join(".cache", "dinox_tasks.sqlite3"))
+# 超过这个时间仍未完成的任务不再恢复（秒）
+RECOVERY_MAX_AGE = float(os.getenv("DINOX_RECOVERY_MAX_AGE", str(24 * 3600)))
+# 已结束任务在日志中保留的时间（秒）
+JOURNAL_RETENTION = float(os.getenv("DINOX_JOURNAL_RETENTION", str(7 * 24 * 3600)))
+RECOVERY_WORKERS = int(os.getenv("DINOX_RECOVERY_WORKERS", "8"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_uuid TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    cache_key TEXT,
+    image_hash TEXT,
+    params TEXT,
+    scale TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, created);
+"""
+
+class TaskJournal:
+    """
+    SQLite-backed record of task UUIDs and their lifecycle (pending -> done / failed / expired)
+
+    一个连接 + 锁，在Streamlit会话线程、批量检测的线程池和恢复线程之间共享；WAL模式下写入很轻量
+    """
+    def __init__(self, path=None):
+        self.path = path or JOURNAL_PATH
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def record_submitted(self, task_uuid, kind, cache_key=None, image_hash=None, params=None, scale=(1.0, 1.0)):
+        now = time.time()
+        self._execute(
+            "INSERT OR REPLACE INTO tasks (task_uuid, kind, cache_key, image_hash, params, scale, status, "
+            "error, created, updated) VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, ?, ?)",
+            (task_uuid, kind, cache_key, image_hash, json.dumps(params, default=str), json.dumps(list(scale)),
+             now, now),
+        )
+
+    def finish(self, task_uuid, status="done", error=None):
+        self._execute("UPDATE tasks SET status = ?, error = ?, updated = ? WHERE task_uuid = ?",
+                      (status, error, time.time(), task_uuid))
+
+    def pending(self):
+        """Unfinished tasks, oldest first"""
+        rows = self._execute(
+            "SELECT task_uuid, kind, cache_key, image_hash, params, scale, created FROM tasks "
+            "WHERE status = 'pending' ORDER BY created"
+        )
+        return [
+            {"task_uuid": r[0], "kind": r[1], "cache_key": r[2], "image_hash": r[3],
+             "params": json.loads(r[4]) if r[4] else None, "scale": tuple(json.loads(r[5])) if r[5] else (1.0, 1.0),
+             "created": r[6]}
+            for r in rows
+        ]
+
+    def expire(self, max_age=None):
+        """Mark pending tasks older than `max_age` as expired; returns how many"""
+        cutoff = time.time() - (RECOVERY_MAX_AGE if max_age is None else max_age)
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE tasks SET status = 'expired', updated = ? WHERE status = 'pending' AND created < ?",
+                (time.time(), cutoff))
+            return cursor.rowcount
+
+    def purge(self, retention=None):
+        """Delete finished entries older than `retention` seconds"""
+        cutoff = time.time() - (JOURNAL_RETENTION if retention is None else retention)
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM tasks WHERE status != 'pending' AND updated < ?", (cutoff,))
+            return cursor.rowcount
+
+    def stats(self):
+        return {status: count for status, count in
+                self._execute("SELECT status, COUNT(*) FROM tasks GROUP BY status")}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def get_task_journal():
+    """
+    Return the process-wide TaskJournal, or None when disabled (DINOX_JOURNAL_ENABLED=0) or unavailable
+    """
+    global _journal
+    if not JOURNAL_ENABLED:
+        return None
+    if _journal is None:
+        with _journal_lock:
+            if _journal is None:
+                try:
+                    _journal = TaskJournal()
+                except (OSError, sqlite3.Error) as e:
+                    logger.warning("Task journal unavailable (%s): %s", JOURNAL_PATH, e)
+                    return None
+    return _journal
+
+def journal_call(method, *args, **kwargs):
+    """
+    Call a journal method if the journal is enabled; failures are logged and never break the request
+    """
+    journal = get_task_journal()
+    if journal is None:
+        return None
+    try:
+        return getattr(journal, method)(*args, **kwargs)
+    except sqlite3.Error as e:
+        logger.warning("Task journal %s failed: %s", method, e)
+        return None
+
+# ---- 启动恢复 ----
+
+def _resume(entry, cache):
+    # 延迟导入：dinox_api 在提交任务时写日志，这里反过来需要它的轮询函数
+    from dinox_api import TaskFailedError, task_kind, wait_for_task_result
+    from image_payload import rescale_result
+
+    task_uuid = entry["task_uuid"]
+    try:
+        result, session_id = wait_for_task_result(
+            task_uuid, kind=task_kind(entry["kind"], (entry["params"] or {}).get("targets")))
+    except TaskFailedError as e:
+        journal_call("finish", task_uuid, "failed", str(e))
+        raise
+    if entry["kind"] == "detection":
+        rescale_result(result, entry["scale"])
+    if cache is not None and entry["cache_key"]:
+        cache.put(entry["cache_key"], result, session_id)
+    journal_call("finish", task_uuid)
+    return result, session_id
+
+def recover_pending_tasks(journal=None, cache=None, workers=None):
+    """
+    Resume polling every unfinished task in the journal and store the results in the result cache
+
+    恢复期间的任务注册在 singleflight.inflight_requests 中，
+    同一时间重新提交的相同请求会直接等待恢复中的任务，而不是再创建一个新任务。
+    返回 {"recovered": n, "failed": n, "expired": n}
+    """
+    from result_cache import get_result_cache
+    from singleflight import inflight_requests
+
+    journal = journal or get_task_journal()
+    summary = {"recovered": 0, "failed": 0, "expired": 0}
+    if journal is None:
+        return summary
+    cache = cache if cache is not None else get_result_cache()
+    summary["expired"] = journal.expire()
+    journal.purge()
+    pending = journal.pending()
+    if not pending:
+        return summary
+    logger.info("Resuming %d unfinished task(s) from the journal", len(pending))
+
+    def resume(entry):
+        try:
+            inflight_requests.do(entry["cache_key"], _resume, entry, cache)
+            return True
+        except Exception as e:
+            logger.warning("Could not recover task %s: %s", entry["task_uuid"], e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers or RECOVERY_WORKERS, thread_name_prefix="dinox-recover") as executor:
+        for ok in executor.map(resume, pending):
+            summary["recovered" if ok else "failed"] += 1
+    logger.info("Task recovery finished: %s", summary)
+    return summary
+
+_recovery_thread = None
+_recovery_lock = threading.Lock()
+
+def start_task_recovery():
+    """
+    Run recover_pending_tasks once per process in a background thread (safe to call on every Streamlit rerun)
+    """
+    global _recovery_thread
+    if get_task_journal() is None:
+        return None
+    with _recovery_lock:
+        if _recovery_thread is None:
+            _recovery_thread = threading.Thread(target=_recover_safely, name="dinox-recovery", daemon=True)
+            _recovery_thread.start()
+    return _recovery_thread
+
+def _recover_safely():
+    try:
+        recover_pending_tasks()
+    except Exception:
+        logger.exception("Task recovery failed")
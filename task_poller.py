@@ -0,0 +1,183 @@
+"""
+Multiplexed task-status poller
+所有在途任务共用一个后台轮询服务：一个调度堆按"预计最先完成"的顺序轮询，并通过 Future 返回结果
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from dinox_api import (
+    DEFAULT_POLLING_POLICY, TaskFailedError, extract_task_result, get_default_client, poll_task_status
+)
+from dinox_logging import get_logger
+from polling import poll_stats
+
+# Load environment variables
+load_dotenv()
+
+# 同时进行的状态查询请求数（单个调度线程 + 少量I/O线程）
+DEFAULT_POLL_WORKERS = int(os.getenv("DINOX_POLL_WORKERS", "4"))
+
+logger = get_logger("poller")
+
+class _PendingTask:
+    __slots__ = ("task_uuid", "future", "schedule", "kind")
+
+    def __init__(self, task_uuid, schedule, kind=None):
+        self.task_uuid = task_uuid
+        self.future = Future()
+        self.schedule = schedule
+        self.kind = kind
+
+class TaskPoller:
+    """
+    Background service that tracks all outstanding task UUIDs and resolves a Future per task
+
+    - 首次轮询时间 = 提交时间 + 预计耗时（按端点和 targets 分别对最近完成任务的耗时做指数滑动平均），
+      不超过 policy.max_delay，避免一个慢任务把其他类型任务的首次轮询推得很晚
+    - 之后按 PollingPolicy 退避；所有任务按下次轮询时间排在同一个堆中
+    - Future 的结果与 get_task_result 相同：(result, session_id)
+    """
+    def __init__(self, client=None, policy=None, workers=None, smoothing=0.2):
+        self.client = client
+        self.policy = policy or DEFAULT_POLLING_POLICY
+        self.smoothing = smoothing
+        self.expected_latency = {}
+        self._heap = []
+        self._tasks = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers or DEFAULT_POLL_WORKERS,
+                                            thread_name_prefix="dinox-poll")
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="dinox-poller", daemon=True)
+        self._thread.start()
+
+    def _first_delay(self, kind):
+        latency = self.expected_latency.get(kind)
+        if latency is None:
+            return self.policy.initial_delay
+        # 略早于预计完成时间做首次轮询
+        cap = min(self.policy.deadline, max(self.policy.initial_delay, self.policy.max_delay))
+        return min(cap, max(self.policy.initial_delay, 0.8 * latency))
+
+    def _push(self, entry, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), entry))
+        self._cond.notify()
+
+    def submit(self, task_uuid, kind=None):
+        """
+        Start tracking a task; returns a concurrent.futures.Future of (result, session_id)
+        同一个任务重复提交时返回同一个 Future；kind（如 (端点, targets)）区分预计耗时的统计
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("TaskPoller has been shut down")
+            entry = self._tasks.get(task_uuid)
+            if entry is not None:
+                return entry.future
+            entry = _PendingTask(task_uuid, self.policy.start(), kind)
+            self._tasks[task_uuid] = entry
+            self._push(entry, self._first_delay(kind))
+            return entry.future
+
+    def wait(self, task_uuid, timeout=None, kind=None):
+        """Blocking equivalent of get_task_result(task_uuid)"""
+        return self.submit(task_uuid, kind).result(timeout)
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._tasks)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                if self._closed:
+                    return
+                _, _, entry = heapq.heappop(self._heap)
+            self._executor.submit(self._poll, entry)
+
+    def _poll(self, entry):
+        if entry.future.cancelled():
+            with self._cond:
+                self._tasks.pop(entry.task_uuid, None)
+            return
+        schedule = entry.schedule
+        schedule.record_poll()
+        try:
+            status, data, retry_after = poll_task_status(entry.task_uuid, self.client or get_default_client())
+            if status == "success":
+                poll_stats.record(entry.task_uuid, schedule.polls, schedule.elapsed, status)
+                self._observe_latency(entry.kind, schedule.elapsed)
+                self._finish(entry, result=extract_task_result(data))
+                return
+            if status == "failed":
+                poll_stats.record(entry.task_uuid, schedule.polls, schedule.elapsed, status)
+                self._finish(entry, error=TaskFailedError(f"Task failed: {data.get('error', 'Unknown error')}"))
+                return
+        except Exception as e:
+            # 查询本身出错（非任务失败）时继续按策略重试
+            logger.warning("Error polling task %s: %s", entry.task_uuid, e)
+            retry_after = None
+
+        if schedule.expired():
+            poll_stats.record(entry.task_uuid, schedule.polls, schedule.elapsed, "timeout")
+            self._finish(entry, error=Exception(
+                f"Task timed out after {schedule.elapsed:.1f} seconds ({schedule.polls} polls)"))
+            return
+        with self._cond:
+            if not self._closed:
+                self._push(entry, schedule.next_delay(retry_after))
+
+    def _observe_latency(self, kind, elapsed):
+        with self._cond:
+            latency = self.expected_latency.get(kind)
+            if latency is None:
+                self.expected_latency[kind] = elapsed
+            else:
+                self.expected_latency[kind] = latency + self.smoothing * (elapsed - latency)
+
+    def _finish(self, entry, result=None, error=None):
+        with self._cond:
+            self._tasks.pop(entry.task_uuid, None)
+        if entry.future.done():
+            return
+        if error is not None:
+            entry.future.set_exception(error)
+        else:
+            entry.future.set_result(result)
+
+    def shutdown(self):
+        """Stop polling; outstanding futures fail with RuntimeError"""
+        with self._cond:
+            self._closed = True
+            pending = list(self._tasks.values())
+            self._tasks.clear()
+            self._heap.clear()
+            self._cond.notify_all()
+        for entry in pending:
+            if not entry.future.done():
+                entry.future.set_exception(RuntimeError("TaskPoller has been shut down"))
+        self._executor.shutdown(wait=False)
+
+_shared_poller = None
+_shared_poller_lock = threading.Lock()
+
+def get_shared_poller():
+    """
+    Return the process-wide TaskPoller, starting it on first use
+    """
+    global _shared_poller
+    if _shared_poller is None:
+        with _shared_poller_lock:
+            if _shared_poller is None:
+                _shared_poller = TaskPoller()
+    return _shared_poller
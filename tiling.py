@@ -0,0 +1,204 @@
+"""
+Tiled (sliced) detection for large images
+大图分块检测：把图像切成相互重叠的小块，通过批量检测流水线并发提交，
+把各块的框平移回原图坐标，再用NMS或加权框融合合并接缝处的重复检测
+"""
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+from batch import DEFAULT_BATCH_CONCURRENCY, detect_objects_batch
+from detection_result import DetectionResult, parse_keypoints
+from dinox_logging import get_logger
+from image_payload import UploadPolicy, decode_to_array, prepare_upload, rescale_result
+from postprocess import box_area
+
+# Load environment variables
+load_dotenv()
+
+logger = get_logger("tiling")
+
+# 分块边长（像素）、相邻分块的重叠比例
+TILE_SIZE = int(os.getenv("DINOX_TILE_SIZE", "1024"))
+TILE_OVERLAP = float(os.getenv("DINOX_TILE_OVERLAP", "0.2"))
+# 同时在途的分块任务数
+TILE_CONCURRENCY = int(os.getenv("DINOX_TILE_CONCURRENCY", str(DEFAULT_BATCH_CONCURRENCY)))
+# 合并方式（nms / wbf）、重叠度量（iou / ios，ios = 交集 / 较小框面积）和阈值
+TILE_MERGE = os.getenv("DINOX_TILE_MERGE", "nms")
+TILE_MERGE_METRIC = os.getenv("DINOX_TILE_MERGE_METRIC", "ios")
+TILE_MERGE_THRESHOLD = float(os.getenv("DINOX_TILE_MERGE_THRESHOLD", "0.5"))
+# 是否额外检测一次整张图像（缩小后上传），用于跨越多个分块的大目标
+TILE_FULL_IMAGE = os.getenv("DINOX_TILE_FULL_IMAGE", "1") == "1"
+
+def tile_grid(width, height, tile_size=None, overlap=None):
+    """
+    (T, 4) int array of [x1, y1, x2, y2] tile windows covering the image
+
+    相邻分块重叠 overlap * tile_size 像素；最后一行/列的分块与图像边缘对齐，因此所有分块大小相同（图像比分块小时除外）
+    """
+    tile_size = tile_size or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be in [0, 1)")
+    stride = max(1, int(round(tile_size * (1 - overlap))))
+
+    def starts(length):
+        if length <= tile_size:
+            return np.zeros(1, dtype=np.int64)
+        positions = np.arange(0, length - tile_size, stride)
+        return np.append(positions, length - tile_size)
+
+    xs, ys = starts(width), starts(height)
+    x1, y1 = np.meshgrid(xs, ys)
+    x1, y1 = x1.ravel(), y1.ravel()
+    return np.stack([x1, y1, np.minimum(x1 + tile_size, width), np.minimum(y1 + tile_size, height)], axis=1)
+
+def _shift_keypoints(keypoints, dx, dy):
+    # 返回新的列表，保持原有格式（扁平 / 嵌套 / 字典列表）
+    if not isinstance(keypoints, list) or not keypoints:
+        return keypoints
+    if isinstance(keypoints[0], dict):
+        return [dict(kp, x=kp.get("x", 0) + dx, y=kp.get("y", 0) + dy) for kp in keypoints]
+    points = parse_keypoints(keypoints).astype(np.float64)
+    points[:, 0] += dx
+    points[:, 1] += dy
+    if isinstance(keypoints[0], list):
+        return points.tolist()
+    return points.ravel().tolist()
+
+def shift_objects(objects, dx, dy):
+    """Copies of `objects` with boxes and keypoints moved by (dx, dy); tile-local masks are dropped"""
+    shifted = []
+    for obj in objects or []:
+        obj = {k: v for k, v in obj.items() if k != "mask"}
+        bbox = obj.get("bbox")
+        if bbox and len(bbox) == 4:
+            obj["bbox"] = [bbox[0] + dx, bbox[1] + dy, bbox[2] + dx, bbox[3] + dy]
+        for key in ("pose_keypoints", "hand_keypoints"):
+            if obj.get(key):
+                obj[key] = _shift_keypoints(obj[key], dx, dy)
+        shifted.append(obj)
+    return shifted
+
+def box_overlap(box, boxes, metric="iou"):
+    """Overlap of one box with each of `boxes`: IoU, or intersection over the smaller box ("ios")"""
+    box = np.asarray(box, dtype=np.float64).reshape(4)
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    top_left = np.maximum(box[:2], boxes[:, :2])
+    bottom_right = np.minimum(box[2:], boxes[:, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    inter = wh[:, 0] * wh[:, 1]
+    area, areas = box_area(box)[0], box_area(boxes)
+    denominator = np.minimum(area, areas) if metric == "ios" else area + areas - inter
+    return np.where(denominator > 0, inter / np.maximum(denominator, 1e-12), 0.0)
+
+def merge_boxes(boxes, scores, classes, method=None, threshold=None, metric=None):
+    """
+    Merge duplicate boxes of the same class; returns (kept indices, merged boxes (len(kept), 4))
+
+    每一轮取剩余得分最高的框，把同类别且重叠度超过阈值的框归为一组：
+    nms 保留该框本身，wbf 使用组内按得分加权平均的坐标（适合被接缝截断的同一目标）
+    """
+    method = method or TILE_MERGE
+    threshold = TILE_MERGE_THRESHOLD if threshold is None else threshold
+    metric = metric or TILE_MERGE_METRIC
+    if method not in ("nms", "wbf"):
+        raise ValueError(f"Unknown merge method: {method}")
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+    classes = np.asarray(classes).reshape(-1)
+    order = np.argsort(-scores, kind="stable")
+    kept, merged = [], []
+    while order.size:
+        leader = order[0]
+        group = (classes[order] == classes[leader]) & (box_overlap(boxes[leader], boxes[order], metric) > threshold)
+        group[0] = True
+        members = order[group]
+        kept.append(leader)
+        if method == "wbf":
+            weights = scores[members][:, None]
+            merged.append((boxes[members] * weights).sum(axis=0) / max(weights.sum(), 1e-12))
+        else:
+            merged.append(boxes[leader])
+        order = order[~group]
+    return np.asarray(kept, dtype=np.int64), np.asarray(merged, dtype=np.float64).reshape(-1, 4)
+
+def merge_tile_objects(objects, method=None, threshold=None, metric=None):
+    """Merge the globally shifted objects of all tiles into one list of object dicts"""
+    detections = DetectionResult.from_objects(objects)
+    boxed = np.flatnonzero(detections.has_box)
+    if len(boxed) < 2:
+        return list(objects)
+    kept, merged = merge_boxes(detections.boxes[boxed], detections.scores_or(1.0)[boxed],
+                               detections.category_ids[boxed], method, threshold, metric)
+    fused = (method or TILE_MERGE) == "wbf"
+    result = []
+    for index, box in zip(boxed[kept].tolist(), np.round(merged, 2).tolist()):
+        obj = dict(objects[index])
+        if fused:
+            obj["bbox"] = box
+        result.append(obj)
+    # 没有边界框的对象不参与合并
+    result.extend(objects[i] for i in np.flatnonzero(~detections.has_box).tolist())
+    return result
+
+def detect_objects_tiled(image, prompt_type="text", prompt_text=None, prompt_universal=None,
+                         targets=["bbox"], bbox_threshold=0.25, iou_threshold=0.8, session_id=None,
+                         tile_size=None, overlap=None, concurrency=None, merge=None, merge_threshold=None,
+                         merge_metric=None, full_image=None, upload_policy=None):
+    """
+    Detect objects in a large image tile by tile
+
+    参数与 detect_objects 相同，另外:
+        tile_size / overlap: 分块边长和重叠比例
+        concurrency: 同时在途的分块任务数
+        merge / merge_threshold / merge_metric: 接缝处重复检测的合并方式（nms / wbf）、阈值和重叠度量（iou / ios）
+        full_image: 是否额外检测整张图像（用于跨越多个分块的大目标；最长边缩小到 tile_size 后上传）
+
+    返回 (result, session_id)，result 与 detect_objects 的格式相同，可以直接用于可视化。
+    分块结果中的掩码是分块坐标系下的RLE，合并后不保留；分块失败时其余分块的结果仍然返回，错误记录在 "tile_errors" 中。
+    """
+    pixels = decode_to_array(image)
+    height, width = pixels.shape[:2]
+    windows = tile_grid(width, height, tile_size, overlap)
+    full_image = TILE_FULL_IMAGE if full_image is None else full_image
+    if "mask" in targets:
+        logger.warning("Masks are not merged across tiles and will be dropped from the tiled result")
+
+    # 分块是原图的视图，编码在批量流水线的线程池中进行
+    crops = [pixels[y1:y2, x1:x2] for x1, y1, x2, y2 in windows.tolist()]
+    offsets = [(x1, y1) for x1, y1, _, _ in windows.tolist()]
+    full_scale, full_size = None, None
+    if full_image and len(windows) > 1:
+        # 整张图像不受 upload_policy（默认不缩放）的限制，单独缩小到分块大小后上传，结果再映射回原图
+        full_data, full_scale, upload = prepare_upload(pixels, UploadPolicy(max_side=tile_size or TILE_SIZE))
+        full_size = upload["upload_size"]
+        crops.append(full_data)
+        offsets.append((0, 0))
+    logger.info("Tiled detection: %dx%d image, %d tile(s)%s", width, height, len(windows),
+                " + full image at %dx%d" % full_size if full_size else "")
+
+    objects, errors = [], []
+    last_session_id = session_id
+    for index, result, new_session_id in detect_objects_batch(
+            crops, prompt_type, prompt_text, prompt_universal, targets, bbox_threshold, iou_threshold,
+            session_id, concurrency=concurrency or TILE_CONCURRENCY, upload_policy=upload_policy):
+        if result.get("error"):
+            errors.append({"tile": index, "window": windows[index].tolist() if index < len(windows) else None,
+                           "error": result["error"]})
+            continue
+        dx, dy = offsets[index]
+        shifted = shift_objects(result.get("objects"), dx, dy)
+        if index == len(windows):
+            # 就地缩放 shift_objects 返回的副本，结果缓存中的对象不受影响
+            rescale_result({"objects": shifted}, full_scale)
+        objects.extend(shifted)
+        last_session_id = new_session_id or last_session_id
+
+    merged = {"objects": merge_tile_objects(objects, merge, merge_threshold, merge_metric) if len(crops) > 1
+              else objects}
+    if errors:
+        logger.warning("%d of %d tile(s) failed", len(errors), len(crops))
+        merged["tile_errors"] = errors
+    return merged, last_session_id
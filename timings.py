@@ -0,0 +1,94 @@
+"""
+Per-stage timing of DINO-X requests
+按阶段累计耗时（编码、上传、排队等待、轮询、JSON解析……）；没有激活的 StageTrace 时不做任何计时
+"""
+import contextlib
+import contextvars
+import time
+
+# 客户端代码中使用的阶段名
+STAGES = ("decode", "encode", "upload", "rate_limit", "queue_wait", "poll", "json_parse", "visualization")
+
+_current_trace = contextvars.ContextVar("dinox_stage_trace", default=None)
+
+class StageTrace:
+    """
+    Accumulated self time per stage
+
+    阶段可以嵌套：外层阶段只记录去掉内层阶段后的时间（例如上传时间不包含限流等待），
+    因此各阶段之和不超过总耗时。
+    """
+    __slots__ = ("stages", "_stack", "started")
+
+    def __init__(self):
+        self.stages = {}
+        self._stack = []
+        self.started = time.perf_counter()
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self._stack:
+            # 从外层阶段中扣除
+            self._stack[-1][1] += seconds
+
+    def enter(self, name):
+        self._stack.append([name, 0.0, time.perf_counter()])
+
+    def exit(self):
+        name, children, start = self._stack.pop()
+        elapsed = time.perf_counter() - start
+        self.add(name, elapsed - children)
+        if self._stack:
+            # add() 已经把自身时间计入外层，这里补上内层阶段的时间
+            self._stack[-1][1] += children
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        return dict(self.stages)
+
+def current_trace():
+    return _current_trace.get()
+
+@contextlib.contextmanager
+def trace_stages(trace=None):
+    """Collect stage timings of everything run in this context (thread / asyncio task)"""
+    trace = trace if trace is not None else StageTrace()
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a block as stage `name` of the active trace (no-op without one)"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    trace.enter(name)
+    try:
+        yield
+    finally:
+        trace.exit()
+
+def record_stage(name, seconds):
+    """Add an externally measured duration (e.g. a sleep) to the active trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+def summarize(values):
+    """count / mean / p50 / p95 / p99 / max of a list of durations"""
+    values = sorted(values)
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+
+    def pct(q):
+        return values[min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))]
+
+    return {"count": len(values), "mean": sum(values) / len(values),
+            "p50": pct(50), "p95": pct(95), "p99": pct(99), "max": values[-1]}
@@ -6,6 +6,14 @@ import matplotlib.colors as mcolors
 import random
 from PIL import Image, ImageDraw, ImageFont
 import io
+from functools import lru_cache
+
+import mask_codec
+from detection_result import as_detection_result, parse_keypoints
+from keypoints import CONNECTIONS, draw_skeletons, result_keypoints
+from dinox_logging import get_logger
+
+logger = get_logger("visualization")
 
 # Define a color palette for visualization
 COLORS = list(mcolors.TABLEAU_COLORS.values())
@@ -14,14 +22,19 @@ def get_color(idx):
     """Get a color from the predefined color palette"""
     return COLORS[idx % len(COLORS)]
 
+@lru_cache(maxsize=4096)
+def text_size(text, font=cv2.FONT_HERSHEY_SIMPLEX, font_scale=0.5, thickness=1):
+    """cv2.getTextSize with the results cached per (text, font, scale, thickness)"""
+    return cv2.getTextSize(text, font, font_scale, thickness)
+
 def decode_rle_mask(rle, shape):
     """
     Decode a run-length encoded mask in COCO RLE format
     
     COCO RLE格式说明:
-    1. counts: 可以是字符串或整数数组
-    2. 如果是字符串，它是一个压缩的RLE编码
-    3. 如果是整数数组，它表示交替的0和1的像素数量
+    1. counts: 可以是压缩字符串或整数数组
+    2. 游程按列优先（column-major）顺序排列，交替表示0和1的像素数量
+    3. 解码由 mask_codec 完成（纯NumPy实现，不依赖 pycocotools）
     """
     if rle is None:
         return None
@@ -29,73 +42,106 @@ def decode_rle_mask(rle, shape):
     counts = rle.get("counts")
     size = rle.get("size")
     
-    if not counts or not size:
+    if counts is None or len(counts) == 0 or not size:
         return None
     
     try:
-        # 创建空白掩码
-        mask = np.zeros((size[0], size[1]), dtype=np.uint8)
-        
-        # 检查counts是否为字符串（压缩格式）
-        if isinstance(counts, str):
-            try:
-                # 尝试使用pycocotools解码（如果可用）
-                try:
-                    from pycocotools import mask as mask_util
-                    binary_mask = mask_util.decode({'size': size, 'counts': counts.encode('utf-8')})
-                    return binary_mask
-                except ImportError:
-                    print("pycocotools not available, using fallback method")
-                    
-                # 如果pycocotools不可用，使用备用方法
-                # 这是一个简单的实现，可能不支持所有COCO RLE格式
-                # 将压缩的RLE转换为整数数组
-                import zlib
-                import struct
-                
-                # 尝试解压缩（如果是压缩的）
-                try:
-                    decoded = zlib.decompress(counts.encode('ascii'))
-                    counts_array = struct.unpack('<%dI' % (len(decoded) // 4), decoded)
-                except Exception as e:
-                    print(f"Failed to decompress RLE: {e}")
-                    # 如果解压缩失败，尝试直接解析
-                    counts_array = []
-                    for count_str in counts.split():
-                        try:
-                            counts_array.append(int(count_str))
-                        except ValueError:
-                            # 如果无法解析为整数，可能是使用了其他编码
-                            print(f"Warning: Could not parse count '{count_str}' as integer")
-                            return None
-            except Exception as e:
-                print(f"Error decoding compressed RLE: {e}")
-                return None
-        else:
-            # 如果counts已经是数组，直接使用
-            counts_array = counts
-        
-        # 解码RLE
-        idx = 0
-        val = 0
-        for count in counts_array:
-            end_idx = min(idx + count, size[0] * size[1])
-            mask.flat[idx:end_idx] = val
-            idx = end_idx
-            val = 1 - val
+        mask = mask_codec.decode(rle)
         
         # 调整掩码大小以匹配图像形状
-        if shape != size:
+        if tuple(shape) != mask.shape:
             mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
         
         return mask
     
-    except Exception as e:
-        print(f"Error decoding RLE mask: {e}")
-        import traceback
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Error decoding RLE mask")
+        return None
+
+def decode_rle_roi(rle, shape, bbox=None, padding=2):
+    """
+    Decode the part of an RLE mask around `bbox`, scaled to an image of `shape`
+
+    只解码边界框（外扩 padding 像素）覆盖的列和行，按最近邻映射到图像坐标，与 decode_rle_mask 整幅解码再缩放的结果一致。
+    返回 ((x1, y1, x2, y2), roi_mask)，roi_mask 的形状为 (y2 - y1, x2 - x1)；没有边界框时覆盖整幅图像。解码失败返回 None。
+    """
+    if rle is None or not rle.get("counts") or not rle.get("size"):
+        return None
+    
+    try:
+        height, width = int(shape[0]), int(shape[1])
+        mask_height, mask_width = (int(v) for v in rle["size"])
+        if bbox is None:
+            x1, y1, x2, y2 = 0, 0, width, height
+        else:
+            x1 = min(max(int(np.floor(bbox[0])) - padding, 0), width)
+            y1 = min(max(int(np.floor(bbox[1])) - padding, 0), height)
+            x2 = min(max(int(np.ceil(bbox[2])) + padding, x1), width)
+            y2 = min(max(int(np.ceil(bbox[3])) + padding, y1), height)
+        if x2 <= x1 or y2 <= y1:
+            return (x1, y1, x1, y1), np.zeros((0, 0), dtype=np.uint8)
+        
+        # 图像像素 -> 掩码像素（最近邻；比例的算法与 cv2.INTER_NEAREST 相同，保证逐像素一致）
+        cols = np.minimum((np.arange(x1, x2) * (1.0 / (width / mask_width))).astype(np.int64), mask_width - 1)
+        rows = np.minimum((np.arange(y1, y2) * (1.0 / (height / mask_height))).astype(np.int64), mask_height - 1)
+        region = mask_codec.decode_region(rle, int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+        if (mask_height, mask_width) != (height, width):
+            region = region[(rows - rows[0])[:, None], cols - cols[0]]
+        return (x1, y1, x2, y2), region
+    
+    except Exception:
+        logger.exception("Error decoding RLE mask")
         return None
 
+def _to_bgr(color):
+    # matplotlib 颜色 -> 与 draw_bbox 相同的 BGR 元组
+    if isinstance(color, str):
+        rgb = mcolors.to_rgb(color)
+        return (int(rgb[2] * 255), int(rgb[1] * 255), int(rgb[0] * 255))
+    return color
+
+def composite_masks(image, objects, indices=None, alpha=0.5):
+    """
+    Blend the masks of many objects onto `image` in one pass (in place); returns the image
+    
+    每个掩码只在自己的边界框范围内解码，写入一张标签图（后面的对象覆盖前面的），
+    最后对被覆盖的像素统一混合一次颜色。临时内存只与所有掩码ROI的并集大小有关，与对象数量无关。
+    对象 i 使用 get_color(i)，与 visualize_detection_results 中边界框的颜色一致。
+    """
+    detections = as_detection_result(objects)
+    if detections is None or not detections:
+        return image
+    
+    height, width = image.shape[:2]
+    indices = range(len(detections)) if indices is None else indices
+    rois = []
+    for i in indices:
+        if detections.masks[i] is None:
+            continue
+        decoded = detections.mask_roi(i, (height, width))
+        if decoded is None:
+            logger.warning("Failed to decode mask for object %d", i)
+        elif decoded[1].size:
+            rois.append((i, decoded[0], decoded[1]))
+    if not rois:
+        return image
+    
+    # 标签图只覆盖所有ROI的并集
+    windows = np.asarray([roi for _, roi, _ in rois])
+    ux1, uy1 = windows[:, :2].min(axis=0).tolist()
+    ux2, uy2 = windows[:, 2:].max(axis=0).tolist()
+    labels = np.full((uy2 - uy1, ux2 - ux1), -1, dtype=np.int16 if len(rois) < 32767 else np.int32)
+    for order, (_, (x1, y1, x2, y2), mask) in enumerate(rois):
+        labels[y1 - uy1:y2 - uy1, x1 - ux1:x2 - ux1][mask > 0] = order
+    
+    # 按标签查表得到彩色层（末行对应背景 -1），整块混合一次后只拷回被覆盖的像素
+    region = image[uy1:uy2, ux1:ux2]
+    palette = np.zeros((len(rois) + 1, region.shape[-1]), dtype=image.dtype)
+    palette[:-1] = np.asarray([_to_bgr(get_color(i)) for i, _, _ in rois])[:, :region.shape[-1]]
+    blended = cv2.addWeighted(palette[labels], alpha, region, 1 - alpha, 0)
+    np.copyto(region, blended, where=(labels >= 0)[..., None])
+    return image
+
 def draw_bbox(image, bbox, label=None, score=None, color=None):
     """
     Draw a bounding box on an image
@@ -124,7 +170,7 @@ def draw_bbox(image, bbox, label=None, score=None, color=None):
         font = cv2.FONT_HERSHEY_SIMPLEX
         font_scale = 0.5
         thickness = 1
-        (text_width, text_height), _ = cv2.getTextSize(text, font, font_scale, thickness)
+        (text_width, text_height), _ = text_size(text, font, font_scale, thickness)
         
         # Draw text background
         cv2.rectangle(image, (x1, y1 - text_height - 5), (x1 + text_width, y1), color, -1)
@@ -145,16 +191,19 @@ def draw_mask(image, mask, color=None, alpha=0.5):
         color = random.choice(COLORS)
     
     # Convert color from matplotlib format to BGR
-    if isinstance(color, str):
-        rgb = mcolors.to_rgb(color)
-        color = (int(rgb[2] * 255), int(rgb[1] * 255), int(rgb[0] * 255))
+    color = _to_bgr(color)
     
-    # Create a colored mask
-    colored_mask = np.zeros_like(image)
-    colored_mask[mask > 0] = color
-    
-    # Blend the mask with the image
-    cv2.addWeighted(colored_mask, alpha, image, 1 - alpha, 0, image)
+    # 只在掩码的外接矩形内混合，且只改动掩码覆盖的像素（不再为整幅图像分配彩色掩码）
+    covered = mask > 0
+    rows, cols = np.flatnonzero(covered.any(axis=1)), np.flatnonzero(covered.any(axis=0))
+    if rows.size == 0:
+        return image
+    y1, y2, x1, x2 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    region = image[y1:y2, x1:x2]
+    colored = np.empty_like(region)
+    colored[:] = np.asarray(color, dtype=image.dtype)[:region.shape[-1]]
+    blended = cv2.addWeighted(colored, alpha, region, 1 - alpha, 0)
+    np.copyto(region, blended, where=covered[y1:y2, x1:x2, None])
     
     return image
 
@@ -166,170 +215,85 @@ def draw_keypoints(image, keypoints, connections=None, color=None):
     1. 扁平列表: [x1, y1, v1, s1, x2, y2, v2, s2, ...]
     2. 嵌套列表: [[x1, y1, v1, s1], [x2, y2, v2, s2], ...]
     3. 字典列表: [{"x": x1, "y": y1, "visible": v1, "score": s1}, ...]
+    4. (K, 4) 数组（DetectionResult.keypoints 的返回值）
+    
+    返回绘制后的副本；一次绘制多个对象请使用 keypoints.draw_skeletons（原地绘制，不复制图像）
     """
     if keypoints is None or len(keypoints) == 0:
-        print("Warning: No keypoints to draw")
+        logger.debug("No keypoints to draw")
         return image
     
-    # Make a copy of the image to avoid modifying the original
-    vis_image = image.copy()
-    
     # If color is not provided, use a default color
     if color is None:
         color = (0, 255, 0)  # Green
     
     try:
-        print(f"Keypoints data type: {type(keypoints)}")
-        print(f"Keypoints data: {keypoints[:20] if isinstance(keypoints, list) else keypoints}")
-        
-        # 转换关键点为标准格式: [[x, y, visible, score], ...]
-        formatted_keypoints = []
-        
-        # 检查关键点格式
-        if isinstance(keypoints, list):
-            if len(keypoints) == 0:
-                return vis_image
-                
-            # 检查是否为扁平列表
-            if not isinstance(keypoints[0], (list, dict)):
-                # 扁平列表: [x1, y1, v1, s1, x2, y2, v2, s2, ...]
-                for i in range(0, len(keypoints), 4):
-                    if i + 3 < len(keypoints):
-                        x, y, v, s = keypoints[i:i+4]
-                        formatted_keypoints.append([x, y, v, s])
-            
-            # 检查是否为嵌套列表
-            elif isinstance(keypoints[0], list):
-                # 嵌套列表: [[x1, y1, v1, s1], [x2, y2, v2, s2], ...]
-                formatted_keypoints = keypoints
-            
-            # 检查是否为字典列表
-            elif isinstance(keypoints[0], dict):
-                # 字典列表: [{"x": x1, "y": y1, "visible": v1, "score": s1}, ...]
-                for kp in keypoints:
-                    x = kp.get("x", 0)
-                    y = kp.get("y", 0)
-                    v = kp.get("visible", 0)
-                    s = kp.get("score", 0)
-                    formatted_keypoints.append([x, y, v, s])
-        else:
-            print(f"Unsupported keypoints format: {type(keypoints)}")
-            return vis_image
-        
-        print(f"Formatted keypoints: {formatted_keypoints[:5]}")
-        
-        # 绘制关键点
-        for i, kp in enumerate(formatted_keypoints):
-            x, y, visible, score = kp
-            
-            # 只绘制可见的关键点
-            if visible > 0 and score > 0.1:
-                cv2.circle(vis_image, (int(x), int(y)), 5, color, -1)
-                
-                # 可选: 绘制关键点索引
-                # cv2.putText(vis_image, str(i), (int(x), int(y)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
-        
-        # 绘制连接线
-        if connections is not None:
-            for connection in connections:
-                idx1, idx2 = connection
-                
-                if idx1 < len(formatted_keypoints) and idx2 < len(formatted_keypoints):
-                    kp1 = formatted_keypoints[idx1]
-                    kp2 = formatted_keypoints[idx2]
-                    
-                    x1, y1, v1, s1 = kp1
-                    x2, y2, v2, s2 = kp2
-                    
-                    # 只绘制两个端点都可见的连接线
-                    if v1 > 0 and v2 > 0 and s1 > 0.1 and s2 > 0.1:
-                        cv2.line(vis_image, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-        
-        return vis_image
+        points = parse_keypoints(keypoints)
+        return draw_skeletons(image.copy(), points[None], connections, [_to_bgr(color)])
     
-    except Exception as e:
-        print(f"Error in draw_keypoints: {e}")
-        import traceback
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("Error in draw_keypoints")
         return image
 
 def visualize_detection_results(image, objects, show_bbox=True, show_mask=True, 
                                show_pose=True, show_hand=True, show_caption=True):
     """
     Visualize detection results on an image
+
+    objects 可以是对象字典列表、API结果字典或 DetectionResult
     """
-    if objects is None or not objects:
+    detections = as_detection_result(objects)
+    if detections is None or not detections:
         return image
     
     # Make a copy of the image to avoid modifying the original
     vis_image = image.copy()
     
+    # 一次性取出所有列，避免逐个对象查字典
+    boxes = detections.boxes.tolist()
+    has_box = detections.has_box.tolist()
+    categories = detections.category_names("object").tolist()
+    scores = detections.scores_or(1.0).tolist()
+    
+    # 所有掩码一次合成，画在边界框和关键点的下面
+    if show_mask and detections.has_mask.any():
+        try:
+            vis_image = composite_masks(vis_image, detections)
+        except Exception:
+            logger.exception("Error compositing masks")
+    
     # Process each detected object
-    for i, obj in enumerate(objects):
+    for i in range(len(detections)):
         # Get a color for this object
         color = get_color(i)
         
         # Get the bounding box
-        bbox = obj.get("bbox")
-        category = obj.get("category", "object")
-        score = obj.get("score", 1.0)
+        bbox = boxes[i] if has_box[i] else None
+        category = categories[i]
+        score = scores[i]
         
         # Draw bounding box
         if show_bbox and bbox:
             vis_image = draw_bbox(vis_image, bbox, category, score, color)
+    
+    # 所有对象的姿态和手部关键点批量绘制（画在边界框之上、描述之下）
+    for kind, enabled in (("pose", show_pose), ("hand", show_hand)):
+        if not enabled:
+            continue
+        try:
+            indices, points = result_keypoints(detections, kind)
+            if len(indices):
+                draw_skeletons(vis_image, points, CONNECTIONS[kind], [_to_bgr(get_color(i)) for i in indices.tolist()])
+        except Exception as e:
+            logger.warning("Error drawing %s keypoints: %s", kind, e)
+    
+    # Draw captions
+    for i, caption in enumerate(detections.captions):
+        color = get_color(i)
+        bbox = boxes[i] if has_box[i] else None
         
-        # Draw mask
-        if show_mask and "mask" in obj and obj["mask"]:
-            try:
-                print(f"Processing mask for object {i} (category: {category})")
-                print(f"Mask data: {obj['mask']}")
-                
-                mask = decode_rle_mask(obj["mask"], vis_image.shape[:2])
-                
-                if mask is not None:
-                    vis_image = draw_mask(vis_image, mask, color)
-                else:
-                    print(f"Warning: Failed to decode mask for object {i}")
-            except Exception as e:
-                print(f"Error processing mask for object {i}: {e}")
-                import traceback
-                print(traceback.format_exc())
-        
-        # Draw pose keypoints
-        if show_pose and "pose_keypoints" in obj and obj["pose_keypoints"]:
-            try:
-                keypoints = obj["pose_keypoints"]
-                connections = [
-                    (0, 1), (0, 2), (1, 3), (2, 4),  # Face
-                    (5, 7), (7, 9), (6, 8), (8, 10),  # Arms
-                    (5, 6), (5, 11), (6, 12), (11, 12),  # Torso
-                    (11, 13), (13, 15), (12, 14), (14, 16)  # Legs
-                ]
-                vis_image = draw_keypoints(vis_image, keypoints, connections, color)
-            except Exception as e:
-                print(f"Error drawing pose keypoints: {e}")
-        
-        # Draw hand keypoints
-        if show_hand and "hand_keypoints" in obj and obj["hand_keypoints"]:
-            try:
-                keypoints = obj["hand_keypoints"]
-                connections = [
-                    (0, 1), (1, 2), (2, 3), (3, 4),  # Thumb
-                    (0, 5), (5, 6), (6, 7), (7, 8),  # Index finger
-                    (0, 9), (9, 10), (10, 11), (11, 12),  # Middle finger
-                    (0, 13), (13, 14), (14, 15), (15, 16),  # Ring finger
-                    (0, 17), (17, 18), (18, 19), (19, 20)  # Pinky finger
-                ]
-                vis_image = draw_keypoints(vis_image, keypoints, connections, color)
-            except Exception as e:
-                print(f"Error drawing hand keypoints: {e}")
-        
-        # Draw caption
-        if show_caption and "caption" in obj and obj["caption"]:
+        if show_caption and caption:
             try:
-                # Get the caption
-                caption = obj["caption"]
-                
                 # Get the top-left corner of the bounding box
                 if bbox:
                     x, y = int(bbox[0]), int(bbox[1])
@@ -338,30 +302,30 @@ def visualize_detection_results(image, objects, show_bbox=True, show_mask=True,
                     x, y = 10, 10 + i * 20
                 
                 # Draw the caption
-                cv2.putText(vis_image, caption, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2)
+                cv2.putText(vis_image, caption, (x, y - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, _to_bgr(color), 2)
             except Exception as e:
-                print(f"Error drawing caption: {e}")
+                logger.warning("Error drawing caption: %s", e)
     
     return vis_image
 
 def create_detection_summary(objects):
     """
-    Create a text summary of detection results
+    Create a text summary of detection results (object dicts, a result dict or a DetectionResult)
     """
-    if not objects:
+    detections = as_detection_result(objects)
+    if detections is None or not detections:
         return "No objects detected."
     
-    summary = f"Detected {len(objects)} objects:\n"
+    categories = detections.category_names("unknown").tolist()
+    scores = detections.scores_or(0).tolist()
+    lines = [f"Detected {len(detections)} objects:"]
     
-    for i, obj in enumerate(objects):
-        category = obj.get("category", "unknown")
-        score = obj.get("score", 0)
-        
-        summary += f"{i+1}. {category} (confidence: {score:.2f})"
+    for i, (category, score, caption) in enumerate(zip(categories, scores, detections.captions)):
+        line = f"{i+1}. {category} (confidence: {score:.2f})"
         
-        if "caption" in obj:
-            summary += f" - {obj['caption']}"
+        if caption is not None:
+            line += f" - {caption}"
         
-        summary += "\n"
+        lines.append(line)
     
-    return summary 
\ No newline at end of file
+    return "\n".join(lines) + "\n"